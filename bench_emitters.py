@@ -0,0 +1,101 @@
+import os
+import argparse
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from create_doppelganger_repo import EMITTERS, create_doppelganger_repo
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'create_doppelganger_repo.py')
+
+MODULE_TEMPLATE = '''"""Generated module {index} for the emitter benchmark."""
+import os
+import json
+from collections import OrderedDict
+
+LIMIT = {index}
+NAMES = ["alpha", "beta", "gamma", "delta"]
+
+
+def helper_{index}(value, scale=2, *args, **kwargs):
+    """Scale a value."""
+    result = value * scale
+    for item in args:
+        result += item
+    return result
+
+
+async def fetch_{index}(session, url, timeout=10):
+    async with session.get(url, timeout=timeout) as response:
+        return await response.json()
+
+
+class Model{index}(object):
+    """A small model class."""
+
+    default = OrderedDict(a=1, b=2)
+
+    def __init__(self, name, payload=None):
+        self.name = name
+        self.payload = payload or {{}}
+
+    @property
+    def size(self):
+        return len(json.dumps(self.payload))
+
+    def save(self, path):
+        with open(os.path.join(path, self.name), "w") as file:
+            json.dump(self.payload, file)
+        return path
+'''
+
+def generate_corpus(root, modules, per_package=50):
+    # Spread the modules over packages the way a real repository would
+    for index in range(modules):
+        package = os.path.join(root, f'pkg{index // per_package}')
+        if index % per_package == 0:
+            os.makedirs(package, exist_ok=True)
+            with open(os.path.join(package, '__init__.py'), 'w') as file:
+                file.write('')
+        with open(os.path.join(package, f'module{index}.py'), 'w') as file:
+            file.write(MODULE_TEMPLATE.format(index=index))
+
+def time_cli(*args, repeat=5):
+    # Best of a few runs of a fresh interpreter, including its startup
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, SCRIPT, *args], check=True, stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the stub emitters of create_doppelganger_repo.py on a generated corpus.")
+    parser.add_argument("--modules", type=int, default=3000, help="Number of modules in the generated corpus")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes generating stubs")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_emitters_')
+    try:
+        src_dir = os.path.join(work_dir, 'src')
+        generate_corpus(src_dir, args.modules)
+        print(f"Corpus: {args.modules} modules, jobs={args.jobs}")
+
+        for emitter in EMITTERS:
+            dst_dir = os.path.join(work_dir, f'dst_{emitter}')
+            start = time.perf_counter()
+            stats = create_doppelganger_repo(src_dir, dst_dir, jobs=args.jobs, emitter=emitter)
+            elapsed = time.perf_counter() - start
+            assert not stats['errors'], stats['errors']
+            print(f"{emitter:>6}: full build {elapsed:8.3f}s  ({args.modules / elapsed:8.0f} modules/s)")
+
+        print(f"CLI --help:            {time_cli('--help') * 1000:8.1f}ms")
+        print(f"CLI no-op incremental: {time_cli(src_dir, os.path.join(work_dir, 'dst_fast')) * 1000:8.1f}ms")
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import json
+import timeit
+import tracemalloc
+
+from example import JSON_HEADERS, HttpRequest, HttpResponse, process_post_fixed
+
+class DictRequest:
+    # HttpRequest as it was before __slots__ and lazy JSON, for reference
+    def __init__(self, method, path, headers=None, body=None):
+        self.method = method
+        self.path = path
+        self.headers = headers if headers else {}
+        self.body = body
+
+class DictResponse:
+    def __init__(self, status_code, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers if headers else {}
+        self.body = body
+
+def dict_exchange(method, path, headers, body):
+    # A request and its response as the handlers built them before
+    request = DictRequest(method, path, headers, body.decode())
+    data = json.loads(request.body)
+    response = DictResponse(status_code=200, headers={"Content-Type": "application/json"}, body=process_post_fixed(data))
+    return request, response
+
+def compact_exchange(method, path, headers, body):
+    request = HttpRequest(method, path, headers, body)
+    response = HttpResponse(status_code=200, headers=JSON_HEADERS, body=process_post_fixed(request.json))
+    return request, response
+
+def held_memory(make_request, count):
+    # Bytes held by `count` live requests and their responses
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [make_request() for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / count
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the memory and time per request of the dict-backed and the compact HttpRequest/HttpResponse.")
+    parser.add_argument("--requests", type=int, default=20000, help="Number of requests per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timing runs (best is reported)")
+    args = parser.parse_args()
+
+    body = json.dumps({"name": "Alice"}).encode()
+    wire = memoryview(b"POST /hello HTTP/1.1\r\n\r\n" + body)[-len(body):]
+    headers = {"Content-Type": "application/json", "Accept": "application/json", "User-Agent": "bench"}
+
+    print(f"{args.requests} POST requests, best of {args.repeat}")
+    for name, exchange, request_headers, request_body in [
+        ("dict-backed", dict_exchange, None, body),
+        ("compact", compact_exchange, None, body),
+        ("compact, memoryview", compact_exchange, None, wire),
+        ("compact, str", compact_exchange, None, body.decode()),
+        ("dict-backed, 3 headers", dict_exchange, headers, body),
+        ("compact, 3 headers", compact_exchange, headers, body),
+    ]:
+        # Headers are parsed into a new dict for every request
+        run = lambda: exchange("POST", "/hello", request_headers and dict(request_headers), request_body)
+        memory = held_memory(run, args.requests)
+        seconds = min(timeit.repeat(run, number=args.requests, repeat=args.repeat + 1)[1:])
+        print(f"{name:>23}: {memory:6.0f} bytes held per request/response pair, {args.requests / seconds:8.0f} pairs/s")
+
+if __name__ == '__main__':
+    main()
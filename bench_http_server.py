@@ -0,0 +1,117 @@
+import os
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def request_bytes(body):
+    return (
+        b"POST /hello HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+        + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+async def run_connection(host, port, payloads, count, pipeline, latencies, statuses):
+    # Keeps up to `pipeline` requests in flight on one persistent connection
+    reader, writer = await asyncio.open_connection(host, port)
+    sent = []
+    received = 0
+    try:
+        while received < count:
+            while len(sent) - received < pipeline and len(sent) < count:
+                writer.write(random.choice(payloads))
+                sent.append(time.perf_counter())
+            await writer.drain()
+            status = await read_response(reader)
+            latencies.append(time.perf_counter() - sent[received])
+            statuses[status] = statuses.get(status, 0) + 1
+            received += 1
+    finally:
+        writer.close()
+
+async def run_load(host, port, payloads, connections, requests, pipeline):
+    latencies = []
+    statuses = {}
+    started = time.perf_counter()
+    per_connection = [requests // connections + (index < requests % connections) for index in range(connections)]
+    await asyncio.gather(*(
+        run_connection(host, port, payloads, count, pipeline, latencies, statuses) for count in per_connection if count
+    ))
+    return time.perf_counter() - started, sorted(latencies), statuses
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def start_server(process_post, args, log_file):
+    command = [
+        sys.executable, os.path.join(HERE, "http_server.py"), "--port", "0",
+        "--handler", args.handler, "--process-post", process_post, "--pool", args.pool,
+        "--log-file", log_file, "--log-level", args.log_level,
+    ]
+    if args.workers:
+        command += ["--workers", str(args.workers)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    line = server.stdout.readline()
+    if not line.startswith("Listening on "):
+        server.kill()
+        raise RuntimeError(f"The server did not start: {line!r}")
+    host, port = line.rsplit("/", 1)[1].strip().rsplit(":", 1)
+    return server, host, int(port)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure requests/s and latency of http_server.py over 127.0.0.1 for the buggy and fixed process_post.")
+    parser.add_argument("--connections", type=int, default=32, help="Number of concurrent persistent connections")
+    parser.add_argument("--requests", type=int, default=20000, help="Number of measured requests per variant")
+    parser.add_argument("--warmup", type=int, default=1000, help="Number of requests sent before measuring")
+    parser.add_argument("--pipeline", type=int, default=1, help="Requests in flight per connection")
+    parser.add_argument("--missing-name-rate", type=float, default=0.1, help="Fraction of requests without a name, which the buggy variant fails on")
+    parser.add_argument("--handler", default="with_exception", choices=["no_exception", "with_exception"], help="Handler of the server")
+    parser.add_argument("--pool", default="none", choices=["none", "thread", "process"], help="Where the server runs the handler")
+    parser.add_argument("--workers", type=int, default=None, help="Number of pool workers of the server")
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Log level of the server")
+    args = parser.parse_args()
+
+    # Payload mix drawn at random; the load generator shares the machine with
+    # the server, so its own CPU use lowers the numbers for both variants alike
+    named = request_bytes(json.dumps({"name": "Alice"}).encode())
+    unnamed = request_bytes(json.dumps({"age": 30}).encode())
+    unnamed_count = round(100 * args.missing_name_rate)
+    payloads = [unnamed] * unnamed_count + [named] * (100 - unnamed_count)
+
+    print(f"{args.requests} requests over {args.connections} connections, {args.pipeline} in flight each, "
+          f"handler {args.handler}, pool {args.pool}")
+    with tempfile.TemporaryDirectory() as log_dir:
+        for process_post in ("buggy", "fixed"):
+            server, host, port = start_server(process_post, args, os.path.join(log_dir, f"{process_post}.log"))
+            try:
+                if args.warmup:
+                    asyncio.run(run_load(host, port, payloads, args.connections, args.warmup, args.pipeline))
+                seconds, latencies, statuses = asyncio.run(
+                    run_load(host, port, payloads, args.connections, args.requests, args.pipeline)
+                )
+            finally:
+                server.terminate()
+                server.wait()
+            counts = ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items()))
+            print(f"{process_post:>6}: {args.requests / seconds:8.0f} requests/s, "
+                  f"p50 {percentile(latencies, 0.5) * 1000:6.2f} ms, p99 {percentile(latencies, 0.99) * 1000:6.2f} ms ({counts})")
+
+if __name__ == '__main__':
+    main()
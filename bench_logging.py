@@ -0,0 +1,62 @@
+import os
+import argparse
+import json
+import logging
+import timeit
+
+import example
+from example import HttpRequest, HttpResponse, LogPolicy, handle_request_with_exception, logger, process_post_fixed
+
+def eager_handler(request, process_post):
+    # The POST path of the handlers as they were before logging became lazy,
+    # for reference: every message is rendered whether it is emitted or not
+    logger.debug(f"Received {request.method} request: Path={request.path}, Headers={request.headers}, Body={request.body}")
+    data = json.loads(request.body)
+    logger.debug(f"Parsed POST data: {data}")
+    response_body = process_post(data)
+    response = HttpResponse(status_code=200, headers={"Content-Type": "application/json"}, body=response_body)
+    logger.debug(f"Generated response: Status=200, Headers={response.headers}, Body={response_body}")
+    return response
+
+def throughput(handler, request, log_policy, number, repeat):
+    if log_policy is None:
+        call = lambda: handler(request, process_post_fixed)
+    else:
+        call = lambda: handler(request, process_post_fixed, log_policy)
+    # The first run warms up the interpreter and CPU clocks and is discarded
+    return number / min(timeit.repeat(call, number=number, repeat=repeat + 1)[1:])
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure handler throughput under the different logging configurations of example.py.")
+    parser.add_argument("--requests", type=int, default=20000, help="Number of requests per timing run")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timing runs per configuration (best is reported)")
+    parser.add_argument("--body-size", type=int, default=2000, help="Approximate size of the request body in bytes")
+    args = parser.parse_args()
+
+    # Log to /dev/null rather than to http_detailed_log_file.log and stderr
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    devnull = logging.StreamHandler(open(os.devnull, "w"))
+    devnull.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(devnull)
+
+    body = json.dumps({"name": "Alice", "padding": "x" * args.body_size})
+    request = HttpRequest(method="POST", path="/hello", headers={"Content-Type": "application/json"}, body=body)
+
+    configurations = [
+        ("logger disabled", logging.DEBUG, True, handle_request_with_exception, example.DEFAULT_LOG_POLICY),
+        ("DEBUG off", logging.INFO, False, handle_request_with_exception, example.DEFAULT_LOG_POLICY),
+        ("DEBUG off, eager f-strings", logging.INFO, False, eager_handler, None),
+        ("DEBUG on, 1% sampled", logging.DEBUG, False, handle_request_with_exception, LogPolicy(default_sample_rate=0.01)),
+        ("DEBUG on, bodies cut to 100", logging.DEBUG, False, handle_request_with_exception, LogPolicy(max_body_length=100)),
+        ("DEBUG on", logging.DEBUG, False, handle_request_with_exception, example.DEFAULT_LOG_POLICY),
+    ]
+    print(f"{args.requests} POST requests with a {len(body)} byte body, best of {args.repeat}")
+    for name, level, disabled, handler, log_policy in configurations:
+        logger.setLevel(level)
+        logger.disabled = disabled
+        rate = throughput(handler, request, log_policy, args.requests, args.repeat)
+        print(f"{name:>28}: {rate:10.0f} requests/s")
+
+if __name__ == '__main__':
+    main()
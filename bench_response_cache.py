@@ -0,0 +1,58 @@
+import os
+import argparse
+import json
+import logging
+import random
+import timeit
+
+from example import HttpRequest, ResponseCache, handle_request_with_exception, logger, process_post_fixed
+
+def throughput(requests, number, repeat, **caches):
+    iterator = iter(())
+
+    def call():
+        nonlocal iterator
+        request = next(iterator, None)
+        if request is None:
+            iterator = iter(requests)
+            request = next(iterator)
+        # A fresh request every time, as parsed off the wire
+        handle_request_with_exception(HttpRequest(request.method, request.path, request.headers, request.body),
+                                      process_post_fixed, **caches)
+
+    # The first run warms up the interpreter, CPU clocks and caches and is discarded
+    return number / min(timeit.repeat(call, number=number, repeat=repeat + 1)[1:])
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure handler throughput with and without the ResponseCache of example.py.")
+    parser.add_argument("--requests", type=int, default=20000, help="Number of requests per timing run")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timing runs per configuration (best is reported)")
+    parser.add_argument("--distinct", type=int, default=100, help="Number of distinct request bodies in the traffic")
+    parser.add_argument("--body-size", type=int, default=2000, help="Approximate size of the request bodies in bytes")
+    args = parser.parse_args()
+
+    # Log to /dev/null at INFO, like a production logger
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.StreamHandler(open(os.devnull, "w")))
+    logger.setLevel(logging.INFO)
+
+    rng = random.Random(0)
+    bodies = [json.dumps({"name": f"user{index}", "padding": "x" * args.body_size}) for index in range(args.distinct)]
+    repeated = [HttpRequest("POST", "/hello", {"Content-Type": "application/json"}, rng.choice(bodies)) for _ in range(10000)]
+    malformed = [HttpRequest("POST", "/hello", {"Content-Type": "application/json"}, rng.choice(bodies)[:-1]) for _ in range(10000)]
+
+    configurations = [
+        ("repeated bodies, no cache", repeated, {}),
+        ("repeated bodies, cached", repeated, {"response_cache": ResponseCache()}),
+        ("malformed flood, no cache", malformed, {}),
+        ("malformed flood, error cache", malformed, {"error_cache": ResponseCache(ttl=1.0)}),
+    ]
+    print(f"{args.requests} POST requests over {args.distinct} distinct {len(bodies[0])} byte bodies, best of {args.repeat}")
+    for name, requests, caches in configurations:
+        rate = throughput(requests, args.requests, args.repeat, **caches)
+        stats = ", ".join(f"{counter} {value}" for cache in caches.values() for counter, value in cache.stats().items())
+        print(f"{name:>29}: {rate:10.0f} requests/s" + (f" ({stats})" if stats else ""))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import re
+import timeit
+
+from example import PATH_PARAMETER, Router
+
+class LinearRouter:
+    # Routes tried one by one in the order added, like an if/elif chain
+    # grown to cover paths, for reference
+    def __init__(self):
+        self.routes = []
+
+    def add(self, method, path, handler):
+        regex = PATH_PARAMETER.sub(lambda parameter: f"(?P<{parameter.group(1)}>[^/]+)", path)
+        self.routes.append((method, re.compile(regex), handler))
+
+    def resolve(self, method, path):
+        for route_method, pattern, handler in self.routes:
+            match = pattern.fullmatch(path)
+            if match is not None and route_method == method:
+                return handler, match.groupdict()
+        return None, {}
+
+def handler(request, **params):
+    return None
+
+def route_paths(count):
+    # Half static paths, half with one or two parameters, each for GET and POST
+    paths = []
+    for index in range(count // 2):
+        if index % 2:
+            paths.append(f"/resource{index}")
+        elif index % 4:
+            paths.append(f"/resource{index}/{{item_id}}/comments/{{comment_id}}")
+        else:
+            paths.append(f"/api/v1/resource{index}/{{item_id}}")
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure dispatch time of the Router of example.py against trying every route in turn.")
+    parser.add_argument("--routes", type=int, default=400, help="Number of (method, path) routes registered")
+    parser.add_argument("--lookups", type=int, default=20000, help="Number of lookups per timing run")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timing runs (best is reported)")
+    args = parser.parse_args()
+
+    paths = route_paths(args.routes)
+    routers = [("linear", LinearRouter()), ("compiled", Router())]
+    for _, router in routers:
+        for path in paths:
+            for method in ("GET", "POST"):
+                router.add(method, path, handler)
+    routers[1][1].compile()
+
+    static = [path for path in paths if "{" not in path]
+    parameterized = [PATH_PARAMETER.sub("7", path) for path in paths if "{" in path]
+    lookups = [
+        ("first static path", "GET", static[0]),
+        ("last static path", "POST", static[-1]),
+        ("first parameterized path", "GET", parameterized[0]),
+        ("last parameterized path", "POST", parameterized[-1]),
+        ("unknown path", "GET", "/missing"),
+    ]
+    print(f"{args.routes} routes, {args.lookups} lookups, best of {args.repeat}")
+    for lookup, method, path in lookups:
+        results = []
+        for name, router in routers:
+            assert (router.resolve(method, path)[0] is None) == (lookup == "unknown path"), (name, path)
+            call = lambda: router.resolve(method, path)
+            # The first run warms up the interpreter and CPU clocks and is discarded
+            seconds = min(timeit.repeat(call, number=args.lookups, repeat=args.repeat + 1)[1:])
+            results.append(f"{name} {seconds / args.lookups * 1e6:8.2f} us")
+        print(f"{lookup:>24}: " + ", ".join(results))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import os
+import argparse
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Standard library modules a Django process typically imports at startup,
+# none of which are stubbed
+STDLIB_MODULES = [
+    'argparse', 'asyncio', 'base64', 'calendar', 'csv', 'dataclasses', 'datetime', 'decimal', 'difflib',
+    'email.message', 'email.utils', 'fractions', 'gettext', 'glob', 'gzip', 'hashlib', 'hmac', 'html.parser',
+    'http.client', 'http.cookies', 'inspect', 'ipaddress', 'json', 'locale', 'logging.config', 'mimetypes',
+    'numbers', 'pathlib', 'pickle', 'pprint', 'queue', 'random', 'secrets', 'shlex', 'signal', 'socket',
+    'sqlite3', 'string', 'tempfile', 'textwrap', 'threading', 'tokenize', 'traceback', 'typing', 'unicodedata',
+    'urllib.parse', 'urllib.request', 'uuid', 'warnings', 'weakref', 'xml.etree.ElementTree', 'zipfile', 'zoneinfo',
+]
+
+STARTUP_SCRIPT = '''
+import sys
+import time
+start = time.perf_counter()
+sys.path.insert(0, {here!r})
+if {mode!r} == 'finder':
+    from stub_finder import install_stub_finder
+    install_stub_finder([{stub_dir!r}, {extra_stub_dir!r}])
+else:
+    sys.path.insert(0, {extra_stub_dir!r})
+    sys.path.insert(0, {stub_dir!r})
+sys.path.insert(0, {app_dir!r})
+for name in {modules!r}:
+    __import__(name)
+print(time.perf_counter() - start)
+'''
+
+def write_package(root, package, modules, body):
+    package_dir = os.path.join(root, package)
+    os.makedirs(package_dir, exist_ok=True)
+    with open(os.path.join(package_dir, '__init__.py'), 'w') as file:
+        file.write('')
+    names = []
+    for index in range(modules):
+        with open(os.path.join(package_dir, f'module{index}.py'), 'w') as file:
+            file.write(body)
+        names.append(f'{package}.module{index}')
+    return names
+
+def time_startup(mode, paths, modules, repeat):
+    script = STARTUP_SCRIPT.format(mode=mode, here=HERE, modules=modules, **paths)
+    # The first run also writes the bytecode caches both modes then share
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    timings = []
+    for _ in range(repeat + 1):
+        output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True, env=env)
+        timings.append(float(output.stdout))
+    return min(timings[1:])
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare import time at startup with stub directories on sys.path versus the stub finder.")
+    parser.add_argument("--stubs", type=int, default=300, help="Number of stubbed modules")
+    parser.add_argument("--app-modules", type=int, default=300, help="Number of real, unstubbed application modules")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of interpreter runs per mode (best is reported)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench_stub_import_')
+    try:
+        paths = {name: os.path.join(work_dir, name) for name in ('stub_dir', 'extra_stub_dir', 'app_dir')}
+        modules = []
+        for package in range(max(1, args.stubs // 50)):
+            modules += write_package(paths['stub_dir'], f'stubbed{package}', min(50, args.stubs), 'def f():\n    pass\n')
+        write_package(paths['extra_stub_dir'], 'repo_a', 10, 'def g():\n    pass\n')
+        for package in range(max(1, args.app_modules // 50)):
+            modules += write_package(paths['app_dir'], f'app{package}', min(50, args.app_modules), 'VALUE = 1\n')
+        modules += STDLIB_MODULES
+
+        print(f"Importing {len(modules)} modules ({args.stubs} stubbed), best of {args.repeat}")
+        for mode in ('sys.path', 'finder'):
+            print(f"{mode:>8}: {time_startup(mode, paths, modules, args.repeat) * 1000:8.1f}ms")
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
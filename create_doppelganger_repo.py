@@ -1,29 +1,609 @@
 import os
-import ast
-import astunparse
 import argparse
-import black
+import hashlib
+import json
+import re
+import sys
 
-def replicate_directory_structure(src_dir, dst_dir):
-    for root, dirs, files in os.walk(src_dir):
-        # Compute destination directory
-        relative_path = os.path.relpath(root, src_dir)
-        dest_path = os.path.join(dst_dir, relative_path)
+# ast, astunparse, black and concurrent.futures are imported where they are
+# used, so that `--help` and no-op incremental runs do not pay for them.
 
-        # Create destination directory if it doesn't exist
-        os.makedirs(dest_path, exist_ok=True)
+# Bump whenever the stub output for an unchanged source file would change,
+# so that every entry of an existing manifest is invalidated.
+GENERATOR_VERSION = 1
 
-        # Process each file
-        for file in files:
-            if file.endswith('.py'):
-                create_stub_file(os.path.join(root, file), os.path.join(dest_path, file))
+# 'fast' unparses with the stdlib ast module; 'black' runs the original
+# astunparse + black pipeline and is opt-in since it dominates runtime.
+EMITTERS = ('fast', 'black')
+
+# 'pass' replaces function bodies with pass and keeps every other statement,
+# 'typed' returns defaults inferred from return annotations and replaces
+# module-level work with cheap placeholders (see typed_stubs.py).
+STUB_MODES = ('pass', 'typed')
+
+# 'pycache' writes an unchecked hash-based .pyc next to every stub, 'zip'
+# additionally bundles those into one archive importable through zipimport.
+BYTECODE_MODES = ('none', 'pycache', 'zip')
+
+# Name of the zipped, precompiled stub bundle in the doppelgänger root
+BUNDLE_NAME = 'stubs.zip'
+
+# 'tree' mirrors the main repository file by file, 'pack' writes every stub
+# into a single archive with a memory-mapped index (see stub_pack.py).
+OUTPUT_FORMATS = ('tree', 'pack')
+
+# Name of the stub pack in the doppelgänger root
+PACK_NAME = 'stubs.pack'
+
+# Name of the manifest kept in the root of the doppelgänger repository
+MANIFEST_NAME = '.doppelganger_manifest.json'
+
+# .gitignore-style patterns that are never worth descending into: VCS
+# metadata, caches, JavaScript dependencies and virtualenvs. Virtualenvs with
+# other names are recognised by their pyvenv.cfg.
+DEFAULT_EXCLUDES = (
+    '.git/', '.hg/', '.svn/', 'node_modules/', '__pycache__/', '.mypy_cache/',
+    '.pytest_cache/', '.ruff_cache/', '.tox/', '.nox/', '.venv/', 'venv/', '*.egg-info/',
+)
+
+DEFAULT_INCLUDES = ('*.py',)
+
+def translate_pattern(pattern):
+    # Translate one .gitignore glob into a regular expression: `*` and `?`
+    # stop at slashes while `**` crosses them
+    i, n = 0, len(pattern)
+    regex = ''
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            body = pattern[i + 1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            regex += '[' + body.replace('\\', '\\\\') + ']'
+            i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+def compile_rules(patterns, base=''):
+    # Compile .gitignore-style lines into (regex, negated, directory_only)
+    # rules. Patterns containing a slash are anchored to `base`, the others
+    # match a name at any depth below it.
+    rules = []
+    prefix = re.escape(base + '/') if base else ''
+    for pattern in patterns:
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith('#'):
+            continue
+        negated = pattern.startswith('!')
+        if negated:
+            pattern = pattern[1:]
+        directory_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if '/' in pattern:
+            regex = prefix + translate_pattern(pattern.lstrip('/'))
+        else:
+            regex = prefix + '(?:.*/)?' + translate_pattern(pattern)
+        rules.append((re.compile(regex + '$'), negated, directory_only))
+    return tuple(rules)
+
+def is_ignored(rules, relative_path, is_dir):
+    # The last matching rule wins, so a later `!pattern` re-includes a path
+    ignored = False
+    for regex, negated, directory_only in rules:
+        if directory_only and not is_dir:
+            continue
+        if regex.match(relative_path):
+            ignored = not negated
+    return ignored
+
+def read_ignore_file(path):
+    try:
+        with open(path, 'r') as file:
+            return file.read().splitlines()
+    except OSError:
+        return []
+
+def walk_source_tree(src_dir, include=DEFAULT_INCLUDES, exclude=(), use_gitignore=True, skip_dirs=(), start=''):
+    # Walk the tree with os.scandir, pruning ignored directories before they
+    # are entered, and stream (relative path, absolute path, is_dir) tuples
+    # for every directory entered and every included file, in a
+    # deterministic order. With `start`, only the subdirectory at that
+    # relative path is walked, under the rules of the directories above it.
+    include_rules = compile_rules(include)
+    rules = directory_rules(src_dir, start, exclude, use_gitignore, skip_dirs)
+    if rules is None:
+        return
+    skip_dirs = {os.path.abspath(path) for path in skip_dirs}
+    stack = [(os.path.join(os.path.abspath(src_dir), start) if start else os.path.abspath(src_dir), start, rules)]
+
+    while stack:
+        directory, relative_dir, rules = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+
+        names = {entry.name for entry in entries}
+        if relative_dir and 'pyvenv.cfg' in names:
+            continue  # A virtualenv that does not use one of the usual names
+        yield relative_dir, directory, True
+        if use_gitignore and '.gitignore' in names:
+            rules = rules + compile_rules(read_ignore_file(os.path.join(directory, '.gitignore')), relative_dir)
+
+        subdirectories = []
+        for entry in entries:
+            relative_path = relative_dir + '/' + entry.name if relative_dir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in skip_dirs and not is_ignored(rules, relative_path, True):
+                    subdirectories.append((entry.path, relative_path, rules))
+            elif entry.is_file() and is_ignored(include_rules, relative_path, False):
+                if not is_ignored(rules, relative_path, False):
+                    yield relative_path, entry.path, False
+
+        # Reversed so that subdirectories are popped in sorted order
+        stack.extend(reversed(subdirectories))
+
+def iter_source_files(src_dir, include=DEFAULT_INCLUDES, exclude=(), use_gitignore=True, skip_dirs=(), start=''):
+    # Stream (relative path, absolute path) pairs of the files to stub
+    for relative_path, path, is_dir in walk_source_tree(src_dir, include, exclude, use_gitignore, skip_dirs, start):
+        if not is_dir:
+            yield relative_path, path
+
+def directory_rules(src_dir, relative_dir, exclude=(), use_gitignore=True, skip_dirs=()):
+    # The rules walk_source_tree() applies to a directory when it enters it
+    # (its own .gitignore aside), gathered from every directory on the way
+    # down to it, or None if the walk would not enter it
+    skip_dirs = {os.path.abspath(path) for path in skip_dirs}
+    rules = compile_rules(DEFAULT_EXCLUDES) + compile_rules(exclude)
+    directory = os.path.abspath(src_dir)
+    current = ''
+    for part in relative_dir.split('/') if relative_dir else ():
+        if use_gitignore:
+            rules = rules + compile_rules(read_ignore_file(os.path.join(directory, '.gitignore')), current)
+        current = current + '/' + part if current else part
+        directory = os.path.join(directory, part)
+        if directory in skip_dirs or is_ignored(rules, current, True):
+            return None
+        if os.path.exists(os.path.join(directory, 'pyvenv.cfg')):
+            return None
+    return rules
+
+def is_source_file(src_dir, relative_file, include=DEFAULT_INCLUDES, exclude=(), use_gitignore=True, skip_dirs=()):
+    # Decide for a single path what walk_source_tree() would decide, by
+    # applying the rules of every directory on the way down to it
+    if not is_ignored(compile_rules(include), relative_file, False):
+        return False
+    relative_dir = relative_file.rpartition('/')[0]
+    rules = directory_rules(src_dir, relative_dir, exclude, use_gitignore, skip_dirs)
+    if rules is None:
+        return False
+    if use_gitignore:
+        rules = rules + compile_rules(read_ignore_file(os.path.join(src_dir, relative_dir, '.gitignore')), relative_dir)
+    return not is_ignored(rules, relative_file, False)
+
+def file_hash(path):
+    # Hash the raw bytes so that the manifest does not depend on the encoding
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def generator_signature(emitter='fast', bytecode='none', output_format='tree', stub_mode='pass'):
+    # Everything besides the source file that determines the stub output
+    return {'version': GENERATOR_VERSION, 'emitter': emitter, 'bytecode': bytecode, 'output_format': output_format,
+            'stub_mode': stub_mode}
+
+def load_manifest(dst_dir, **stub_options):
+    manifest_path = os.path.join(dst_dir, MANIFEST_NAME)
+    try:
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    files = manifest.get('files', {})
+    # A manifest written by another generator version or with other stub
+    # options describes stale stubs: their hashes are dropped so that every
+    # stub is regenerated, but the files are kept so that the stubs of
+    # deleted sources are still pruned
+    if manifest.get('generator') != generator_signature(**stub_options):
+        return {relative_file: {} for relative_file in files}
+    return files
+
+def save_manifest(dst_dir, entries, **stub_options):
+    manifest_path = os.path.join(dst_dir, MANIFEST_NAME)
+    manifest = {'generator': generator_signature(**stub_options), 'files': entries}
+
+    # Write to a temporary file first so an interrupted run never leaves a
+    # truncated manifest behind
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+def remove_stub_file(dst_dir, relative_file):
+    dst_file = os.path.join(dst_dir, relative_file)
+    for path in (dst_file, cache_from_source(dst_file)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    try:
+        os.rmdir(os.path.dirname(cache_from_source(dst_file)))
+    except OSError:
+        pass
+
+    # Drop directories that no longer contain any stubs, up to the root
+    parent = os.path.dirname(dst_file)
+    while os.path.abspath(parent) != os.path.abspath(dst_dir):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+def cache_from_source(path):
+    # Same as importlib.util.cache_from_source, without importing importlib.util
+    # on the no-op path
+    head, tail = os.path.split(path)
+    return os.path.join(head, '__pycache__', f'{tail[:-3]}.{sys.implementation.cache_tag}.pyc')
+
+def open_pack(dst_dir):
+    # The pack written by the previous run, or an empty container
+    from stub_pack import StubPack
+
+    try:
+        return StubPack(os.path.join(dst_dir, PACK_NAME))
+    except (OSError, ValueError):
+        return ()
+
+def write_pack(dst_dir, entries, results, old_pack):
+    # Stream freshly generated stubs into a new pack as the results pass
+    # through, then copy the unchanged ones over from the previous pack
+    from stub_pack import PackWriter, module_name
+
+    pack_path = os.path.join(dst_dir, PACK_NAME)
+    regenerated = set()
+    with PackWriter(pack_path + '.tmp') as writer:
+        for result in results:
+            relative_file, error, data, _ = result
+            if error is None:
+                writer.add(relative_file, *data)
+                regenerated.add(relative_file)
+            yield result
+
+        for relative_file in sorted(entries.keys() - regenerated):
+            found = old_pack.lookup(module_name(relative_file)[0]) if old_pack else None
+            if found is not None:
+                writer.add(relative_file, found[1], found[2] if old_pack.code_usable else b'')
+            del found  # Release the views into the old map before closing it
+    if old_pack:
+        old_pack.close()
+    os.replace(pack_path + '.tmp', pack_path)
+
+def update_outputs(dst_dir, entries, changed, output_format='tree', bytecode='none', **stub_options):
+    # The finder prefers a pack over a bundle over the tree, so outputs of
+    # another format left behind by earlier runs are removed before they can
+    # go stale
+    bundle_path = os.path.join(dst_dir, BUNDLE_NAME)
+    pack_path = os.path.join(dst_dir, PACK_NAME)
+    if output_format != 'pack' and os.path.exists(pack_path):
+        os.remove(pack_path)
+    if output_format != 'tree' or bytecode != 'zip':
+        if os.path.exists(bundle_path):
+            os.remove(bundle_path)
+        return
+    if not changed and os.path.exists(bundle_path):
+        return
+
+    import zipfile
+
+    # Rebuild the zipped bundle from the .pyc files next to the stubs, stored
+    # rather than deflated so that importing does not pay for decompression
+    tmp_path = bundle_path + '.tmp'
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as bundle:
+        for relative_file in sorted(entries):
+            pyc_file = cache_from_source(os.path.join(dst_dir, relative_file))
+            try:
+                bundle.write(pyc_file, relative_file[:-len('.py')] + '.pyc')
+            except FileNotFoundError:
+                pass
+    os.replace(tmp_path, bundle_path)
+
+def create_stub_chunk(chunk, stub_options):
+    # Worker entry point: stub a batch of files and report failures per file
+    # instead of letting one bad file abort the whole run. Packed stubs are
+    # sent back to the parent process, which owns the pack being written.
+    stub_options = dict(stub_options)
+    output_format = stub_options.pop('output_format', 'tree')
+    results = []
+    for relative_file, src_file, dst_file in chunk:
+        try:
+            if output_format == 'pack':
+                data, imports = generate_stub_data(src_file, dst_file, relative_file=relative_file, **stub_options)
+            else:
+                imports = create_stub_file(src_file, dst_file, relative_file=relative_file, **stub_options)
+                data = None
+        except Exception as e:
+            results.append((relative_file, f'{type(e).__name__}: {e}', None, None))
+        else:
+            results.append((relative_file, None, data, imports))
+    return results
+
+def iter_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def run_stub_jobs(work, jobs=1, chunk_size=64, task=create_stub_chunk, **stub_options):
+    if jobs <= 1:
+        for chunk in iter_chunks(work, chunk_size):
+            yield from task(chunk, stub_options)
+        return
+
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Keep only a few chunks per worker in flight so that memory stays
+    # bounded no matter how many files the walk produces. Results are
+    # yielded in submission order, as with a single job, so that outputs
+    # built from them (the pack) do not depend on worker timing.
+    max_pending = jobs * 2
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for chunk in iter_chunks(work, chunk_size):
+            pending.append(executor.submit(task, chunk, stub_options))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def collect_results(results, entries, stats, graph=None):
+    for relative_file, error, _, imports in results:
+        if error is None:
+            stats['regenerated'] += 1
+            # The stub was generated from the same parse, keep the import
+            # graph current for free
+            if graph is not None:
+                graph[relative_file] = dict(entries[relative_file], imports=imports)
+        else:
+            # Leave the file out of the manifest so the next run retries it
+            del entries[relative_file]
+            stats['errors'].append((relative_file, error))
+    stats['errors'].sort()
+
+def check_stale(relative_file, src_file, stub_exists, previous, entries):
+    # Record the current state of a source file in `entries` and tell
+    # whether its stub has to be regenerated
+    st = os.stat(src_file)
+    entry = previous.get(relative_file)
+
+    # Same size and mtime as last time: trust the recorded hash without
+    # reading the file again
+    if entry and stub_exists and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+        entries[relative_file] = entry
+        return False
+
+    digest = file_hash(src_file)
+    entries[relative_file] = {'hash': digest, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    # Touched but not modified
+    return not (entry and stub_exists and entry['hash'] == digest)
+
+def stub_path(dst_dir, relative_file, output_format='tree'):
+    # Where a stub lives; inside a pack this is the virtual path used for
+    # __file__ and tracebacks
+    if output_format == 'pack':
+        return os.path.join(dst_dir, PACK_NAME, relative_file)
+    return os.path.join(dst_dir, relative_file)
+
+def select_reachable_files(source_files, graph, roots, jobs=1, chunk_size=64):
+    # Bring the import graph up to date for every source file, parsing only
+    # the files that changed since it was cached, and keep the source files
+    # reachable from the roots
+    source_files = list(source_files)
+    states = {}
+    work = []
+    for relative_file, src_file in source_files:
+        if check_stale(relative_file, src_file, relative_file in graph, graph, states):
+            work.append((relative_file, src_file, None))
+        else:
+            states[relative_file] = dict(states[relative_file], imports=graph[relative_file]['imports'])
+
+    from import_graph import reachable_files, scan_imports_chunk
+
+    for relative_file, _, _, imports in run_stub_jobs(work, jobs, chunk_size, task=scan_imports_chunk):
+        states[relative_file]['imports'] = imports
+    graph.clear()
+    graph.update(states)
+
+    reachable = reachable_files(graph, roots)
+    return [(relative_file, src_file) for relative_file, src_file in source_files if relative_file in reachable]
+
+def replicate_directory_structure(src_dir, dst_dir, jobs=1, chunk_size=64, include=DEFAULT_INCLUDES,
+                                  exclude=(), use_gitignore=True, roots=None, **stub_options):
+    from import_graph import load_import_graph, save_import_graph
+
+    previous = load_manifest(dst_dir, **stub_options)
+    graph = load_import_graph(dst_dir)
+    graph_before = dict(graph)
+    entries = {}
+    seen = set()
+    stats = {'regenerated': 0, 'skipped': 0, 'removed': 0, 'errors': []}
+    packed = stub_options.get('output_format') == 'pack'
+
+    # Never stub the doppelgänger repository itself if it lives inside the
+    # main repository
+    source_files = iter_source_files(src_dir, include, exclude, use_gitignore, skip_dirs=[dst_dir])
+    if roots:
+        # Stubs outside the import closure of the roots are pruned below
+        source_files = select_reachable_files(source_files, graph, roots, jobs, chunk_size)
+    old_pack = open_pack(dst_dir) if packed else None
+
+    def iter_stale_files():
+        for relative_file, src_file in source_files:
+            dst_file = stub_path(dst_dir, relative_file, stub_options.get('output_format', 'tree'))
+            seen.add(relative_file)
+            stub_exists = relative_file in old_pack if packed else os.path.exists(dst_file)
+            if check_stale(relative_file, src_file, stub_exists, previous, entries):
+                yield relative_file, src_file, dst_file
+            else:
+                stats['skipped'] += 1
+
+    results = run_stub_jobs(iter_stale_files(), jobs, chunk_size, **stub_options)
+    if packed:
+        results = write_pack(dst_dir, entries, results, old_pack)
+    collect_results(results, entries, stats, graph)
+
+    # Prune stubs whose sources were deleted since the previous run; a
+    # pack simply does not copy them over
+    for relative_file in previous.keys() - seen:
+        if not packed:
+            remove_stub_file(dst_dir, relative_file)
+        stats['removed'] += 1
+
+    if not roots:
+        for relative_file in graph.keys() - seen:
+            del graph[relative_file]
+    if graph != graph_before:
+        save_import_graph(dst_dir, graph)
+    save_manifest(dst_dir, entries, **stub_options)
+    update_outputs(dst_dir, entries, stats['regenerated'] or stats['removed'], **stub_options)
+    return stats
+
+def sync_stub_files(src_dir, dst_dir, relative_paths, entries, include=DEFAULT_INCLUDES,
+                    exclude=(), use_gitignore=True, **stub_options):
+    # Bring the stubs of the given paths up to date, updating the manifest
+    # `entries` in place and the bundle or pack if there is one. A path
+    # ending with a slash stands for everything below that directory.
+    stats = {'regenerated': 0, 'skipped': 0, 'removed': 0, 'errors': []}
+    packed = stub_options.get('output_format') == 'pack'
+    relative_files = set()
+    for relative_path in relative_paths:
+        if not relative_path.endswith('/'):
+            relative_files.add(relative_path)
+            continue
+        relative_files.update(key for key in entries if key.startswith(relative_path))
+        if os.path.isdir(os.path.join(src_dir, relative_path)):
+            for relative_file, _ in iter_source_files(src_dir, include, exclude, use_gitignore, skip_dirs=[dst_dir],
+                                                      start=relative_path.rstrip('/')):
+                relative_files.add(relative_file)
+
+    old_pack = open_pack(dst_dir) if packed else None
+    work = []
+    for relative_file in sorted(relative_files):
+        src_file = os.path.join(src_dir, relative_file)
+        dst_file = stub_path(dst_dir, relative_file, stub_options.get('output_format', 'tree'))
+        if os.path.isfile(src_file) and is_source_file(src_dir, relative_file, include, exclude, use_gitignore, skip_dirs=[dst_dir]):
+            stub_exists = relative_file in old_pack if packed else os.path.exists(dst_file)
+            if check_stale(relative_file, src_file, stub_exists, entries, entries):
+                work.append((relative_file, src_file, dst_file))
+            else:
+                stats['skipped'] += 1
+        elif relative_file in entries:
+            if not packed:
+                remove_stub_file(dst_dir, relative_file)
+            del entries[relative_file]
+            stats['removed'] += 1
+
+    results = run_stub_jobs(work, **stub_options)
+    if packed:
+        if not work and not stats['removed']:
+            if old_pack:
+                old_pack.close()
+            return stats
+        results = write_pack(dst_dir, entries, results, old_pack)
+    collect_results(results, entries, stats)
+    if stats['regenerated'] or stats['removed']:
+        update_outputs(dst_dir, entries, True, **stub_options)
+    return stats
+
+def create_stub_file(src_file, dst_file, emitter='fast', bytecode='none', stub_mode='pass', relative_file=None):
+    # Returns the modules imported by the source file, for the import graph
+    stub_code, imports = read_stub_source(src_file, relative_file, emitter, stub_mode)
+
+    # Write the stub code to the destination file. Only directories that
+    # actually receive a stub are created, when the first write into them
+    # fails, so that the tree may be removed between runs without a stale
+    # record of what exists
+    try:
+        file = open(dst_file, 'w')
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+        file = open(dst_file, 'w')
+    with file:
+        file.write(stub_code)
+
+    if bytecode == 'none':
+        # An unchecked .pyc from an earlier run would shadow the new stub
+        try:
+            os.remove(cache_from_source(dst_file))
+        except FileNotFoundError:
+            pass
+    else:
+        import py_compile
+
+        # The manifest already regenerates the .pyc whenever the stub
+        # changes, so the import system need not check the source again
+        py_compile.compile(dst_file, cfile=cache_from_source(dst_file), doraise=True,
+                           invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+    return imports
+
+def generate_stub_data(src_file, origin, emitter='fast', bytecode='none', stub_mode='pass', relative_file=None):
+    # The (source, marshalled code) pair stored for a stub in a pack, and the
+    # modules imported by the source file
+    import marshal
+
+    stub_code, imports = read_stub_source(src_file, relative_file, emitter, stub_mode)
+    code = b''
+    if bytecode != 'none':
+        code = marshal.dumps(compile(stub_code, origin, 'exec', dont_inherit=True))
+    return (stub_code.encode(), code), imports
+
+def read_stub_source(src_file, relative_file=None, emitter='fast', stub_mode='pass'):
+    # Parse a source file once for both its stub and its imports
+    import ast
+    from import_graph import scan_imports
 
-def create_stub_file(src_file, dst_file):
     with open(src_file, 'r') as file:
-        source_code = file.read()
+        tree = ast.parse(file.read())
+    imports = scan_imports(tree, relative_file)
+    return generate_stub_tree_source(tree, emitter, stub_mode), imports
+
+def generate_stub_source(source_code, emitter='fast', stub_mode='pass'):
+    import ast
 
     # Parse the source code into an AST
     tree = ast.parse(source_code)
+    return generate_stub_tree_source(tree, emitter, stub_mode)
+
+def generate_stub_tree_source(tree, emitter='fast', stub_mode='pass'):
+    import ast
+
+    if stub_mode == 'typed':
+        from typed_stubs import generate_typed_stub
+
+        return emit_stub_source(generate_typed_stub(tree), emitter)
 
     # Visit each node and create stubs
     class StubGenerator(ast.NodeTransformer):
@@ -62,27 +642,259 @@ def create_stub_file(src_file, dst_file):
             return node
 
     transformed_tree = StubGenerator().visit(tree)
-    stub_code = astunparse.unparse(transformed_tree)
-    formatted_stub_code = black.format_str(stub_code, mode=black.FileMode())
+    return emit_stub_source(transformed_tree, emitter)
+
+def emit_stub_source(transformed_tree, emitter='fast'):
+    import ast
+
+    if emitter == 'black':
+        import astunparse
+        import black
 
-    # Write the formatted stub code to the destination file
-    with open(dst_file, 'w') as file:
-        file.write(formatted_stub_code)
+        stub_code = astunparse.unparse(transformed_tree)
+        return black.format_str(stub_code, mode=black.FileMode())
 
-def create_doppelganger_repo(main_repo, doppelganger_repo):
+    # ast.unparse output is not black-formatted, but it is valid, importable
+    # Python; only the trailing newline is missing
+    return ast.unparse(transformed_tree) + '\n'
+
+def create_doppelganger_repo(main_repo, doppelganger_repo, jobs=1, chunk_size=64, include=DEFAULT_INCLUDES,
+                             exclude=(), use_gitignore=True, roots=None, **stub_options):
     # Create the sibling repository directory
     os.makedirs(doppelganger_repo, exist_ok=True)
     # Replicate the directory structure and create stubs
-    replicate_directory_structure(main_repo, doppelganger_repo)
+    return replicate_directory_structure(main_repo, doppelganger_repo, jobs=jobs, chunk_size=chunk_size, include=include,
+                                         exclude=exclude, use_gitignore=use_gitignore, roots=roots, **stub_options)
+
+def format_stats(stats, elapsed=None):
+    suffix = f" in {elapsed * 1000:.0f}ms" if elapsed is not None else ''
+    return f"Regenerated {stats['regenerated']}, skipped {stats['skipped']}, removed {stats['removed']} stub files{suffix}."
 
 def main():
     parser = argparse.ArgumentParser(description="Create a doppelgänger repository with stubs for a main repository.")
     parser.add_argument("main_repo", help="Path to the main repository")
     parser.add_argument("doppelganger_repo", help="Path to the doppelgänger repository")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes generating stubs (0 uses every CPU)")
+    parser.add_argument("--chunk-size", type=int, default=64, help="Number of files handed to a worker at a time")
+    parser.add_argument("--emitter", choices=EMITTERS, default='fast', help="Write stubs with the stdlib ast module (fast) or astunparse + black (black)")
+    parser.add_argument("--stub-mode", choices=STUB_MODES, default='pass', help="Replace function bodies with pass (pass) or return defaults inferred from annotations and drop module-level work (typed)")
+    parser.add_argument("--bytecode", choices=BYTECODE_MODES, default='none', help="Precompile the stubs into __pycache__ (pycache) and also bundle them into stubs.zip (zip); packs store the bytecode inline")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default='tree', help="Write one stub file per module (tree) or a single stubs.pack archive (pack)")
+    parser.add_argument("--include", action='append', metavar="GLOB", help="Only stub files matching this glob (repeatable, default: *.py)")
+    parser.add_argument("--exclude", action='append', default=[], metavar="GLOB", help=".gitignore-style pattern of paths to skip (repeatable)")
+    parser.add_argument("--no-gitignore", action='store_true', help="Do not honour .gitignore files found in the main repository")
+    parser.add_argument("--roots", action='append', metavar="MODULE", help="Only stub the modules transitively imported by these modules or files (repeatable, comma-separated)")
+    parser.add_argument("--watch", action='store_true', help="After the initial build, keep the stubs in sync with the main repository")
+    parser.add_argument("--watch-backend", choices=('auto', 'inotify', 'poll'), default='auto', help="How --watch detects changes (auto prefers inotify)")
+    parser.add_argument("--poll-interval", type=float, default=0.25, help="Seconds between two scans of the poll backend")
+    parser.add_argument("--debounce", type=float, default=0.05, help="Seconds of quiet to wait for before syncing a burst of changes")
 
     args = parser.parse_args()
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    include = args.include or DEFAULT_INCLUDES
+    stub_options = {'emitter': args.emitter, 'bytecode': args.bytecode, 'output_format': args.output_format,
+                    'stub_mode': args.stub_mode}
+    roots = [root for value in args.roots or () for root in value.split(',') if root] or None
+
+    if args.watch:
+        from doppelganger_watch import watch_doppelganger_repo
+
+        watch_doppelganger_repo(args.main_repo, args.doppelganger_repo, backend=args.watch_backend,
+                                poll_interval=args.poll_interval, debounce=args.debounce, jobs=jobs,
+                                chunk_size=args.chunk_size, include=include, exclude=args.exclude,
+                                use_gitignore=not args.no_gitignore, roots=roots, **stub_options)
+        return
+
+    try:
+        stats = create_doppelganger_repo(args.main_repo, args.doppelganger_repo, jobs=jobs, chunk_size=args.chunk_size, include=include,
+                                         exclude=args.exclude, use_gitignore=not args.no_gitignore, roots=roots, **stub_options)
+    except ValueError as e:
+        parser.error(str(e))
+    print(format_stats(stats))
+    for relative_file, error in stats['errors']:
+        print(f"Failed to stub {relative_file}: {error}", file=sys.stderr)
+    if stats['errors']:
+        sys.exit(1)
+
+class CreateDoppelgangerRepoTests:
+    # Run with `python -m unittest create_doppelganger_repo`. load_tests()
+    # makes a unittest.TestCase of these, so that importing this module (and
+    # the no-op runs the lazy imports above are for) never imports unittest.
+    def setUp(self):
+        import tempfile
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.src = os.path.join(tmp.name, 'src')
+        self.dst = os.path.join(tmp.name, 'dst')
+        os.makedirs(self.src)
+
+    def write(self, relative_file, source=''):
+        path = os.path.join(self.src, relative_file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(source)
+        return path
+
+    def build(self, **options):
+        # (regenerated, skipped, removed) of a run, the stats are kept
+        self.stats = create_doppelganger_repo(self.src, self.dst, **options)
+        return self.stats['regenerated'], self.stats['skipped'], self.stats['removed']
+
+    def test_manifest_skips_unchanged_files_and_prunes_deleted_ones(self):
+        app = self.write('app.py', 'def f():\n    return 1\n')
+        self.write('pkg/__init__.py')
+        self.write('other.py', 'X = 1\n')
+        self.assertEqual(self.build(), (3, 0, 0))
+        self.assertEqual(self.build(), (0, 3, 0))
+
+        # Touched without changes: hashed again, not regenerated
+        st = os.stat(app)
+        os.utime(app, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertEqual(self.build(), (0, 3, 0))
+
+        self.write('app.py', 'def f():\n    return 2\n')
+        self.assertEqual(self.build(), (1, 2, 0))
+        os.remove(os.path.join(self.dst, 'other.py'))
+        self.assertEqual(self.build(), (1, 2, 0))
+
+        os.remove(os.path.join(self.src, 'other.py'))
+        self.assertEqual(self.build(), (0, 2, 1))
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'other.py')))
+        self.assertEqual(sorted(load_manifest(self.dst)), ['app.py', 'pkg/__init__.py'])
+
+    def test_changed_stub_options_regenerate_and_still_prune(self):
+        self.write('app.py', 'def f() -> int:\n    return 1\n')
+        self.write('other.py', 'X = 1\n')
+        self.build(bytecode='pycache')
+        other_pyc = cache_from_source(os.path.join(self.dst, 'other.py'))
+        self.assertTrue(os.path.exists(other_pyc))
+
+        os.remove(os.path.join(self.src, 'other.py'))
+        self.assertEqual(self.build(stub_mode='typed', bytecode='pycache'), (1, 0, 1))
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'other.py')))
+        self.assertFalse(os.path.exists(other_pyc))
+        with open(os.path.join(self.dst, 'app.py')) as file:
+            self.assertIn('return 0', file.read())
+
+        # A manifest that cannot be read only costs a full rebuild
+        with open(os.path.join(self.dst, MANIFEST_NAME), 'w') as file:
+            file.write('{"files": ')
+        self.assertEqual(self.build(stub_mode='typed', bytecode='pycache'), (1, 0, 0))
+
+    def read_stubs(self):
+        stubs = {}
+        for relative_file, path in iter_source_files(self.dst):
+            with open(path) as file:
+                stubs[relative_file] = file.read()
+        return stubs
+
+    def test_jobs_produce_the_same_stubs_and_report_errors_per_file(self):
+        import shutil
+
+        for i in range(6):
+            self.write(f'pkg/mod{i}.py', f'def f{i}(x):\n    return x * {i}\n')
+        self.write('pkg/broken.py', 'def f(:\n')
+        self.assertEqual(self.build(), (6, 0, 0))
+        serial = self.read_stubs()
+        shutil.rmtree(self.dst)
+        self.assertEqual(self.build(jobs=2, chunk_size=1), (6, 0, 0))
+        self.assertEqual(self.read_stubs(), serial)
+        self.assertEqual([relative_file for relative_file, _ in self.stats['errors']], ['pkg/broken.py'])
+
+        # The failed file stays out of the manifest and is retried
+        self.write('pkg/broken.py', 'def f():\n    pass\n')
+        self.assertEqual(self.build(jobs=2, chunk_size=1), (1, 6, 0))
+
+        # Results come back in submission order whatever the worker timing
+        work = [(relative_file, path, None) for relative_file, path in iter_source_files(self.src)]
+        results = run_stub_jobs(work, jobs=2, chunk_size=1, task=scan_chunk_for_test)
+        self.assertEqual([result[0] for result in results], [relative_file for relative_file, _, _ in work])
+
+    STUBBED_SOURCE = 'import os\n"""Doc."""\nX = {1: 2}\n\nclass A:\n    def f(self, x=1):\n        return x\n\nasync def g():\n    await h()\n'
+
+    def test_fast_emitter(self):
+        self.assertEqual(generate_stub_source(self.STUBBED_SOURCE),
+                         'import os\nX = {1: 2}\n\nclass A:\n\n    def f(self, x=1):\n        pass\n\nasync def g():\n    pass\n')
+
+    def test_black_emitter_writes_the_same_stubs(self):
+        import ast
+
+        try:
+            stub = generate_stub_source(self.STUBBED_SOURCE, emitter='black')
+        except ImportError as e:
+            self.skipTest(f'The black emitter needs {e.name}')
+        self.assertEqual(ast.dump(ast.parse(stub)), ast.dump(ast.parse(generate_stub_source(self.STUBBED_SOURCE))))
+        self.assertIn('\n\n\nclass A:\n', stub)
+
+    def test_gitignore_rules_and_walker(self):
+        self.write('.gitignore', 'build/\n*.gen.py\n!keep.gen.py\n/top_only.py\ndocs/**/conf.py\ntmp[0-9].py\n')
+        self.write('sub/.gitignore', 'local.py\n')
+        expected = ['app.py', 'build.py', 'docs/a/other.py', 'keep.gen.py', 'local.py', 'sub/top_only.py', 'tmpx.py']
+        ignored = [
+            'top_only.py', 'a.gen.py', 'build/x.py', 'node_modules/pkg/x.py', 'env/lib.py', 'docs/conf.py',
+            'docs/a/b/conf.py', 'sub/local.py', 'tmp1.py', 'vendored/x.py', 'data.txt',
+        ]
+        for relative_file in expected + ignored:
+            self.write(relative_file)
+        self.write('env/pyvenv.cfg')
+
+        exclude = ['vendored/']
+        walked = [relative_file for relative_file, _ in iter_source_files(self.src, exclude=exclude)]
+        self.assertEqual(sorted(walked), expected)
+        for relative_file in expected + ignored:
+            with self.subTest(relative_file=relative_file):
+                self.assertEqual(is_source_file(self.src, relative_file, exclude=exclude), relative_file in expected)
+
+        self.assertIsNone(directory_rules(self.src, 'build'))
+        self.assertIsNone(directory_rules(self.src, 'node_modules/pkg'))
+        self.assertIsNone(directory_rules(self.src, 'env'))
+        self.assertEqual([relative_file for relative_file, _ in iter_source_files(self.src, start='sub')], ['sub/top_only.py'])
+        self.assertEqual(list(walk_source_tree(self.src, start='build/deep')), [])
+
+        # Without .gitignore files only the default excludes apply
+        walked = [relative_file for relative_file, _ in iter_source_files(self.src, use_gitignore=False)]
+        self.assertIn('build/x.py', walked)
+        self.assertNotIn('node_modules/pkg/x.py', walked)
+
+    def test_bytecode_follows_the_stubs(self):
+        import zipfile
+
+        app = self.write('pkg/app.py', 'def f():\n    return 1\n')
+        self.build(bytecode='pycache')
+        pyc = cache_from_source(os.path.join(self.dst, 'pkg', 'app.py'))
+        with open(pyc, 'rb') as file:
+            header = file.read(16)
+        # Hash-based and unchecked: importing never reads the stub source
+        self.assertEqual(int.from_bytes(header[4:8], 'little'), 0b01)
+
+        self.write('pkg/app.py', 'def f(x):\n    return x\n')
+        self.assertEqual(self.build(bytecode='pycache'), (1, 0, 0))
+        with open(pyc, 'rb') as file:
+            self.assertNotEqual(file.read(16), header)
+
+        self.build(bytecode='zip')
+        with zipfile.ZipFile(os.path.join(self.dst, BUNDLE_NAME)) as bundle:
+            self.assertEqual(bundle.namelist(), ['pkg/app.pyc'])
+
+        # Back to plain stubs: neither the bundle nor a stale .pyc may shadow them
+        os.remove(app)
+        self.write('pkg/app.py', 'def g():\n    return 1\n')
+        self.assertEqual(self.build(), (1, 0, 0))
+        self.assertFalse(os.path.exists(os.path.join(self.dst, BUNDLE_NAME)))
+        self.assertFalse(os.path.exists(pyc))
+
+def scan_chunk_for_test(chunk, stub_options):
+    # A task for run_stub_jobs() that finishes its first chunks last
+    import time
+
+    time.sleep(0.05 if chunk[0][0].endswith(('0.py', '1.py')) else 0)
+    return [(relative_file, None, None, []) for relative_file, _, _ in chunk]
+
+def load_tests(loader, tests, pattern):
+    import unittest
 
-    create_doppelganger_repo(args.main_repo, args.doppelganger_repo)
+    return loader.loadTestsFromTestCase(type('TestCreateDoppelgangerRepo', (CreateDoppelgangerRepoTests, unittest.TestCase), {}))
 
 if __name__ == '__main__':
     main()
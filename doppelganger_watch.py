@@ -0,0 +1,308 @@
+import os
+import select
+import struct
+import sys
+import time
+
+from create_doppelganger_repo import (
+    DEFAULT_INCLUDES, create_doppelganger_repo, format_stats, iter_source_files, load_manifest,
+    save_manifest, sync_stub_files, walk_source_tree,
+)
+
+# Event bits from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# Every watcher's wait(timeout=None) blocks until something changed or the
+# timeout expired, and returns the set of relative paths that changed. A path
+# ending with a slash stands for a whole directory, and None means the
+# watcher lost track of the tree and everything has to be rescanned.
+
+class PollingWatcher:
+    # Portable backend comparing (mtime, size) snapshots of the source files
+    def __init__(self, src_dir, dst_dir, include=DEFAULT_INCLUDES, exclude=(), use_gitignore=True, interval=0.25):
+        self.src_dir = src_dir
+        self.dst_dir = dst_dir
+        self.include = include
+        self.exclude = exclude
+        self.use_gitignore = use_gitignore
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        snapshot = {}
+        source_files = iter_source_files(self.src_dir, self.include, self.exclude, self.use_gitignore, skip_dirs=[self.dst_dir])
+        for relative_file, path in source_files:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # Deleted while walking
+            snapshot[relative_file] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval if deadline is None else min(self.interval, max(0.0, deadline - time.monotonic()))
+            time.sleep(delay)
+            snapshot = self.take_snapshot()
+            changed = {
+                relative_file for relative_file in snapshot.keys() | self.snapshot.keys()
+                if snapshot.get(relative_file) != self.snapshot.get(relative_file)
+            }
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    # Linux backend: one inotify watch per directory the walker enters, so
+    # that only the directories holding changed files report anything
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self, src_dir, dst_dir, include=DEFAULT_INCLUDES, exclude=(), use_gitignore=True):
+        import ctypes
+        import ctypes.util
+
+        self.src_dir = src_dir
+        self.dst_dir = dst_dir
+        self.include = include
+        self.exclude = exclude
+        self.use_gitignore = use_gitignore
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.get_errno = ctypes.get_errno
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = self.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {}  # Watch descriptor -> relative directory
+        self.add_tree('')
+
+    def add_tree(self, relative_dir):
+        # A new directory is walked under the rules of the directories above
+        # it, so that ignored trees (node_modules, build output) get no watch
+        source_tree = walk_source_tree(self.src_dir, self.include, self.exclude, self.use_gitignore, skip_dirs=[self.dst_dir],
+                                       start=relative_dir)
+        for relative_path, path, is_dir in source_tree:
+            if not is_dir:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+            if wd < 0:
+                errno = self.get_errno()
+                raise OSError(errno, f"Cannot watch {path}: {os.strerror(errno)} (see fs.inotify.max_user_watches)")
+            self.watches[wd] = relative_path
+
+    def remove_tree(self, relative_dir):
+        prefix = relative_dir + '/'
+        for wd, watched in list(self.watches.items()):
+            if watched == relative_dir or watched.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self):
+        chunks = []
+        while True:
+            try:
+                chunks.append(os.read(self.fd, 1 << 16))
+            except BlockingIOError:
+                return b''.join(chunks)
+
+    def wait(self, timeout=None):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        data = self.read_events()
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                return None  # Events were dropped, only a full rescan is safe
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            relative_dir = self.watches.get(wd)
+            if relative_dir is None or not name:
+                continue
+
+            relative_path = join_relative(relative_dir, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self.remove_tree(relative_path)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(relative_path)
+                changed.add(relative_path + '/')
+            elif name == b'.gitignore':
+                # The rules for the whole directory may have changed
+                if not relative_dir:
+                    return None
+                changed.add(relative_dir + '/')
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE):
+                # IN_CREATE alone is skipped, the write that follows it
+                # reports IN_CLOSE_WRITE once the file is complete
+                changed.add(relative_path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+def join_relative(relative_dir, name):
+    return relative_dir + '/' + name if relative_dir else name
+
+def make_watcher(src_dir, dst_dir, backend='auto', poll_interval=0.25, include=DEFAULT_INCLUDES, exclude=(), use_gitignore=True):
+    if backend in ('auto', 'inotify') and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(src_dir, dst_dir, include, exclude, use_gitignore)
+        except (OSError, AttributeError):
+            if backend == 'inotify':
+                raise
+    elif backend == 'inotify':
+        raise OSError("The inotify backend is only available on Linux")
+    return PollingWatcher(src_dir, dst_dir, include, exclude, use_gitignore, poll_interval)
+
+def watch_doppelganger_repo(main_repo, doppelganger_repo, backend='auto', poll_interval=0.25, debounce=0.05,
+                            jobs=1, chunk_size=64, include=DEFAULT_INCLUDES, exclude=(), use_gitignore=True, roots=None,
+                            **stub_options):
+    # Start watching before the initial build so that edits made during it
+    # are not lost
+    watcher = make_watcher(main_repo, doppelganger_repo, backend, poll_interval, include, exclude, use_gitignore)
+    try:
+        stats = create_doppelganger_repo(main_repo, doppelganger_repo, jobs=jobs, chunk_size=chunk_size, include=include,
+                                         exclude=exclude, use_gitignore=use_gitignore, roots=roots, **stub_options)
+        report(stats)
+        entries = load_manifest(doppelganger_repo, **stub_options)
+        print(f"Watching {main_repo} with the {type(watcher).__name__}, press Ctrl+C to stop.")
+
+        while True:
+            changed = watcher.wait()
+            # Editors save in bursts (write, rename, chmod), so wait until
+            # the tree has been quiet for `debounce` seconds
+            while changed is not None:
+                more = watcher.wait(debounce)
+                if more is None:
+                    changed = None
+                elif more:
+                    changed |= more
+                else:
+                    break
+
+            start = time.perf_counter()
+            # Any edit may change the import closure of the roots, so those
+            # always go through an incremental run over the whole tree
+            if changed is None or roots:
+                stats = create_doppelganger_repo(main_repo, doppelganger_repo, jobs=jobs, chunk_size=chunk_size, include=include,
+                                                 exclude=exclude, use_gitignore=use_gitignore, roots=roots, **stub_options)
+                entries = load_manifest(doppelganger_repo, **stub_options)
+            else:
+                stats = sync_stub_files(main_repo, doppelganger_repo, changed, entries, include=include,
+                                        exclude=exclude, use_gitignore=use_gitignore, **stub_options)
+                save_manifest(doppelganger_repo, entries, **stub_options)
+            report(stats, time.perf_counter() - start)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+def report(stats, elapsed=None):
+    print(format_stats(stats, elapsed), flush=True)
+    for relative_file, error in stats['errors']:
+        print(f"Failed to stub {relative_file}: {error}", file=sys.stderr, flush=True)
+
+class WatchTests:
+    # Run with `python -m unittest doppelganger_watch`; load_tests() makes a
+    # unittest.TestCase of these without importing unittest on --watch runs
+    def setUp(self):
+        import tempfile
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.src = os.path.join(tmp.name, 'src')
+        self.dst = os.path.join(tmp.name, 'dst')
+        os.makedirs(self.src)
+        self.write('.gitignore', 'build/\n')
+        self.write('app.py', 'X = 1\n')
+
+    def write(self, relative_file, source=''):
+        path = os.path.join(self.src, relative_file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(source)
+
+    def wait_for(self, watcher, expected):
+        # Changes reported until `expected` were all seen, within a second
+        changed = set()
+        deadline = time.monotonic() + 1
+        while not expected <= changed and time.monotonic() < deadline:
+            changed |= watcher.wait(0.1)
+        return changed
+
+    def test_polling_watcher(self):
+        watcher = PollingWatcher(self.src, self.dst, interval=0.01)
+        self.write('app.py', 'X = 12\n')
+        self.write('pkg/mod.py')
+        self.write('build/gen.py')
+        self.assertEqual(self.wait_for(watcher, {'app.py', 'pkg/mod.py'}), {'app.py', 'pkg/mod.py'})
+        os.remove(os.path.join(self.src, 'app.py'))
+        self.assertEqual(self.wait_for(watcher, {'app.py'}), {'app.py'})
+        self.assertEqual(watcher.wait(0.05), set())
+
+    def test_inotify_watcher_skips_ignored_directories(self):
+        if not sys.platform.startswith('linux'):
+            self.skipTest('inotify is only available on Linux')
+        watcher = InotifyWatcher(self.src, self.dst)
+        self.addCleanup(watcher.close)
+
+        # Whole trees created at once, as npm install or a build does
+        for relative_dir in ('node_modules/lib/deep', 'build/x/y', 'pkg/sub', 'pkg/venv'):
+            os.makedirs(os.path.join(self.src, relative_dir))
+        self.write('pkg/venv/pyvenv.cfg')
+        self.write('pkg/sub/mod.py')
+        self.assertLessEqual({'pkg/', 'node_modules/', 'build/'}, self.wait_for(watcher, {'pkg/', 'node_modules/', 'build/'}))
+        self.assertEqual(sorted(watcher.watches.values()), ['', 'pkg', 'pkg/sub'])
+
+        self.write('pkg/sub/other.py')
+        self.assertIn('pkg/sub/other.py', self.wait_for(watcher, {'pkg/sub/other.py'}))
+
+    def test_sync_stub_files(self):
+        create_doppelganger_repo(self.src, self.dst)
+        entries = load_manifest(self.dst)
+        self.write('pkg/__init__.py')
+        self.write('pkg/mod.py', 'def f():\n    return 1\n')
+        self.write('build/gen.py')
+        os.remove(os.path.join(self.src, 'app.py'))
+
+        stats = sync_stub_files(self.src, self.dst, {'pkg/', 'build/', 'app.py'}, entries)
+        self.assertEqual((stats['regenerated'], stats['skipped'], stats['removed']), (2, 0, 1))
+        self.assertEqual(sorted(entries), ['pkg/__init__.py', 'pkg/mod.py'])
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'app.py')))
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'build')))
+
+        # A directory that went away takes its stubs with it
+        import shutil
+
+        shutil.rmtree(os.path.join(self.src, 'pkg'))
+        stats = sync_stub_files(self.src, self.dst, {'pkg/'}, entries)
+        self.assertEqual(stats['removed'], 2)
+        self.assertEqual(entries, {})
+
+def load_tests(loader, tests, pattern):
+    import unittest
+
+    return loader.loadTestsFromTestCase(type('TestDoppelgangerWatch', (WatchTests, unittest.TestCase), {}))
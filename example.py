@@ -1,19 +1,76 @@
 import unittest
 import logging
+import gzip
+import os
+import tempfile
 from logging.handlers import RotatingFileHandler
+from collections import OrderedDict
+from collections.abc import MutableMapping
 import json
+import functools
+import random
+import re
+import sys
+import threading
+import time
 
-def setup_logger(name, log_file, level=logging.DEBUG):
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+from log_writer import BatchingLogWriter
+
+# Request fields attached to every record logged by the handlers, for
+# formatters that emit them as structured data
+LOG_FIELDS = ("method", "path", "status", "request_size", "response_size", "latency_ms")
+
+class StructuredFormatter(logging.Formatter):
+    # One JSON object per line, with the request fields as separate keys
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "name": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+# Names of the handlers attached by setup_logger, so that calling it again
+# replaces them instead of adding duplicates
+SETUP_HANDLER_NAMES = ("setup_logger.file", "setup_logger.console", "setup_logger.writer")
+
+def setup_logger(name, log_file, level=logging.DEBUG, structured=False, async_writer=False, **writer_options):
+    # With async_writer, a BatchingLogWriter (see log_writer.py) writes to the
+    # file and stderr from a background thread; writer_options are passed to it
+    if structured:
+        formatter = StructuredFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    for handler in list(logger.handlers):
+        if handler.name in SETUP_HANDLER_NAMES:
+            logger.removeHandler(handler)
+            handler.close()
+
+    if async_writer:
+        writer_options.setdefault("stream", sys.stderr)
+        writer = BatchingLogWriter(log_file, **writer_options)
+        writer.set_name("setup_logger.writer")
+        writer.setFormatter(formatter)
+        logger.addHandler(writer)
+        return logger
 
     file_handler = RotatingFileHandler(log_file, maxBytes=10**6, backupCount=3)
+    file_handler.set_name("setup_logger.file")
     file_handler.setFormatter(formatter)
 
     console_handler = logging.StreamHandler()
+    console_handler.set_name("setup_logger.console")
     console_handler.setFormatter(formatter)
 
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
     logger.addHandler(file_handler)
     logger.addHandler(console_handler)
 
@@ -22,19 +79,168 @@ def setup_logger(name, log_file, level=logging.DEBUG):
 logger = setup_logger('http_logger', 'http_detailed_log_file.log')
 
 
+class Headers(MutableMapping):
+    # Case-insensitive header map over a plain dict of the names as they were
+    # set. Lookups with the stored case are a dict lookup, others scan the
+    # few headers a message has. A dict passed in is wrapped, not copied,
+    # like the messages used to keep it. Frozen maps can be shared between
+    # any number of messages.
+    __slots__ = ("_items", "_frozen")
+
+    def __init__(self, headers=None, frozen=False):
+        self._frozen = False
+        if type(headers) is dict:
+            self._items = headers
+        else:
+            self._items = {}
+            if headers:
+                for name, value in (headers.items() if hasattr(headers, "items") else headers):
+                    self[name] = value
+        self._frozen = frozen
+
+    def _find(self, name):
+        # The stored name matching `name` case-insensitively, or None
+        if name in self._items:
+            return name
+        lowered = name.lower()
+        for stored in self._items:
+            if stored.lower() == lowered:
+                return stored
+        return None
+
+    def __getitem__(self, name):
+        try:
+            return self._items[name]
+        except KeyError:
+            stored = self._find(name)
+            if stored is None:
+                raise
+            return self._items[stored]
+
+    def __setitem__(self, name, value):
+        if self._frozen:
+            raise TypeError("These headers are shared and cannot be modified, use a copy()")
+        stored = self._find(name)
+        if stored is not None and stored != name:
+            del self._items[stored]
+        self._items[name] = value
+
+    def __delitem__(self, name):
+        if self._frozen:
+            raise TypeError("These headers are shared and cannot be modified, use a copy()")
+        stored = self._find(name)
+        if stored is None:
+            raise KeyError(name)
+        del self._items[stored]
+
+    def __contains__(self, name):
+        return isinstance(name, str) and self._find(name) is not None
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return repr(self._items)
+
+    def copy(self):
+        return Headers(dict(self._items))
+
+# Shared by every message created without headers, instead of a new dict each
+EMPTY_HEADERS = Headers(frozen=True)
+
+# Shared by every JSON response of the handlers
+JSON_HEADERS = Headers({"Content-Type": "application/json"}, frozen=True)
+
+def make_headers(headers):
+    # Exact type checks: isinstance() against an ABC subclass is slow
+    if headers is None:
+        return EMPTY_HEADERS
+    if type(headers) is Headers:
+        return headers
+    return Headers(headers) if headers else EMPTY_HEADERS
+
+# Marks a request body whose JSON has not been parsed yet
+UNPARSED = object()
+
 class HttpRequest:
+    # The body is kept as it was received (bytes, memoryview or str), and
+    # the headers as the plain dict they were parsed into: the
+    # case-insensitive Headers view is only built when `headers` is read.
+    # The JSON of the body is parsed on first access only, and the parsed
+    # value is shared by every middleware and handler reading it: it must be
+    # treated as read-only (copy it before changing it).
+    __slots__ = ("method", "path", "_headers", "body", "_json", "log_started")
+
     def __init__(self, method, path, headers=None, body=None):
         self.method = method
         self.path = path
-        self.headers = headers if headers else {}
+        self._headers = headers
         self.body = body
+        self._json = UNPARSED
+        # Set by logging_middleware to when the request was received if its
+        # debug lines are logged
+        self.log_started = None
+
+    @property
+    def headers(self):
+        headers = self._headers
+        if type(headers) is not Headers:
+            headers = self._headers = make_headers(headers)
+        return headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._headers = headers
+
+    @property
+    def json(self):
+        if self._json is UNPARSED:
+            body = self.body
+            # Decoded straight from the buffer, without copying a memoryview
+            # to bytes first; JSON exchanged over HTTP is UTF-8, and a body
+            # that is not is invalid JSON like any other malformed body
+            if type(body) is not str:
+                try:
+                    body = body.decode() if type(body) is bytes else str(body, "utf-8")
+                except UnicodeDecodeError as e:
+                    raise json.JSONDecodeError(f"Invalid UTF-8 ({e.reason})", str(body, "utf-8", "replace"), e.start) from None
+            self._json = json.loads(body)
+        return self._json
+
+    @property
+    def text(self):
+        body = self.body
+        return str(body, "utf-8", "replace") if isinstance(body, (bytes, bytearray, memoryview)) else body
+
+    def __reduce__(self):
+        # Pickled (e.g. for a process pool) as a new, unparsed request: the
+        # UNPARSED sentinel would not survive pickling, nor would a memoryview
+        body = bytes(self.body) if isinstance(self.body, memoryview) else self.body
+        return HttpRequest, (self.method, self.path, self._headers, body)
 
 class HttpResponse:
+    # Like HttpRequest, the headers are wrapped on first access only
+    __slots__ = ("status_code", "_headers", "body")
+
     def __init__(self, status_code, headers=None, body=None):
         self.status_code = status_code
-        self.headers = headers if headers else {}
+        self._headers = headers
         self.body = body
 
+    @property
+    def headers(self):
+        headers = self._headers
+        if type(headers) is not Headers:
+            headers = self._headers = make_headers(headers)
+        return headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._headers = headers
+
 class Repository:
     pass
 
@@ -42,10 +248,17 @@ class Service:
     def __init__(self, repository):
         self.repository = repository
 
+def cacheable(process_post):
+    # Declares a process_post a pure function of the data posted, so that a
+    # ResponseCache may answer repeated requests with an earlier response
+    process_post.cacheable = True
+    return process_post
+
 def process_post_buggy(data):
     # Buggy: raises KeyError if "name" is missing and does not handle it
     return {"message": f"Hello, {data['name']}!"}
 
+@cacheable
 def process_post_fixed(data):
     # Fixed: handle the case where "name" is missing
     if "name" in data:
@@ -53,49 +266,375 @@ def process_post_fixed(data):
     else:
         return {"error": "Name not provided"}
 
-def handle_request_no_exception(request, process_post):
-    logger.debug(f"Received {request.method} request: Path={request.path}, Headers={request.headers}, Body={request.body}")
-    
-    if request.method == 'GET':
-        response_body = {"message": "Hello, World!"}
-        response = HttpResponse(status_code=200, headers={"Content-Type": "application/json"}, body=response_body)
-        logger.debug(f"Generated response: Status=200, Headers={response.headers}, Body={response_body}")
+class Truncated:
+    # Defers rendering a logged value until a record is emitted, decoding
+    # bytes bodies, and cuts it down to `limit` characters (if not None)
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            text = str(value, "utf-8", "replace")
+        else:
+            text = str(value)
+        if self.limit is not None and len(text) > self.limit:
+            return f"{text[:self.limit]}... ({len(text)} chars)"
+        return text
+
+class LogPolicy:
+    # Which requests get their debug lines logged and how much of their
+    # bodies. `sample_rates` maps paths to the fraction of their requests to
+    # log, other paths use `default_sample_rate`. Errors are always logged.
+    def __init__(self, sample_rates=None, default_sample_rate=1.0, max_body_length=None):
+        self.sample_rates = sample_rates or {}
+        self.default_sample_rate = default_sample_rate
+        self.max_body_length = max_body_length
+
+    def sampled(self, path):
+        rate = self.sample_rates.get(path, self.default_sample_rate)
+        return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+    def body(self, body):
+        if self.max_body_length is None and not isinstance(body, (bytes, bytearray, memoryview)):
+            return body
+        return Truncated(body, self.max_body_length)
+
+# Log every request in full, like the handlers always did
+DEFAULT_LOG_POLICY = LogPolicy()
+
+def body_size(body):
+    if isinstance(body, memoryview):
+        return body.nbytes
+    return len(body) if isinstance(body, (str, bytes, bytearray)) else 0
+
+def log_received(request, log_policy):
+    # Returns the start time of a request whose debug lines are logged, None
+    # if they are not. Nothing is formatted unless a record is emitted.
+    if not logger.isEnabledFor(logging.DEBUG) or not log_policy.sampled(request.path):
+        return None
+    fields = {"method": request.method, "path": request.path, "request_size": body_size(request.body)}
+    logger.debug("Received %s request: Path=%s, Headers=%s, Body=%s", request.method, request.path, request.headers,
+                 log_policy.body(request.body), extra=fields)
+    return time.perf_counter()
+
+def log_parsed(request, data, started, log_policy):
+    if started is not None:
+        logger.debug("Parsed POST data: %s", log_policy.body(data), extra={"method": request.method, "path": request.path})
+
+def log_response(request, response, started, log_policy):
+    if started is not None:
+        fields = {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "request_size": body_size(request.body),
+            "response_size": len(json.dumps(response.body)),
+            "latency_ms": (time.perf_counter() - started) * 1000,
+        }
+        logger.debug("Generated response: Status=%s, Headers=%s, Body=%s", response.status_code, response.headers,
+                     log_policy.body(response.body), extra=fields)
+
+def log_failure(message, request, log_policy, error=None):
+    fields = {"method": request.method, "path": request.path, "status": 400, "request_size": body_size(request.body)}
+    if error is None:
+        logger.error(message + ": %s", log_policy.body(request.body), extra=fields)
+    else:
+        logger.error(message + ": %s. Error: %s", log_policy.body(request.body), error, extra=fields)
+
+# Parameters of a route path, as in /users/{user_id}
+PATH_PARAMETER = re.compile(r"{(\w+)}")
+
+NO_PARAMS = {}
+
+def first_segment(path):
+    return path[1:].partition("/")[0]
+
+class Router:
+    # Maps (method, path) to handlers called as handler(request, **params).
+    # Routes are compiled once: static paths resolve with a single dict
+    # lookup, and the paths with {parameters} are grouped by their first
+    # segment and folded into one regex per group, so dispatch does not try
+    # the routes one by one in Python. Static paths win over parameterized
+    # ones, templates starting with a literal segment over those starting
+    # with a parameter, and otherwise templates are tried in the order added.
+    def __init__(self):
+        self.static = {}
+        self.templates = {}
+        self.patterns = None
+        self.pattern_routes = {}
+
+    def add(self, method, path, handler):
+        routes = self.templates if PATH_PARAMETER.search(path) else self.static
+        methods = routes.setdefault(path, {})
+        if method in methods:
+            raise ValueError(f"Route {method} {path} is already registered")
+        methods[method] = handler
+        if routes is self.templates:
+            self.patterns = None
+
+    def route(self, method, path):
+        def register(handler):
+            self.add(method, path, handler)
+            return handler
+        return register
+
+    def compile(self):
+        # Every template becomes a named group of its alternation, and its
+        # parameters groups named after it, so the outermost group that
+        # matched (match.lastgroup) identifies the route. Templates starting
+        # with a parameter are in the group of the None segment.
+        groups = {}
+        self.pattern_routes = {}
+        for index, (template, methods) in enumerate(self.templates.items()):
+            route_group = f"r{index}"
+            params = []
+            regex = []
+            position = 0
+            for parameter in PATH_PARAMETER.finditer(template):
+                group = f"{route_group}_{len(params)}"
+                params.append((group, parameter.group(1)))
+                regex.append(re.escape(template[position:parameter.start()]))
+                regex.append(f"(?P<{group}>[^/]+)")
+                position = parameter.end()
+            regex.append(re.escape(template[position:]))
+            segment = first_segment(template)
+            groups.setdefault(None if "{" in segment else segment, []).append(f"(?P<{route_group}>{''.join(regex)})")
+            self.pattern_routes[route_group] = (methods, params)
+        self.patterns = {segment: re.compile("|".join(alternatives)) for segment, alternatives in groups.items()}
+
+    def match(self, path):
+        pattern = self.patterns.get(first_segment(path))
+        match = pattern.fullmatch(path) if pattern is not None else None
+        if match is None:
+            pattern = self.patterns.get(None)
+            match = pattern.fullmatch(path) if pattern is not None else None
+        return match
+
+    def resolve(self, method, path):
+        # Returns (handler, params, methods): the handler is None if no route
+        # matches, and `methods` holds the handlers of the path for any
+        # method (empty if the path is unknown)
+        methods = self.static.get(path)
+        params = NO_PARAMS
+        if methods is None:
+            if self.patterns is None:
+                self.compile()
+            match = self.match(path)
+            if match is None:
+                return None, NO_PARAMS, NO_PARAMS
+            methods, groups = self.pattern_routes[match.lastgroup]
+            params = {name: match.group(group) for group, name in groups}
+        return methods.get(method), params, methods
+
+class Application:
+    # A router behind a chain of middleware, called as
+    # middleware(request, call_next). A middleware may answer without calling
+    # call_next, replace the response or handle what call_next raises; the
+    # first one in the list is the outermost.
+    def __init__(self, router, middleware=()):
+        router.compile()
+        self.router = router
+        self.static = router.static
+        handler = self.dispatch
+        for layer in reversed(middleware):
+            handler = functools.partial(layer, call_next=handler)
+        self.handler = handler
+
+    def __call__(self, request):
+        return self.handler(request)
+
+    def dispatch(self, request):
+        # Static routes are looked up inline, they are the common case
+        methods = self.static.get(request.path)
+        if methods is not None:
+            handler, params = methods.get(request.method), NO_PARAMS
+        else:
+            handler, params, methods = self.router.resolve(request.method, request.path)
+        if handler is not None:
+            return handler(request, **params) if params else handler(request)
+        if methods:
+            headers = {"Content-Type": "application/json", "Allow": ", ".join(methods)}
+            return HttpResponse(status_code=405, headers=headers, body={"error": "Method Not Allowed"})
+        return HttpResponse(status_code=404, headers=JSON_HEADERS, body={"error": "Not Found"})
+
+def logging_middleware(log_policy=DEFAULT_LOG_POLICY):
+    def log_exchange(request, call_next):
+        started = request.log_started = log_received(request, log_policy)
+        response = call_next(request)
+        if started is not None:
+            log_response(request, response, started, log_policy)
         return response
-    elif request.method == 'POST':
-        data = json.loads(request.body)
-        logger.debug(f"Parsed POST data: {data}")
-        response_body = process_post(data)
-        response = HttpResponse(status_code=200, headers={"Content-Type": "application/json"}, body=response_body)
-        logger.debug(f"Generated response: Status=200, Headers={response.headers}, Body={response_body}")
+    return log_exchange
+
+# Exceptions turned into responses by error_mapping_middleware, checked in
+# order: (exception type, status, body, message logged, whether the
+# exception is logged with it)
+ERROR_RESPONSES = (
+    (KeyError, 400, {"error": "Invalid JSON"}, "Failed to process POST data", True),
+    (json.JSONDecodeError, 400, {"error": "Invalid JSON"}, "Failed to parse POST data", False),
+)
+
+def error_mapping_middleware(log_policy=DEFAULT_LOG_POLICY, error_responses=ERROR_RESPONSES):
+    # Outside of logging_middleware, so that a failed request logs its error
+    # instead of a response, as the handlers always did
+    handled = tuple(error_type for error_type, *_ in error_responses)
+
+    def map_errors(request, call_next):
+        try:
+            return call_next(request)
+        except handled as e:
+            for error_type, status_code, body, message, log_error in error_responses:
+                if isinstance(e, error_type):
+                    log_failure(message, request, log_policy, e if log_error else None)
+                    return HttpResponse(status_code=status_code, headers=JSON_HEADERS, body=body)
+    return map_errors
+
+def timing_middleware(record):
+    # Calls record(request, response, seconds) for every response
+    def time_exchange(request, call_next):
+        started = time.perf_counter()
+        response = call_next(request)
+        record(request, response, time.perf_counter() - started)
         return response
+    return time_exchange
+
+# Bytes charged per cache entry on top of its body and response body
+CACHE_ENTRY_OVERHEAD = 200
+
+def is_request_error(request, response):
+    # What an error cache keeps, whatever the statuses of its ResponseCache:
+    # the errors that follow from the request alone, an unknown route (404,
+    # 405) or a body that is not JSON, which is left unparsed. A 400 mapped
+    # from an exception of process_post depends on the handler, and neither
+    # its successes nor transient server errors may be replayed.
+    status = response.status_code
+    return status == 404 or status == 405 or (status == 400 and request._json is UNPARSED)
+
+class ResponseCache:
+    # A middleware answering repeated requests, keyed on (scope, method,
+    # path, body bytes), with the response given to the first one. The scope
+    # given to a call (None by default) tells apart the handlers sharing a
+    # cache, whose responses to one request differ. Only responses with
+    # a status in `statuses` are kept, or those for which the
+    # store_if(request, response) given to a call is true. Entries expire after `ttl` seconds
+    # (if not None) and the least recently used ones are evicted beyond
+    # max_entries or max_bytes. Cached responses are shared between the
+    # requests they answer and must not be modified.
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024, ttl=None, statuses=range(200, 300), methods=("POST",)):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.statuses = statuses
+        self.methods = methods
+        # key -> (response, size in bytes, expiry time or None)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, request, call_next, store_if=None, scope=None):
+        if request.method not in self.methods:
+            return call_next(request)
+        body = request.body
+        if body is not None and type(body) is not bytes:
+            body = body.encode() if type(body) is str else bytes(body)
+        key = (scope, request.method, request.path, body)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[2] is None or entry[2] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self.remove(key)
+                self.expirations += 1
+            self.misses += 1
 
-def handle_request_with_exception(request, process_post):
-    logger.debug(f"Received {request.method} request: Path={request.path}, Headers={request.headers}, Body={request.body}")
-    
-    if request.method == 'GET':
-        response_body = {"message": "Hello, World!"}
-        response = HttpResponse(status_code=200, headers={"Content-Type": "application/json"}, body=response_body)
-        logger.debug(f"Generated response: Status=200, Headers={response.headers}, Body={response_body}")
+        response = call_next(request)
+        if response.status_code in self.statuses if store_if is None else store_if(request, response):
+            self.store(key, response)
         return response
-    elif request.method == 'POST':
-        try:
-            data = json.loads(request.body)
-            logger.debug(f"Parsed POST data: {data}")
-            response_body = process_post(data)
-            response = HttpResponse(status_code=200, headers={"Content-Type": "application/json"}, body=response_body)
-            logger.debug(f"Generated response: Status=200, Headers={response.headers}, Body={response_body}")
-            return response
-        except KeyError as e:
-            error_message = {"error": "Invalid JSON"}
-            response = HttpResponse(status_code=400, headers={"Content-Type": "application/json"}, body=error_message)
-            logger.error(f"Failed to process POST data: {request.body}. Error: {e}")
-            return response
-        except json.JSONDecodeError:
-            error_message = {"error": "Invalid JSON"}
-            response = HttpResponse(status_code=400, headers={"Content-Type": "application/json"}, body=error_message)
-            logger.error(f"Failed to parse POST data: {request.body}")
-            return response
 
+    def store(self, key, response):
+        size = CACHE_ENTRY_OVERHEAD + len(key[2]) + len(key[3] or b"") + len(json.dumps(response.body))
+        if size > self.max_bytes:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (response, size, expires)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def remove(self, key):
+        self.bytes -= self.entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+def get_hello(request):
+    return HttpResponse(status_code=200, headers=JSON_HEADERS, body={"message": "Hello, World!"})
+
+def post_hello(request, process_post, log_policy):
+    # process_post gets the request's shared parsed JSON and must not modify it
+    data = request.json
+    log_parsed(request, data, request.log_started, log_policy)
+    return HttpResponse(status_code=200, headers=JSON_HEADERS, body=process_post(data))
+
+@functools.lru_cache(maxsize=64)
+def hello_application(process_post, handle_exceptions, log_policy, response_cache=None, error_cache=None):
+    # Built once per configuration and reused by the handlers below. The
+    # response cache sits inside the logging, so cache hits are logged like
+    # any request, and is only used if process_post is declared cacheable.
+    # The error cache sits outside the error mapping: a repeated bad request
+    # is answered without being logged again, which keeps floods of
+    # malformed bodies cheap. It only keeps the errors caused by the request
+    # itself (see is_request_error). Both
+    # caches are scoped to process_post, since they may be shared between
+    # applications.
+    router = Router()
+    router.add("GET", "/hello", get_hello)
+    router.add("POST", "/hello", functools.partial(post_hello, process_post=process_post, log_policy=log_policy))
+    middleware = [logging_middleware(log_policy)]
+    if response_cache is not None and getattr(process_post, "cacheable", False):
+        middleware.append(functools.partial(response_cache, scope=process_post))
+    if handle_exceptions:
+        middleware.insert(0, error_mapping_middleware(log_policy))
+        if error_cache is not None:
+            middleware.insert(0, functools.partial(error_cache, store_if=is_request_error, scope=process_post))
+    return Application(router, middleware)
+
+def handle_request_no_exception(request, process_post, log_policy=DEFAULT_LOG_POLICY, response_cache=None):
+    return hello_application(process_post, False, log_policy, response_cache).handler(request)
+
+def handle_request_with_exception(request, process_post, log_policy=DEFAULT_LOG_POLICY, response_cache=None, error_cache=None):
+    # error_cache is a ResponseCache for the responses to malformed or
+    # misrouted requests, e.g. ResponseCache(ttl=1.0); its own statuses are
+    # ignored
+    return hello_application(process_post, True, log_policy, response_cache, error_cache).handler(request)
 
 # Unit test class
 class TestRequestHandler(unittest.TestCase):
@@ -204,5 +743,273 @@ class TestRequestHandler(unittest.TestCase):
         # Fixed implementation matches the correct output
         self.assertEqual(response_fixed_with_exception.body, {"error": "Name not provided"})
 
+    def test_logging_is_deferred_when_debug_is_off(self):
+        rendered = []
+
+        class Headers(dict):
+            def __repr__(self):
+                rendered.append(True)
+                return dict.__repr__(self)
+
+        request = HttpRequest(method="GET", path="/hello", headers=Headers({"Accept": "application/json"}))
+        level = logger.level
+        logger.setLevel(logging.INFO)
+        try:
+            handle_request_with_exception(request, process_post_fixed)
+        finally:
+            logger.setLevel(level)
+        self.assertEqual(rendered, [])
+
+    def test_log_sampling_and_truncation(self):
+        request_body = json.dumps({"age": 30})
+        request = HttpRequest(method="POST", path="/hello", headers={"Content-Type": "application/json"}, body=request_body)
+        log_policy = LogPolicy(sample_rates={"/hello": 0.0}, max_body_length=5)
+
+        # Debug lines of unsampled paths are skipped, errors are always logged
+        with self.assertLogs(logger, level="DEBUG") as logs:
+            handle_request_with_exception(request, process_post_buggy, log_policy)
+        self.assertEqual([record.levelname for record in logs.records], ["ERROR"])
+        self.assertEqual(logs.records[0].getMessage(), "Failed to process POST data: {\"age... (11 chars). Error: 'name'")
+
+    def test_structured_log_fields(self):
+        request = HttpRequest(method="GET", path="/hello", headers={"Accept": "application/json"})
+        with self.assertLogs(logger, level="DEBUG") as logs:
+            handle_request_with_exception(request, process_post_fixed)
+        received, generated = logs.records
+        self.assertEqual(received.getMessage(), "Received GET request: Path=/hello, Headers={'Accept': 'application/json'}, Body=None")
+        self.assertEqual((generated.method, generated.path, generated.status), ("GET", "/hello", 200))
+        self.assertGreaterEqual(generated.latency_ms, 0)
+
+        entry = json.loads(StructuredFormatter().format(generated))
+        self.assertEqual(entry["status"], 200)
+        self.assertEqual(entry["response_size"], len(json.dumps({"message": "Hello, World!"})))
+        self.assertTrue(entry["message"].startswith("Generated response: Status=200"))
+
+    def test_setup_logger_replaces_its_handlers(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_file = os.path.join(log_dir, "test.log")
+            test_logger = setup_logger("test_setup_logger", log_file)
+            setup_logger("test_setup_logger", log_file)
+            self.assertEqual(len(test_logger.handlers), 2)
+
+            setup_logger("test_setup_logger", log_file, async_writer=True, stream=None)
+            self.assertEqual([type(handler) for handler in test_logger.handlers], [BatchingLogWriter])
+            for handler in list(test_logger.handlers):
+                test_logger.removeHandler(handler)
+                handler.close()
+
+    def test_async_log_writer_batches_rotates_and_compresses(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_file = os.path.join(log_dir, "test.log")
+            writer = BatchingLogWriter(log_file, max_bytes=2000, backup_count=2, compress=True, batch_size=10)
+            test_logger = logging.getLogger("test_async_log_writer")
+            test_logger.addHandler(writer)
+            try:
+                for index in range(100):
+                    test_logger.warning("Record %d %s", index, "x" * 50)
+            finally:
+                test_logger.removeHandler(writer)
+                writer.close()
+
+            lines = []
+            for path in (log_file + ".2.gz", log_file + ".1.gz"):
+                with gzip.open(path, "rt") as file:
+                    lines += file.read().splitlines()
+            with open(log_file) as file:
+                lines += file.read().splitlines()
+            # Older records were rotated away, the ones kept are complete and in order
+            self.assertEqual(lines[-1], f"Record 99 {'x' * 50}")
+            numbers = [int(line.split()[1]) for line in lines]
+            self.assertEqual(numbers, list(range(numbers[0], 100)))
+
+    def test_async_log_writer_drop_policy(self):
+        writing = threading.Event()
+        resume = threading.Event()
+
+        class BlockingStream:
+            # Holds the writer thread in its first write so that the queue fills up
+            def write(self, data):
+                writing.set()
+                resume.wait()
+
+            def flush(self):
+                pass
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_file = os.path.join(log_dir, "test.log")
+            writer = BatchingLogWriter(log_file, stream=BlockingStream(), capacity=1, overflow="drop")
+            writer.emit(logging.makeLogRecord({"msg": "written"}))
+            writing.wait()
+            writer.emit(logging.makeLogRecord({"msg": "queued"}))
+            writer.emit(logging.makeLogRecord({"msg": "dropped"}))
+            resume.set()
+            writer.close()
+            with open(log_file) as file:
+                self.assertEqual(file.read().splitlines(), ["written", "queued", "1 log records dropped, the log queue was full"])
+
+    def test_headers_are_case_insensitive(self):
+        headers = Headers({"Content-Type": "application/json"})
+        self.assertEqual(headers["content-type"], "application/json")
+        self.assertIn("CONTENT-TYPE", headers)
+        headers["content-type"] = "text/plain"
+        self.assertEqual(dict(headers), {"content-type": "text/plain"})
+
+        # Messages without headers share one read-only map
+        request = HttpRequest(method="GET", path="/hello")
+        self.assertIs(request.headers, HttpResponse(status_code=200).headers)
+        with self.assertRaises(TypeError):
+            request.headers["Accept"] = "application/json"
+
+    def test_request_json_is_parsed_lazily_once(self):
+        request = HttpRequest(method="POST", path="/hello", body=memoryview(b'{"name": "Alice"}'))
+        self.assertIsInstance(request.body, memoryview)
+        self.assertIs(request.json, request.json)
+        self.assertEqual(request.json, {"name": "Alice"})
+        self.assertEqual(HttpRequest(method="POST", path="/hello", body='{"name": "Alice"}').json, {"name": "Alice"})
+
+        with self.assertRaises(json.JSONDecodeError):
+            HttpRequest(method="POST", path="/hello", body=b"{").json
+        response = handle_request_with_exception(HttpRequest(method="POST", path="/hello", body=b"{"), process_post_fixed)
+        self.assertEqual(response.status_code, 400)
+
+        # A body that is not UTF-8 is a client error too
+        with self.assertRaises(json.JSONDecodeError):
+            HttpRequest(method="POST", path="/hello", body=b"\xff\xfe").json
+        response = handle_request_with_exception(HttpRequest(method="POST", path="/hello", body=b"\xff\xfe"), process_post_fixed)
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_routes(self):
+        for handler in (handle_request_no_exception, handle_request_with_exception):
+            response = handler(HttpRequest(method="DELETE", path="/hello"), process_post_fixed)
+            self.assertEqual(response.status_code, 405)
+            self.assertEqual(response.headers["allow"], "GET, POST")
+
+            response = handler(HttpRequest(method="GET", path="/goodbye"), process_post_fixed)
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response.body, {"error": "Not Found"})
+
+    def test_router_and_middleware(self):
+        router = Router()
+        router.add("GET", "/users/me", lambda request: "me")
+        router.add("GET", "/users/{user_id}", lambda request, user_id: f"user {user_id}")
+        router.add("GET", "/users/{user_id}/posts/{post_id}", lambda request, user_id, post_id: f"post {post_id} of {user_id}")
+        router.add("GET", "/{section}/posts", lambda request, section: f"posts of {section}")
+        with self.assertRaises(ValueError):
+            router.add("GET", "/users/{user_id}", lambda request, user_id: None)
+
+        calls = []
+
+        def outer(request, call_next):
+            calls.append("outer")
+            return call_next(request)
+
+        timings = []
+        application = Application(router, [outer, timing_middleware(lambda *exchange: timings.append(exchange))])
+
+        # Static paths take precedence over parameterized ones
+        self.assertEqual(application(HttpRequest(method="GET", path="/users/me")), "me")
+        self.assertEqual(application(HttpRequest(method="GET", path="/users/42")), "user 42")
+        self.assertEqual(application(HttpRequest(method="GET", path="/users/42/posts/7")), "post 7 of 42")
+        self.assertEqual(application(HttpRequest(method="GET", path="/blog/posts")), "posts of blog")
+        self.assertEqual(application(HttpRequest(method="GET", path="/users/42/posts")).status_code, 404)
+        self.assertEqual(calls, ["outer"] * 5)
+        self.assertEqual([seconds >= 0 for _, _, seconds in timings], [True] * 5)
+
+    def test_response_cache(self):
+        cache = ResponseCache(max_entries=2)
+        bodies = [json.dumps({"name": name}) for name in ("Alice", "Bob", "Carol")]
+        for body in bodies[:2] + bodies[:2]:
+            response = handle_request_with_exception(HttpRequest(method="POST", path="/hello", body=body), process_post_fixed,
+                                                     response_cache=cache)
+        self.assertEqual(response.body, {"message": "Hello, Bob!"})
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # Carol evicts the least recently used entry, Alice's
+        handle_request_no_exception(HttpRequest(method="POST", path="/hello", body=bodies[2]), process_post_fixed, response_cache=cache)
+        self.assertEqual([key[3] for key in cache.entries], [bodies[1].encode(), bodies[2].encode()])
+        self.assertEqual(cache.evictions, 1)
+
+        # Not declared cacheable
+        handle_request_with_exception(HttpRequest(method="POST", path="/hello", body=bodies[1]), process_post_buggy, response_cache=cache)
+        self.assertEqual(cache.misses, 3)
+
+        expired = ResponseCache(ttl=0.0)
+        for _ in range(2):
+            handle_request_with_exception(HttpRequest(method="POST", path="/hello", body=bodies[0]), process_post_fixed,
+                                          response_cache=expired)
+        self.assertEqual(expired.stats(), {"entries": 1, "bytes": expired.bytes, "hits": 0, "misses": 2, "evictions": 0, "expirations": 1})
+
+    def test_error_cache(self):
+        error_cache = ResponseCache(ttl=60.0)
+        with self.assertLogs(logger, level="ERROR") as logs:
+            for _ in range(3):
+                response = handle_request_with_exception(HttpRequest(method="POST", path="/hello", body=b"{"), process_post_fixed,
+                                                         error_cache=error_cache)
+        self.assertEqual(response.status_code, 400)
+        # Only the first of the identical malformed requests got as far as the handler
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual((error_cache.hits, error_cache.misses), (2, 1))
+
+        response = handle_request_with_exception(HttpRequest(method="POST", path="/hello", body=b'{"name": "Alice"}'), process_post_fixed,
+                                                 error_cache=error_cache)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(error_cache.entries), 1)
+
+    def test_caches_shared_between_handlers(self):
+        @cacheable
+        def process_post_shouting(data):
+            return {"message": f"HELLO, {data.get('name', 'WORLD').upper()}!"}
+
+        response_cache = ResponseCache()
+        for process_post, message in [(process_post_fixed, "Hello, Alice!"), (process_post_shouting, "HELLO, ALICE!")] * 2:
+            response = handle_request_with_exception(HttpRequest(method="POST", path="/hello", body=b'{"name": "Alice"}'), process_post,
+                                                     response_cache=response_cache)
+            self.assertEqual(response.body, {"message": message})
+        self.assertEqual((response_cache.hits, response_cache.misses), (2, 2))
+
+        error_cache = ResponseCache()
+        for process_post in (process_post_buggy, process_post_fixed):
+            response = handle_request_with_exception(HttpRequest(method="POST", path="/hello", body=b"{"), process_post,
+                                                     error_cache=error_cache)
+            self.assertEqual(response.status_code, 400)
+        response = handle_request_with_exception(HttpRequest(method="POST", path="/hello", body=b"{"), process_post_fixed,
+                                                 error_cache=error_cache)
+        self.assertEqual((error_cache.hits, error_cache.misses), (1, 2))
+
+    def test_error_cache_keeps_request_errors_only(self):
+        error_cache = ResponseCache(methods=("POST", "DELETE"))
+        body = json.dumps({"age": 30})
+        # The KeyError of process_post_buggy is mapped to a 400 that depends
+        # on the handler, and is logged every time
+        with self.assertLogs(logger, level="ERROR") as logs:
+            for _ in range(2):
+                response = handle_request_with_exception(HttpRequest(method="POST", path="/hello", body=body), process_post_buggy,
+                                                         error_cache=error_cache)
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(len(error_cache.entries), 0)
+
+        for method, path, status_code in [("POST", "/goodbye", 404), ("DELETE", "/hello", 405)]:
+            for _ in range(2):
+                response = handle_request_with_exception(HttpRequest(method=method, path=path, body=body), process_post_buggy,
+                                                         error_cache=error_cache)
+                self.assertEqual(response.status_code, status_code)
+        self.assertEqual(error_cache.hits, 2)
+
+    def test_error_cache_does_not_cache_successes(self):
+        # Not declared cacheable: every request has to reach it
+        calls = []
+
+        def counting_post(data):
+            calls.append(data)
+            return {"n": len(calls)}
+
+        error_cache = ResponseCache()
+        for n in range(1, 4):
+            response = handle_request_with_exception(HttpRequest(method="POST", path="/hello", body=b'{"name": "Alice"}'), counting_post,
+                                                     error_cache=error_cache)
+            self.assertEqual(response.body, {"n": n})
+        self.assertEqual(len(error_cache.entries), 0)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
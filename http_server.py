@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import unittest
+from http import HTTPStatus
+
+from example import (
+    JSON_HEADERS,
+    Headers,
+    HttpRequest,
+    HttpResponse,
+    handle_request_no_exception,
+    handle_request_with_exception,
+    logger,
+    process_post_buggy,
+    process_post_fixed,
+    setup_logger,
+)
+
+# The handlers and process_post variants of example.py, by command line name
+HANDLERS = {"no_exception": handle_request_no_exception, "with_exception": handle_request_with_exception}
+PROCESS_POST = {"buggy": process_post_buggy, "fixed": process_post_fixed}
+POOLS = ("none", "thread", "process")
+
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+
+# Requests of one connection read ahead of the response being written
+MAX_PIPELINE = 16
+
+# Status lines by status code, built on first use
+STATUS_LINES = {}
+
+class BadRequest(Exception):
+    # A request that cannot be parsed; it is answered with `status` and the
+    # connection is closed, since the next request cannot be found
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+def status_line(status_code):
+    line = STATUS_LINES.get(status_code)
+    if line is None:
+        try:
+            phrase = HTTPStatus(status_code).phrase
+        except ValueError:
+            phrase = ""
+        line = STATUS_LINES[status_code] = f"HTTP/1.1 {status_code} {phrase}\r\n"
+    return line
+
+def keeps_alive(version, connection):
+    # HTTP/1.1 connections are persistent unless closed, HTTP/1.0 ones only
+    # if asked for
+    connection = connection.lower()
+    if version == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+async def read_request(reader):
+    # The next (request, keep_alive) of the connection, or None when the
+    # client closed it between requests
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise BadRequest(400, "Incomplete request")
+        return None
+    except asyncio.LimitOverrunError:
+        raise BadRequest(431, "Request header fields too large")
+    except ConnectionError:
+        return None
+
+    lines = head[:-4].decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ")
+    except ValueError:
+        raise BadRequest(400, "Malformed request line")
+    if version not in ("HTTP/1.0", "HTTP/1.1"):
+        raise BadRequest(505, f"{version} is not supported")
+    headers = {}
+    for line in lines[1:]:
+        name, separator, value = line.partition(":")
+        if not separator or not name or name != name.strip():
+            raise BadRequest(400, "Malformed header field")
+        headers[name] = value.strip()
+    headers = Headers(headers)
+
+    if "Transfer-Encoding" in headers:
+        raise BadRequest(501, "Chunked request bodies are not supported")
+    try:
+        length = int(headers.get("Content-Length", 0))
+    except ValueError:
+        raise BadRequest(400, "Invalid Content-Length")
+    if length < 0:
+        raise BadRequest(400, "Invalid Content-Length")
+    if length > MAX_BODY_BYTES:
+        raise BadRequest(413, "Request body too large")
+    try:
+        body = await reader.readexactly(length) if length else None
+    except (asyncio.IncompleteReadError, ConnectionError):
+        raise BadRequest(400, "Incomplete request body")
+
+    # The handlers route on the path alone, the query string is dropped
+    path = target.partition("?")[0]
+    return HttpRequest(method, path, headers, body), keeps_alive(version, headers.get("Connection", ""))
+
+def encode_response(response, keep_alive):
+    body = b"" if response.body is None else json.dumps(response.body).encode()
+    head = [status_line(response.status_code)]
+    for name, value in response.headers.items():
+        head.append(f"{name}: {value}\r\n")
+    head.append(f"Content-Length: {len(body)}\r\n")
+    if not keep_alive:
+        head.append("Connection: close\r\n")
+    head.append("\r\n")
+    return "".join(head).encode("latin-1") + body
+
+def error_response(status_code, message):
+    return HttpResponse(status_code=status_code, headers=JSON_HEADERS, body={"error": message})
+
+class HttpServer:
+    # Serves handler(request) -> HttpResponse over HTTP/1.1 with persistent
+    # connections and pipelining. Every connection reads requests ahead of
+    # the responses (up to max_pipeline of them) and answers them in order.
+    # Without an executor the handler runs on the event loop; with a thread
+    # or process pool, the pipelined requests of a connection and the
+    # requests of different connections are handled in parallel. A process
+    # pool needs a picklable handler, such as a functools.partial of the
+    # example handlers.
+    def __init__(self, handler, executor=None, max_pipeline=MAX_PIPELINE):
+        self.handler = handler
+        self.executor = executor
+        self.max_pipeline = max_pipeline
+
+    async def start(self, host="127.0.0.1", port=0):
+        return await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+
+    async def respond(self, request, keep_alive):
+        try:
+            if self.executor is None:
+                response = self.handler(request)
+            else:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(self.executor, self.handler, request)
+            return encode_response(response, keep_alive)
+        except Exception:
+            logger.exception("Unhandled error for %s request: Path=%s", request.method, request.path)
+            return encode_response(error_response(500, "Internal Server Error"), keep_alive)
+
+    async def handle_connection(self, reader, writer):
+        pending = asyncio.Queue(self.max_pipeline)
+        writing = asyncio.create_task(self.write_responses(pending, writer))
+        try:
+            while True:
+                try:
+                    parsed = await read_request(reader)
+                except BadRequest as e:
+                    response = asyncio.get_running_loop().create_future()
+                    response.set_result(encode_response(error_response(e.status, e.message), False))
+                    await pending.put(response)
+                    break
+                if parsed is None:
+                    break
+                request, keep_alive = parsed
+                await pending.put(asyncio.create_task(self.respond(request, keep_alive)))
+                if not keep_alive:
+                    break
+        finally:
+            await pending.put(None)
+            await writing
+
+    async def write_responses(self, pending, writer):
+        # Responses are written in request order; the socket is drained only
+        # once no further response is ready, so pipelined responses go out
+        # together. After a write error the remaining ones are discarded.
+        broken = False
+        while True:
+            response = await pending.get()
+            if response is None:
+                break
+            data = await response
+            if broken:
+                continue
+            try:
+                writer.write(data)
+                if pending.empty():
+                    await writer.drain()
+            except ConnectionError:
+                broken = True
+                writer.close()
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+def configure_logging(log_file, level):
+    setup_logger("http_logger", log_file, level)
+
+def start_log_listener():
+    # The records of process pool workers are sent to this process and
+    # written by its handlers, so that a single process writes and rotates
+    # the log file
+    queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(queue, *logger.handlers, respect_handler_level=True)
+    listener.start()
+    return queue, listener
+
+def configure_worker_logging(queue, level):
+    # Initializer of process pool workers: http_logger only puts its records
+    # on the queue of start_log_listener
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    logger.addHandler(logging.handlers.QueueHandler(queue))
+    logger.setLevel(level)
+
+def make_executor(pool, workers, log_queue, level):
+    if pool == "thread":
+        return concurrent.futures.ThreadPoolExecutor(workers)
+    if pool == "process":
+        return concurrent.futures.ProcessPoolExecutor(workers, initializer=configure_worker_logging, initargs=(log_queue, level))
+    return None
+
+async def serve(handler, host, port, executor=None):
+    server = await HttpServer(handler, executor).start(host, port)
+    host, port = server.sockets[0].getsockname()[:2]
+    # Printed for load generators started with --port 0
+    print(f"Listening on http://{host}:{port}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the example.py handlers over HTTP/1.1.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on, 0 for any free port")
+    parser.add_argument("--handler", choices=sorted(HANDLERS), default="with_exception", help="Handler serving the requests")
+    parser.add_argument("--process-post", choices=sorted(PROCESS_POST), default="fixed", help="process_post variant of the handler")
+    parser.add_argument("--pool", choices=POOLS, default="none",
+                        help="Run the handler on the event loop, or in a thread or process pool for CPU-bound process_post")
+    parser.add_argument("--workers", type=int, default=None, help="Number of pool workers (default: the executor's default)")
+    parser.add_argument("--log-file", default="http_detailed_log_file.log", help="Log file of the handlers")
+    parser.add_argument("--log-level", default="DEBUG", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Log level of the handlers")
+    args = parser.parse_args()
+
+    level = getattr(logging, args.log_level)
+    configure_logging(args.log_file, level)
+    handler = functools.partial(HANDLERS[args.handler], process_post=PROCESS_POST[args.process_post])
+    log_queue, listener = start_log_listener() if args.pool == "process" else (None, None)
+    executor = make_executor(args.pool, args.workers, log_queue, level)
+    try:
+        asyncio.run(serve(handler, args.host, args.port, executor))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if listener is not None:
+            # Writes the records the workers sent before they exited
+            listener.stop()
+
+class TestHttpServer(unittest.TestCase):
+    def test_http_server_keep_alive_and_pipelining(self):
+        async def exchange(wire):
+            handler = functools.partial(handle_request_no_exception, process_post=process_post_buggy)
+            server = await HttpServer(handler).start()
+            async with server:
+                reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+                writer.write(wire)
+                data = await reader.read()
+                writer.close()
+            return data
+
+        # Three pipelined requests on one connection, the last one closing it
+        body = b'{"name": "Alice"}'
+        wire = (
+            b"GET /hello HTTP/1.1\r\n\r\n"
+            + b"POST /hello HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+            + b"POST /hello HTTP/1.1\r\nContent-Length: 2\r\nConnection: close\r\n\r\n{}"
+        )
+        with self.assertLogs(logger, level="ERROR"):
+            responses = asyncio.run(exchange(wire)).split(b"HTTP/1.1 ")[1:]
+        self.assertEqual([response[:3] for response in responses], [b"200", b"200", b"500"])
+        self.assertTrue(responses[0].endswith(b'{"message": "Hello, World!"}'))
+        self.assertTrue(responses[1].endswith(b'{"message": "Hello, Alice!"}'))
+        self.assertIn(b"Connection: close", responses[2])
+
+        self.assertTrue(asyncio.run(exchange(b"NONSENSE\r\n\r\n")).startswith(b"HTTP/1.1 400 Bad Request"))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import os
+import json
+
+# Cache of the import graph of the main repository, kept in the root of the
+# doppelgänger repository next to the manifest. Every source file maps to its
+# hash, size and mtime (as in the manifest) and to the modules it imports, so
+# only files that changed since the graph was written are parsed again.
+IMPORTS_NAME = '.doppelganger_imports.json'
+IMPORT_GRAPH_VERSION = 1
+
+# Fields holding nested statements; imports are statements, so expressions
+# never need to be visited
+STATEMENT_FIELDS = ('body', 'orelse', 'finalbody', 'handlers', 'cases')
+
+def resolve_relative(package, module, level):
+    # Absolute name of `from <level dots><module> import ...` inside
+    # `package`, None if it climbs above the top-level package
+    if not level:
+        return module or ''
+    parts = package.split('.') if package else []
+    if level - 1 > len(parts):
+        return None
+    parts = parts[:len(parts) - (level - 1)]
+    if module:
+        parts.append(module)
+    return '.'.join(parts)
+
+def scan_imports(tree, relative_file=None):
+    # Every module a parsed source file may import, at any depth (including
+    # imports inside functions and try blocks). `from a import b` yields both
+    # a and a.b, since b may be a submodule; names that turn out not to be
+    # modules of the main repository are ignored when walking the graph.
+    import ast
+    from stub_pack import module_name
+
+    package = ''
+    if relative_file is not None:
+        name, is_package = module_name(relative_file)
+        package = name if is_package else name.rpartition('.')[0]
+
+    imports = set()
+    stack = list(tree.body)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Import):
+            imports.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = resolve_relative(package, node.module, node.level)
+            if base is None:
+                continue
+            if base:
+                imports.add(base)
+            imports.update(f'{base}.{alias.name}' if base else alias.name for alias in node.names if alias.name != '*')
+        else:
+            for field in STATEMENT_FIELDS:
+                stack.extend(getattr(node, field, ()))
+    return sorted(imports)
+
+def scan_imports_chunk(chunk, options):
+    # Worker entry point for files whose graph entry is stale, with the same
+    # result shape as create_stub_chunk
+    import ast
+
+    results = []
+    for relative_file, src_file, _ in chunk:
+        try:
+            with open(src_file, 'r') as file:
+                tree = ast.parse(file.read())
+        except Exception as e:
+            # The stub run reports the error if the file turns out to be needed
+            results.append((relative_file, f'{type(e).__name__}: {e}', None, []))
+        else:
+            results.append((relative_file, None, None, scan_imports(tree, relative_file)))
+    return results
+
+def load_import_graph(dst_dir):
+    try:
+        with open(os.path.join(dst_dir, IMPORTS_NAME), 'r') as file:
+            graph = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if graph.get('version') != IMPORT_GRAPH_VERSION:
+        return {}
+    return graph.get('files', {})
+
+def save_import_graph(dst_dir, graph):
+    graph_path = os.path.join(dst_dir, IMPORTS_NAME)
+    tmp_path = graph_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({'version': IMPORT_GRAPH_VERSION, 'files': graph}, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, graph_path)
+
+def root_module(root):
+    # Roots are module names (main_app.views) or paths relative to the main
+    # repository (main_app/views.py)
+    if root.endswith('.py'):
+        from stub_pack import module_name
+
+        return module_name(root.replace(os.sep, '/'))[0]
+    return root
+
+def reachable_files(graph, roots):
+    # The relative paths of the source files transitively imported by the
+    # roots, including the roots themselves and every package __init__.py
+    # on the way, which Python imports before any of its submodules
+    from stub_pack import module_name
+
+    modules = {}
+    for relative_file in graph:
+        name, is_package = module_name(relative_file)
+        # A package wins over a module of the same name, as on import
+        if is_package or name not in modules:
+            modules[name] = relative_file
+
+    stack = []
+    for root in roots:
+        name = root_module(root)
+        if name not in modules:
+            raise ValueError(f"Root module {root} is not part of the main repository")
+        stack.append(name)
+
+    reached = set()
+    visited = set()
+    while stack:
+        name = stack.pop()
+        if name in visited:
+            continue
+        visited.add(name)
+        parts = name.split('.')
+        for depth in range(1, len(parts) + 1):
+            relative_file = modules.get('.'.join(parts[:depth]))
+            if relative_file is not None and relative_file not in reached:
+                reached.add(relative_file)
+                stack.extend(graph[relative_file]['imports'])
+    return reached
+
+class ImportGraphTests:
+    # Run with `python -m unittest import_graph`; load_tests() makes a
+    # unittest.TestCase of these
+    def setUp(self):
+        import tempfile
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.src = os.path.join(tmp.name, 'src')
+        self.dst = os.path.join(tmp.name, 'dst')
+
+    def write(self, relative_file, source=''):
+        path = os.path.join(self.src, relative_file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(source)
+
+    def test_scan_imports(self):
+        import ast
+
+        tree = ast.parse(
+            'import os.path\nfrom . import sibling\nfrom .models import User\nfrom .helpers import *\nfrom .. import top\n'
+            'def f():\n    try:\n        import json as j\n    except ImportError:\n        from ...beyond import x\n'
+        )
+        self.assertEqual(scan_imports(tree, 'app/views/__init__.py'), [
+            'app', 'app.top', 'app.views', 'app.views.helpers', 'app.views.models', 'app.views.models.User',
+            'app.views.sibling', 'beyond', 'beyond.x', 'json', 'os.path',
+        ])
+        # In a module, the same import climbs above the top-level package
+        self.assertEqual(scan_imports(tree, 'app/views.py'),
+                         ['app', 'app.helpers', 'app.models', 'app.models.User', 'app.sibling', 'json', 'os.path', 'top'])
+
+    def test_reachable_files(self):
+        graph = {
+            'app/__init__.py': {'imports': []},
+            'app/views.py': {'imports': ['app.models', 'django.http']},
+            'app/models.py': {'imports': ['lib.util']},
+            'lib/util.py': {'imports': []},
+            'unused.py': {'imports': ['app.views']},
+        }
+        self.assertEqual(reachable_files(graph, ['app.views']), {'app/__init__.py', 'app/views.py', 'app/models.py', 'lib/util.py'})
+        self.assertEqual(reachable_files(graph, ['lib/util.py']), {'lib/util.py'})
+        with self.assertRaises(ValueError):
+            reachable_files(graph, ['missing'])
+
+    def test_roots_stub_the_import_closure_only(self):
+        from create_doppelganger_repo import create_doppelganger_repo
+
+        self.write('app/__init__.py')
+        self.write('app/views.py', 'from .models import User\n')
+        self.write('app/models.py', 'import lib.util\n')
+        self.write('lib/util.py')
+        self.write('tools/script.py', 'import app.views\n')
+
+        def build():
+            stats = create_doppelganger_repo(self.src, self.dst, roots=['app.views'])
+            stubs = sorted(os.path.relpath(os.path.join(root, name), self.dst).replace(os.sep, '/')
+                           for root, _, names in os.walk(self.dst) for name in names if name.endswith('.py'))
+            return stats['regenerated'], stats['removed'], stubs
+
+        self.assertEqual(build(), (4, 0, ['app/__init__.py', 'app/models.py', 'app/views.py', 'lib/util.py']))
+        self.assertEqual(sorted(load_import_graph(self.dst)), ['app/__init__.py', 'app/models.py', 'app/views.py', 'lib/util.py', 'tools/script.py'])
+
+        # The closure follows the edits, stubs that fall out of it are pruned
+        self.write('app/models.py', 'X = 1\n')
+        self.assertEqual(build(), (1, 1, ['app/__init__.py', 'app/models.py', 'app/views.py']))
+        self.write('app/views.py', 'import lib.util\nfrom .models import User\n')
+        self.assertEqual(build(), (2, 0, ['app/__init__.py', 'app/models.py', 'app/views.py', 'lib/util.py']))
+
+def load_tests(loader, tests, pattern):
+    import unittest
+
+    return loader.loadTestsFromTestCase(type('TestImportGraph', (ImportGraphTests, unittest.TestCase), {}))
@@ -0,0 +1,274 @@
+import os
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import gzip
+import mmap
+import re
+import tempfile
+import time
+import unittest
+
+# The lines of http_logger that open and close a request; every other line
+# (Parsed POST data, continuation lines of multi-line bodies or tracebacks)
+# is skipped by the regex search itself
+LOG_LINE = re.compile(
+    rb"^(?P<time>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(?P<ms>\d{3}) - \S+ - [A-Z]+ - "
+    rb"(?:Received (?P<method>\S+) request: Path=(?P<path>[^,\s]*)"
+    rb"|Generated response: Status=(?P<status>\d+)"
+    rb"|Failed to (?:process|parse) POST data)",
+    re.MULTILINE,
+)
+
+# Length of the timestamp prefix that names the time bucket of a request
+BUCKETS = {"second": 19, "minute": 16, "hour": 13, "day": 10}
+
+# Status of requests without a response line, e.g. whose handler raised
+NO_RESPONSE = "-"
+
+# Failed lines always answer 400; unknown method and path of a failure whose
+# Received line was not logged (it was not sampled)
+FAILED_STATUS = "400"
+UNKNOWN = "?"
+
+# Plain files are split into ranges of about this size, one per task
+CHUNK_BYTES = 64 * 1024 * 1024
+
+class LogSummary:
+    # Per (path, method, status): [count, total latency in ms, max latency in
+    # ms, number of requests timed] (only requests with both lines are
+    # timed), and per time bucket: [requests, errors]. Errors are 4xx/5xx
+    # responses and requests without a response.
+    def __init__(self):
+        self.requests = {}
+        self.buckets = {}
+        self.bytes = 0
+
+    def add(self, method, path, status, received, responded, bucket):
+        key = (path, method, status)
+        entry = self.requests.get(key)
+        if entry is None:
+            entry = self.requests[key] = [0, 0.0, 0.0, 0]
+        entry[0] += 1
+        if received is not None and responded is not None:
+            latency = (responded - received) * 1000
+            entry[1] += latency
+            entry[2] = max(entry[2], latency)
+            entry[3] += 1
+        counts = self.buckets.get(bucket)
+        if counts is None:
+            counts = self.buckets[bucket] = [0, 0]
+        counts[0] += 1
+        if status == NO_RESPONSE or status >= "400":
+            counts[1] += 1
+
+    def merge(self, other):
+        for key, (count, total, worst, timed) in other.requests.items():
+            entry = self.requests.setdefault(key, [0, 0.0, 0.0, 0])
+            entry[0] += count
+            entry[1] += total
+            entry[2] = max(entry[2], worst)
+            entry[3] += timed
+        for bucket, (count, errors) in other.buckets.items():
+            counts = self.buckets.setdefault(bucket, [0, 0])
+            counts[0] += count
+            counts[1] += errors
+        self.bytes += other.bytes
+
+    @property
+    def total(self):
+        return sum(entry[0] for entry in self.requests.values())
+
+    @property
+    def errors(self):
+        return sum(errors for _, errors in self.buckets.values())
+
+class Correlator:
+    # Correlates the lines fed to it in order: a Received line is answered by
+    # the next Generated or Failed line. The first answer with no Received
+    # line before it (`head`, as (timestamp, status, bucket)) and the last
+    # Received line left unanswered (`pending`, as (timestamp, bucket,
+    # method, path)) are kept aside, so that the chunks of a file can be
+    # stitched together.
+    def __init__(self, summary, bucket_length):
+        self.summary = summary
+        self.bucket_length = bucket_length
+        # Seconds since the epoch and bucket of the timestamps seen, parsed
+        # once per distinct second since many lines share one
+        self.seconds = {}
+        self.pending = None
+        self.head = None
+        self.received = False
+
+    def parse_time(self, stamp):
+        parsed = self.seconds[stamp] = (
+            datetime.datetime.strptime(stamp.decode(), "%Y-%m-%d %H:%M:%S").timestamp(),
+            stamp[:self.bucket_length].decode(),
+        )
+        return parsed
+
+    def feed(self, data, start=0, end=None):
+        add = self.summary.add
+        seconds = self.seconds
+        pending = self.pending
+        for match in LOG_LINE.finditer(data, start, len(data) if end is None else end):
+            stamp, milliseconds, method, path, status = match.groups()
+            second, bucket = seconds.get(stamp) or self.parse_time(stamp)
+            timestamp = second + int(milliseconds) / 1000
+            if method is not None:
+                if pending is not None:
+                    add(pending[2], pending[3], NO_RESPONSE, pending[0], None, pending[1])
+                self.received = True
+                pending = (timestamp, bucket, method.decode(), path.decode())
+                continue
+            status = FAILED_STATUS if status is None else status.decode()
+            if pending is not None:
+                add(pending[2], pending[3], status, pending[0], timestamp, pending[1])
+                pending = None
+            elif not self.received and self.head is None:
+                self.head = (timestamp, status, bucket)
+            else:
+                add(UNKNOWN, UNKNOWN, status, None, None, bucket)
+        self.pending = pending
+
+def analyze_chunk(path, start, end, bucket_length):
+    # Worker entry point, returning (summary, head, pending, whether any
+    # Received line was seen). Plain files are memory-mapped and only the
+    # lines starting in [start, end) are read; gzipped files are read whole,
+    # one block of lines at a time.
+    summary = LogSummary()
+    correlator = Correlator(summary, bucket_length)
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as file:
+            rest = b""
+            while True:
+                block = file.read(CHUNK_BYTES)
+                if not block:
+                    break
+                block = rest + block
+                cut = block.rfind(b"\n") + 1
+                correlator.feed(block, 0, cut)
+                summary.bytes += cut
+                rest = block[cut:]
+            correlator.feed(rest)
+            summary.bytes += len(rest)
+    else:
+        with open(path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            if size:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    # Both ends move to the start of the line they fall in the middle of
+                    if start:
+                        start = data.find(b"\n", start - 1) + 1 or size
+                    if end < size:
+                        end = data.find(b"\n", end - 1) + 1 or size
+                    summary.bytes = end - start
+                    correlator.feed(data, start, end)
+    return summary, correlator.head, correlator.pending, correlator.received
+
+def log_files(paths):
+    # Each log file given is expanded to its rotated files (log.N, log.N.gz),
+    # oldest first and the current file last
+    files = []
+    for path in paths:
+        rotated = []
+        for candidate in glob.glob(glob.escape(path) + ".*"):
+            index = candidate[len(path) + 1:].removesuffix(".gz")
+            if index.isdigit():
+                rotated.append((int(index), candidate))
+        files.extend(candidate for _, candidate in sorted(rotated, reverse=True))
+        if os.path.exists(path) or not rotated:
+            files.append(path)
+    return files
+
+def chunks(files, chunk_bytes):
+    for path in files:
+        if path.endswith(".gz"):
+            yield path, 0, None
+            continue
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), chunk_bytes):
+            yield path, start, min(start + chunk_bytes, size)
+
+def analyze(paths, bucket="hour", workers=None, chunk_bytes=CHUNK_BYTES):
+    # Analyzes the log files (and their rotated files) in `workers`
+    # processes (one per CPU by default, in this process if 0)
+    bucket_length = BUCKETS[bucket]
+    tasks = list(chunks(log_files(paths), chunk_bytes))
+    if workers == 0:
+        results = [analyze_chunk(*task, bucket_length) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(analyze_chunk, *zip(*tasks), [bucket_length] * len(tasks)))
+
+    # The Received line left unanswered at the end of a chunk is answered by
+    # the first answer of the next one, if any; successive files are
+    # stitched the same way, since a rotation may split a request
+    summary = LogSummary()
+    pending = None
+    for chunk_summary, head, tail, received in results:
+        summary.merge(chunk_summary)
+        if head is not None:
+            if pending is not None:
+                summary.add(pending[2], pending[3], head[1], pending[0], head[0], pending[1])
+                pending = None
+            else:
+                summary.add(UNKNOWN, UNKNOWN, head[1], None, None, head[2])
+        if received:
+            if pending is not None:
+                summary.add(pending[2], pending[3], NO_RESPONSE, pending[0], None, pending[1])
+            pending = tail
+    if pending is not None:
+        summary.add(pending[2], pending[3], NO_RESPONSE, pending[0], None, pending[1])
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the requests logged by http_logger in its current and rotated log files.")
+    parser.add_argument("logs", nargs="*", default=["http_detailed_log_file.log"], help="Log files; their rotated files (.1, .2.gz, ...) are included")
+    parser.add_argument("--bucket", choices=list(BUCKETS), default="hour", help="Width of the time buckets")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes, 0 to analyze in this process (default: one per CPU)")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    summary = analyze(args.logs, args.bucket, args.workers)
+    seconds = time.perf_counter() - started
+
+    total = summary.total
+    print(f"Analyzed {summary.bytes / 1e6:.1f} MB in {seconds:.2f} s: {total} requests, "
+          f"{summary.errors} errors ({summary.errors / max(total, 1):.1%})")
+    print(f"\n{'path':<30} {'method':<7} {'status':>6} {'count':>10} {'share':>7} {'avg ms':>9} {'max ms':>9}")
+    for (path, method, status), (count, latency, worst, timed) in sorted(summary.requests.items(), key=lambda item: -item[1][0]):
+        average = f"{latency / timed:9.2f}" if timed else f"{'-':>9}"
+        maximum = f"{worst:9.2f}" if timed else f"{'-':>9}"
+        print(f"{path:<30} {method:<7} {status:>6} {count:>10} {count / total:7.1%} {average} {maximum}")
+    print(f"\n{args.bucket:<19} {'requests':>10} {'errors':>8} {'rate':>7}")
+    for bucket, (count, errors) in sorted(summary.buckets.items()):
+        print(f"{bucket:<19} {count:>10} {errors:>8} {errors / count:7.1%}")
+
+class TestLogAnalyzer(unittest.TestCase):
+    def test_log_analyzer(self):
+        def line(second, level, message):
+            return f"2024-07-17 15:58:{second:02d},100 - http_logger - {level} - {message}\n"
+
+        received = "Received POST request: Path=/hello, Headers={}, Body={\"age\": 30}"
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_file = os.path.join(log_dir, "http.log")
+            # A rotation splits the second request between the gzipped and the current file
+            with gzip.open(log_file + ".1.gz", "wt") as file:
+                file.write(line(1, "DEBUG", received) + line(1, "DEBUG", "Parsed POST data: {'age': 30}"))
+                file.write(line(2, "DEBUG", "Generated response: Status=200, Headers={}, Body={}") + line(3, "DEBUG", received))
+            with open(log_file, "w") as file:
+                file.write(line(4, "ERROR", "Failed to process POST data: {\"age\": 30}. Error: 'name'"))
+                file.write(line(5, "DEBUG", received) + "Traceback (most recent call last):\n")
+                file.write(line(6, "DEBUG", "Received GET request: Path=/hello, Headers={}, Body=None"))
+                file.write(line(6, "DEBUG", "Generated response: Status=200, Headers={}, Body={}"))
+
+            summary = analyze([log_file], bucket="minute", workers=0, chunk_bytes=100)
+        self.assertEqual({key: entry[0] for key, entry in summary.requests.items()},
+                         {("/hello", "POST", "200"): 1, ("/hello", "POST", "400"): 1, ("/hello", "POST", "-"): 1, ("/hello", "GET", "200"): 1})
+        self.assertEqual(summary.requests[("/hello", "POST", "400")][1], 1000.0)
+        self.assertEqual(summary.buckets, {"2024-07-17 15:58": [4, 2]})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import os
+import gzip
+import logging
+import queue
+import shutil
+import threading
+
+# What emit() does when the queue is full: wait for the writer thread to make
+# room, or discard the record and count it
+OVERFLOW_POLICIES = ("block", "drop")
+
+class BatchingLogWriter(logging.Handler):
+    # A handler whose emit() only puts the record on a bounded queue. A writer
+    # thread formats the queued records in batches, writes each batch to the
+    # log file (and the stream, if any) with a single write, and rotates the
+    # file like RotatingFileHandler, optionally gzipping the rotated files.
+    # Records are formatted by the writer thread, so arguments logged by
+    # reference should not be mutated afterwards.
+    def __init__(self, log_file, max_bytes=10**6, backup_count=3, compress=False, stream=None,
+                 capacity=10000, overflow="block", batch_size=512, flush_interval=0.5):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {OVERFLOW_POLICIES}, not {overflow!r}")
+        super().__init__()
+        self.log_file = os.path.abspath(log_file)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.stream = stream
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(capacity)
+        # Approximate under contention, increments from several threads may race
+        self.dropped = 0
+        self.reported_drops = 0
+        self.closed = False
+        self.file = open(self.log_file, "a", encoding="utf-8")
+        self.thread = threading.Thread(target=self.run, name=f"log-writer:{os.path.basename(log_file)}", daemon=True)
+        self.thread.start()
+
+    def handle(self, record):
+        # The queue does its own locking, the handler lock is not needed
+        rv = self.filter(record)
+        if rv:
+            self.emit(rv if isinstance(rv, logging.LogRecord) else record)
+        return rv
+
+    def emit(self, record):
+        if self.closed:
+            return
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None is the stop sentinel put by close()
+            records = [record for record in batch if record is not None]
+            running = len(records) == len(batch)
+            self.write_batch(records)
+            for _ in batch:
+                self.queue.task_done()
+
+    def write_batch(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record) + "\n")
+            except Exception:
+                self.handleError(record)
+        if self.dropped != self.reported_drops:
+            dropped, self.reported_drops = self.dropped - self.reported_drops, self.dropped
+            notice = logging.makeLogRecord({
+                "name": __name__, "levelno": logging.WARNING, "levelname": "WARNING",
+                "msg": "%d log records dropped, the log queue was full", "args": (dropped,),
+            })
+            lines.append(self.format(notice) + "\n")
+        if not lines:
+            return
+
+        data = "".join(lines)
+        try:
+            self.file.write(data)
+            self.file.flush()
+            if self.stream is not None:
+                self.stream.write(data)
+                self.stream.flush()
+            if self.max_bytes and self.backup_count and os.fstat(self.file.fileno()).st_size >= self.max_bytes:
+                self.rotate()
+        except Exception:
+            self.handleError(records[0] if records else notice)
+
+    def rotate(self):
+        # Same naming as RotatingFileHandler (log, log.1, ... log.N), with a
+        # .gz suffix on the rotated files when compressing. A batch is never
+        # split, so a file may exceed max_bytes by up to one batch.
+        self.file.close()
+        suffix = ".gz" if self.compress else ""
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.log_file}.{index}{suffix}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.log_file}.{index + 1}{suffix}")
+        rotated = f"{self.log_file}.1"
+        os.replace(self.log_file, rotated)
+        self.file = open(self.log_file, "a", encoding="utf-8")
+        if self.compress:
+            with open(rotated, "rb") as source, gzip.open(rotated + ".gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.remove(rotated)
+
+    def flush(self):
+        # Wait until every record queued so far has been written
+        if self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        # Drain the queue and stop the writer thread; logging.shutdown() calls
+        # this at exit, so nothing queued is lost
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+            self.file.close()
+        super().close()
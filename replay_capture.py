@@ -0,0 +1,291 @@
+import os
+import argparse
+import concurrent.futures
+import gzip
+import json
+import logging
+import math
+import sys
+import tempfile
+import time
+import unittest
+
+from example import (
+    HttpRequest,
+    handle_request_no_exception,
+    handle_request_with_exception,
+    logger,
+    process_post_buggy,
+    process_post_fixed,
+    setup_logger,
+)
+from http_server import configure_worker_logging, start_log_listener
+
+# A capture holds one recorded exchange per line:
+#   {"method": "POST", "path": "/hello", "headers": {...}, "body": "<raw body>",
+#    "response": {"status_code": 200, "headers": {...}, "body": <JSON value>}}
+# "headers" and "response" are optional. A request body that is not a string
+# is taken as the JSON value that was sent. Captures ending in .gz are read
+# through gzip.
+
+HANDLERS = {"no_exception": handle_request_no_exception, "with_exception": handle_request_with_exception}
+PROCESS_POST = {"buggy": process_post_buggy, "fixed": process_post_fixed}
+
+# How responses differ from what they are compared with, in report order
+OUTCOMES = ("matched", "status differs", "headers differ", "body differs", "handler error", "not recorded", "invalid line")
+
+# Set in every worker by init_worker: (handler, reference handler or None)
+REPLAY = None
+
+class LatencyHistogram:
+    # Latencies counted in buckets 5% wide on a log scale, so percentiles of
+    # any number of requests take constant memory and merge across workers
+    RATIO = 1.05
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        bucket = int(math.log(max(seconds, 1e-9) * 1e9) / math.log(self.RATIO))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the percentile, in seconds
+        rank = max(1, math.ceil(self.count * fraction))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.max, self.RATIO ** (bucket + 1) / 1e9)
+        return self.max
+
+class ReplayResult:
+    def __init__(self):
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.latency = LatencyHistogram()
+        # (line number, message) of the first differences found
+        self.examples = []
+
+    def record(self, outcome, line_number, message, max_examples):
+        self.outcomes[outcome] += 1
+        if message is not None and len(self.examples) < max_examples:
+            self.examples.append((line_number, message))
+
+    def merge(self, other, max_examples):
+        for outcome, count in other.outcomes.items():
+            self.outcomes[outcome] += count
+        self.latency.merge(other.latency)
+        self.examples = sorted(self.examples + other.examples)[:max_examples]
+
+def init_worker(handler_name, process_post, reference, log_queue, log_level):
+    # The handlers log through example.logger, whose records are written by
+    # the listener of replay() in the parent process
+    configure_worker_logging(log_queue, log_level)
+    set_handlers(handler_name, process_post, reference)
+
+def set_handlers(handler_name, process_post, reference):
+    global REPLAY
+    handler = HANDLERS[handler_name]
+    REPLAY = (
+        lambda request: handler(request, PROCESS_POST[process_post]),
+        None if reference is None else lambda request: handler(request, PROCESS_POST[reference]),
+    )
+
+def parse_exchange(line):
+    exchange = json.loads(line)
+    if not isinstance(exchange, dict) or "method" not in exchange or "path" not in exchange:
+        raise ValueError("not a recorded request")
+    body = exchange.get("body")
+    if body is not None and not isinstance(body, str):
+        body = json.dumps(body)
+    request = HttpRequest(exchange["method"], exchange["path"], exchange.get("headers"), body)
+    return request, exchange.get("response")
+
+def call(handler, request):
+    try:
+        return handler(request), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+def compare(response, expected):
+    # The outcome and a description of the first difference, if any. Only
+    # the headers that were recorded are compared.
+    if response.status_code != expected.get("status_code"):
+        return "status differs", f"status {response.status_code} != {expected.get('status_code')}"
+    for name, value in (expected.get("headers") or {}).items():
+        if response.headers.get(name) != value:
+            return "headers differ", f"header {name}: {response.headers.get(name)!r} != {value!r}"
+    if "body" in expected and response.body != expected["body"]:
+        return "body differs", f"body {json.dumps(response.body)} != {json.dumps(expected['body'])}"
+    return "matched", None
+
+def replay_batch(batch, max_examples):
+    # Worker entry point: replays (line number, line) pairs, comparing with
+    # the recorded responses or with the reference handler
+    handler, reference = REPLAY
+    result = ReplayResult()
+    for line_number, line in batch:
+        try:
+            request, recorded = parse_exchange(line)
+        except ValueError as e:
+            result.record("invalid line", line_number, f"invalid line: {e}", max_examples)
+            continue
+
+        started = time.perf_counter()
+        response, error = call(handler, request)
+        result.latency.add(time.perf_counter() - started)
+        label = f"{request.method} {request.path}"
+        if reference is not None:
+            expected, expected_error = call(reference, HttpRequest(request.method, request.path, request.headers, request.body))
+            if error is not None or expected_error is not None:
+                if error == expected_error:
+                    result.record("matched", line_number, None, max_examples)
+                else:
+                    result.record("handler error", line_number, f"{label}: {error} != {expected_error}", max_examples)
+                continue
+            expected = {"status_code": expected.status_code, "headers": dict(expected.headers), "body": expected.body}
+        elif error is not None:
+            result.record("handler error", line_number, f"{label}: {error}", max_examples)
+            continue
+        elif recorded is None:
+            result.record("not recorded", line_number, None, max_examples)
+            continue
+        else:
+            expected = recorded
+        outcome, difference = compare(response, expected)
+        result.record(outcome, line_number, difference and f"{label}: {difference}", max_examples)
+    return result
+
+def read_batches(capture, batch_size):
+    # Lines are read one at a time, only `batch_size` of them are held per batch
+    opener = gzip.open if capture.endswith(".gz") else open
+    with opener(capture, "rb") as file:
+        batch = []
+        for line_number, line in enumerate(file, 1):
+            if line.strip():
+                batch.append((line_number, line))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def replay(capture, workers=None, batch_size=2000, max_examples=10, handler="with_exception", process_post="fixed",
+           reference=None, log_file=os.devnull, log_level=logging.CRITICAL):
+    # Replays a capture through `handler`, in `workers` processes (all CPUs
+    # by default) whose records this process writes to `log_file`, or in
+    # this process if 0, leaving its logging alone. At most two batches per
+    # worker are in flight, so memory does not grow with the size of the
+    # capture.
+    result = ReplayResult()
+    if workers == 0:
+        set_handlers(handler, process_post, reference)
+        for batch in read_batches(capture, batch_size):
+            result.merge(replay_batch(batch, max_examples), max_examples)
+        return result
+
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = 2 * workers
+    # A single process writes and rotates the log file, see start_log_listener
+    setup_logger("http_logger", log_file, log_level)
+    log_queue, listener = start_log_listener()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker,
+                                                    initargs=(handler, process_post, reference, log_queue, log_level)) as executor:
+            pending = set()
+            for batch in read_batches(capture, batch_size):
+                if len(pending) >= max_in_flight:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        result.merge(future.result(), max_examples)
+                pending.add(executor.submit(replay_batch, batch, max_examples))
+            for future in concurrent.futures.as_completed(pending):
+                result.merge(future.result(), max_examples)
+    finally:
+        # Writes the records the workers sent before they exited
+        listener.stop()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a JSONL traffic capture through the example.py handlers and compare the responses.")
+    parser.add_argument("capture", help="Capture file, one recorded exchange per line (optionally gzipped)")
+    parser.add_argument("--handler", choices=sorted(HANDLERS), default="with_exception", help="Handler replaying the requests")
+    parser.add_argument("--process-post", choices=sorted(PROCESS_POST), default="fixed", help="process_post variant being tested")
+    parser.add_argument("--compare-with", choices=sorted(PROCESS_POST), default=None,
+                        help="Compare with this process_post variant instead of the recorded responses")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes, 0 to replay in this process (default: one per CPU)")
+    parser.add_argument("--batch-size", type=int, default=2000, help="Number of lines sent to a worker at once")
+    parser.add_argument("--max-examples", type=int, default=10, help="Number of differences listed in the report")
+    parser.add_argument("--log-file", default=os.devnull, help="Log file of the handlers")
+    parser.add_argument("--log-level", default="CRITICAL", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+                        help="Log level of the handlers (default: CRITICAL, which keeps them quiet)")
+    args = parser.parse_args()
+
+    # Also where replay() writes the records of its workers
+    setup_logger("http_logger", args.log_file, getattr(logging, args.log_level))
+    started = time.perf_counter()
+    result = replay(args.capture, args.workers, args.batch_size, args.max_examples, args.handler, args.process_post,
+                    args.compare_with, args.log_file, getattr(logging, args.log_level))
+    seconds = time.perf_counter() - started
+
+    latency = result.latency
+    print(f"Replayed {latency.count} requests from {args.capture} in {seconds:.2f} s ({latency.count / seconds:.0f} requests/s)")
+    if latency.count:
+        print("Handler latency: " + ", ".join(
+            f"p{round(fraction * 100)} {latency.percentile(fraction) * 1e6:.1f} us" for fraction in (0.5, 0.9, 0.99)
+        ) + f", max {latency.max * 1e6:.1f} us")
+    against = f"process_post_{args.compare_with}" if args.compare_with else "the recorded responses"
+    print(f"Compared with {against}: " + ", ".join(f"{outcome} {count}" for outcome, count in result.outcomes.items() if count))
+    for line_number, message in result.examples:
+        print(f"  line {line_number}: {message}")
+    matched = result.outcomes["matched"] + result.outcomes["not recorded"]
+    sys.exit(0 if matched == sum(result.outcomes.values()) else 1)
+
+class TestReplayCapture(unittest.TestCase):
+    def test_replay_capture(self):
+        exchanges = [
+            {"method": "POST", "path": "/hello", "body": {"name": "Alice"},
+             "response": {"status_code": 200, "body": {"message": "Hello, Alice!"}}},
+            {"method": "POST", "path": "/hello", "body": '{"age": 30}',
+             "response": {"status_code": 200, "headers": {"content-type": "application/json"}, "body": {"error": "Name not provided"}}},
+            {"method": "GET", "path": "/hello"},
+        ]
+        with tempfile.TemporaryDirectory() as capture_dir:
+            capture = os.path.join(capture_dir, "capture.jsonl")
+            with open(capture, "w") as file:
+                file.writelines(json.dumps(exchange) + "\n" for exchange in exchanges)
+                file.write("not json\n")
+
+            result = replay(capture, workers=0, batch_size=2)
+            self.assertEqual(result.latency.count, 3)
+            self.assertEqual({outcome: count for outcome, count in result.outcomes.items() if count},
+                             {"matched": 2, "not recorded": 1, "invalid line": 1})
+
+            # The buggy process_post answers 400 where the fixed one reports the missing name
+            result = replay(capture, workers=0, process_post="buggy", reference="fixed")
+            self.assertEqual(result.outcomes["status differs"], 1)
+            self.assertEqual(result.examples[0], (2, "POST /hello: status 400 != 200"))
+
+            # The records of the workers are sent to this process, which
+            # alone writes the log file
+            log_file = os.path.join(capture_dir, "replay.log")
+            self.addCleanup(setup_logger, "http_logger", "http_detailed_log_file.log")
+            with self.assertLogs(logger, level="ERROR") as logs:
+                result = replay(capture, workers=2, batch_size=1, process_post="buggy", log_file=log_file, log_level=logging.ERROR)
+            self.assertEqual(result.outcomes["status differs"], 1)
+            self.assertEqual(len(logs.records), 1)
+            with open(log_file) as file:
+                self.assertEqual([line.split(" - ")[3] for line in file], ["Failed to process POST data: {\"age\": 30}. Error: 'name'\n"])
+
+if __name__ == '__main__':
+    main()
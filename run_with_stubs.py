@@ -2,18 +2,24 @@ import os
 import sys
 from pathlib import Path
 
+current_dir = Path(__file__).resolve().parent
+
 # Check if the USE_STUBS environment variable is set
 use_stubs = os.getenv('USE_STUBS', 'false') == 'true'
 
 if use_stubs:
+    from stub_finder import install_stub_finder
+
     # Calculate the path to the stubs directory
-    current_dir = Path(__file__).resolve().parent
     stubs_path = current_dir / 'stubs'
     doppelganger_path = current_dir / 'django_app_stubs'
 
-    # Add the stubs directory and doppelganger directory to the system path
-    sys.path.insert(0, str(stubs_path))
-    sys.path.insert(0, str(doppelganger_path))
+    # Resolve stubbed modules from an index of the doppelganger and stubs
+    # directories instead of prepending them to sys.path, so that imports of
+    # everything else do not probe them first. STUB_MODULES optionally limits
+    # stubbing to some modules, e.g. STUB_MODULES='main_app.*,repo_a.*'
+    stub_modules = [pattern.strip() for pattern in os.getenv('STUB_MODULES', '').split(',') if pattern.strip()]
+    install_stub_finder([doppelganger_path, stubs_path], modules=stub_modules or None)
 
 # Add the main Django app directory to the system path
 django_app_path = current_dir / 'django_app'
@@ -0,0 +1,275 @@
+import os
+import json
+import sys
+from fnmatch import fnmatchcase
+from importlib.machinery import ModuleSpec, PathFinder
+from importlib.util import spec_from_file_location
+
+from stub_pack import StubPack, module_name
+
+# Written by create_doppelganger_repo.py; when present it saves a directory scan
+MANIFEST_NAME = '.doppelganger_manifest.json'
+
+# Precompiled bundle written by `create_doppelganger_repo.py --bytecode zip`
+BUNDLE_NAME = 'stubs.zip'
+
+# Archive written by `create_doppelganger_repo.py --output-format pack`
+PACK_NAME = 'stubs.pack'
+
+def iter_stub_files(stub_dir):
+    # A bundle lists its modules in the zip directory
+    if os.path.isfile(stub_dir):
+        import zipfile
+
+        with zipfile.ZipFile(stub_dir) as bundle:
+            for name in bundle.namelist():
+                if name.endswith('.pyc'):
+                    yield name[:-1]
+        return
+
+    # Prefer the list of stubs recorded in the manifest over walking the tree
+    try:
+        with open(os.path.join(stub_dir, MANIFEST_NAME), 'r') as file:
+            yield from json.load(file)['files']
+        return
+    except (OSError, ValueError, KeyError):
+        pass
+
+    stack = ['']
+    while stack:
+        relative_dir = stack.pop()
+        try:
+            with os.scandir(os.path.join(stub_dir, relative_dir)) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            relative_path = relative_dir + '/' + entry.name if relative_dir else entry.name
+            if entry.is_dir():
+                if entry.name.isidentifier():
+                    stack.append(relative_path)
+            elif entry.name.endswith('.py'):
+                yield relative_path
+
+def is_selected(name, patterns):
+    # 'main_app.*' selects the main_app package as well as everything below it
+    if patterns is None:
+        return True
+    for pattern in patterns:
+        if fnmatchcase(name, pattern) or (pattern.endswith('.*') and name == pattern[:-2]):
+            return True
+    return False
+
+def resolve_stub_dir(stub_dir, prefer_bundle=True):
+    # Use the precompiled bundle of a doppelgänger repository when it has one
+    stub_dir = os.path.abspath(stub_dir)
+    bundle_path = os.path.join(stub_dir, BUNDLE_NAME)
+    if prefer_bundle and os.path.isfile(bundle_path):
+        return bundle_path
+    return stub_dir
+
+def build_module_index(stub_dirs, modules=None, prefer_bundle=True):
+    # Map every stubbed module name to (origin, submodule_search_locations,
+    # archive). Regular modules and packages have an origin file, with the
+    # archive set when that file lives in a zipped bundle; directories
+    # without an __init__.py become namespace packages with an origin of
+    # None. Earlier directories take precedence, like earlier sys.path
+    # entries.
+    index = {}
+    for stub_dir in stub_dirs:
+        stub_dir = resolve_stub_dir(stub_dir, prefer_bundle)
+        archive = stub_dir if os.path.isfile(stub_dir) else None
+        parents_seen = set()
+        for relative_file in iter_stub_files(stub_dir):
+            name, is_package = module_name(relative_file)
+            if not name:
+                continue
+            path = os.path.join(stub_dir, relative_file)
+
+            # Every parent directory is at least a namespace package
+            parts = name.split('.')
+            for depth in range(1, len(parts)):
+                parent = '.'.join(parts[:depth])
+                if parent in parents_seen:
+                    continue
+                parents_seen.add(parent)
+                if not is_selected(parent, modules):
+                    continue
+                origin, locations, _ = index.get(parent, (None, [], None))
+                location = os.path.join(stub_dir, *parts[:depth])
+                if origin is None and location not in locations:
+                    index[parent] = (None, locations + [location], None)
+
+            if not is_selected(name, modules):
+                continue
+            # Submodules of a regular package are only looked up in the
+            # directory of that package
+            parent = index.get(name.rpartition('.')[0])
+            if parent is not None and parent[0] is not None and not parent[0].startswith(stub_dir + os.sep):
+                continue
+            existing = index.get(name)
+            if existing is not None and existing[0] is not None:
+                continue  # Shadowed by an earlier directory
+            locations = [os.path.dirname(path)] if is_package else None
+            index[name] = (path, locations, archive)
+    return index
+
+def open_stub_sources(stub_dirs, modules=None, prefer_bundle=True):
+    # Stub directories become module indexes, except those holding a stub
+    # pack, which is used as is through its own memory-mapped index. Runs of
+    # consecutive directories share an index so that namespace packages
+    # spanning them merge as they would on sys.path.
+    sources = []
+    pending = []
+    for stub_dir in stub_dirs:
+        pack_path = os.path.join(os.path.abspath(stub_dir), PACK_NAME)
+        if prefer_bundle and os.path.isfile(pack_path):
+            if pending:
+                sources.append(build_module_index(pending, modules, prefer_bundle))
+                pending = []
+            sources.append(StubPack(pack_path))
+        else:
+            pending.append(stub_dir)
+    if pending:
+        sources.append(build_module_index(pending, modules, prefer_bundle))
+    return sources
+
+class StubFinder:
+    # A sys.meta_path finder resolving stubbed modules with one dict lookup
+    # (or one hashed probe of a stub pack) and leaving every other import to
+    # the regular import system
+    def __init__(self, stub_dirs, modules=None, prefer_bundle=True):
+        self.stub_dirs = [str(stub_dir) for stub_dir in stub_dirs]
+        self.modules = modules
+        self.prefer_bundle = prefer_bundle
+        self.sources = open_stub_sources(self.stub_dirs, modules, prefer_bundle)
+        self.zip_importers = {}
+
+    def find_spec(self, fullname, path=None, target=None):
+        for source in self.sources:
+            if isinstance(source, StubPack):
+                if self.modules is None or is_selected(fullname, self.modules):
+                    spec = source.find_spec(fullname)
+                    if spec is not None:
+                        return spec
+                continue
+            entry = source.get(fullname)
+            if entry is not None:
+                return self.find_indexed_spec(fullname, path, entry)
+        return None
+
+    def find_indexed_spec(self, fullname, path, entry):
+        origin, locations, archive = entry
+        if archive is not None:
+            return self.find_bundled_spec(fullname, archive)
+        if origin is not None:
+            return spec_from_file_location(fullname, origin, submodule_search_locations=locations)
+
+        # A namespace portion loses against a regular package found on the
+        # real path, as it would with the stubs prepended to sys.path
+        spec = PathFinder.find_spec(fullname, path)
+        if spec is not None and spec.loader is not None:
+            return None
+        spec = ModuleSpec(fullname, None, is_package=True)
+        spec.submodule_search_locations = list(locations)
+        return spec
+
+    def find_bundled_spec(self, fullname, archive):
+        # zipimport resolves only the last name component, relative to the
+        # package directory the importer was created for
+        package_dir = os.path.join(archive, *fullname.split('.')[:-1])
+        importer = self.zip_importers.get(package_dir)
+        if importer is None:
+            import zipimport
+
+            importer = self.zip_importers[package_dir] = zipimport.zipimporter(package_dir)
+        return importer.find_spec(fullname)
+
+    def invalidate_caches(self):
+        # Packs are not closed: modules loaded from them still reference
+        # their memory maps
+        self.sources = open_stub_sources(self.stub_dirs, self.modules, self.prefer_bundle)
+        self.zip_importers = {}
+
+def install_stub_finder(stub_dirs, modules=None, prefer_bundle=True):
+    finder = StubFinder(stub_dirs, modules, prefer_bundle)
+    sys.meta_path.insert(0, finder)
+    return finder
+
+class StubFinderTests:
+    # Run with `python -m unittest stub_finder`. load_tests() makes a
+    # unittest.TestCase of these, so installing the finder at startup does
+    # not import unittest.
+    def setUp(self):
+        import tempfile
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.addCleanup(self.forget_modules)
+
+    def write(self, path, source=''):
+        path = os.path.join(self.tmp, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(source)
+
+    def forget_modules(self):
+        for name in list(sys.modules):
+            if name.startswith('finder_test_'):
+                del sys.modules[name]
+
+    def install(self, stub_dirs, modules=None):
+        finder = install_stub_finder([os.path.join(self.tmp, stub_dir) for stub_dir in stub_dirs], modules)
+        self.addCleanup(sys.meta_path.remove, finder)
+        return finder
+
+    def test_stubbed_modules_are_found_in_the_index(self):
+        import importlib
+
+        self.write('stubs/finder_test_app/__init__.py')
+        self.write('stubs/finder_test_app/views.py', 'ORIGIN = "stubs"\n')
+        self.write('stubs/finder_test_ns/mod.py', 'ORIGIN = "stubs"\n')
+        self.write('stubs/finder_test_other.py')
+        self.write('more/finder_test_app/views.py', 'ORIGIN = "more"\n')
+        self.write('more/finder_test_ns/extra.py', 'ORIGIN = "more"\n')
+        index = build_module_index([os.path.join(self.tmp, 'stubs'), os.path.join(self.tmp, 'more')])
+        self.assertEqual(index['finder_test_app.views'][0], os.path.join(self.tmp, 'stubs', 'finder_test_app', 'views.py'))
+        self.assertIsNone(index['finder_test_ns'][0])
+
+        self.install(['stubs', 'more'], modules=['finder_test_app.*', 'finder_test_ns.*'])
+        # Earlier directories win, namespace packages span both
+        self.assertEqual(importlib.import_module('finder_test_app.views').ORIGIN, 'stubs')
+        self.assertEqual(importlib.import_module('finder_test_ns.mod').ORIGIN, 'stubs')
+        self.assertEqual(importlib.import_module('finder_test_ns.extra').ORIGIN, 'more')
+        # Modules that are not selected are left to the regular import system
+        with self.assertRaises(ModuleNotFoundError):
+            importlib.import_module('finder_test_other')
+
+    def test_bundles_are_preferred_over_the_tree(self):
+        import importlib
+        import zipimport
+
+        from create_doppelganger_repo import create_doppelganger_repo
+
+        self.write('src/finder_test_bundled/__init__.py')
+        self.write('src/finder_test_bundled/mod.py', 'def f() -> int:\n    return 1\n')
+        create_doppelganger_repo(os.path.join(self.tmp, 'src'), os.path.join(self.tmp, 'dst'), bytecode='zip')
+        self.assertEqual(list(iter_stub_files(os.path.join(self.tmp, 'dst', BUNDLE_NAME))),
+                         ['finder_test_bundled/__init__.py', 'finder_test_bundled/mod.py'])
+
+        self.install(['dst'])
+        module = importlib.import_module('finder_test_bundled.mod')
+        self.assertIsInstance(module.__spec__.loader, zipimport.zipimporter)
+        self.assertIsNone(module.f())
+
+    def test_is_selected(self):
+        self.assertTrue(is_selected('main_app', ['main_app.*']))
+        self.assertTrue(is_selected('main_app.views.detail', ['main_app.*']))
+        self.assertFalse(is_selected('main_apps', ['main_app.*']))
+        self.assertTrue(is_selected('anything', None))
+
+def load_tests(loader, tests, pattern):
+    import unittest
+
+    return loader.loadTestsFromTestCase(type('TestStubFinder', (StubFinderTests, unittest.TestCase), {}))
@@ -0,0 +1,301 @@
+import os
+import hashlib
+import marshal
+import mmap
+import struct
+from importlib.machinery import ModuleSpec
+from importlib.util import MAGIC_NUMBER
+
+# Layout of a stub pack, all integers little-endian:
+#
+#   header  magic, bytecode magic of the writing interpreter, module count,
+#           number of index slots (a power of two), offset of the index
+#   data    module names, stub sources and marshalled code, back to back
+#   index   open-addressing hash table of fixed-size slots, probed linearly
+#
+# A lookup hashes the module name, jumps to its slot and compares at most a
+# few neighbouring slots, all through the memory map: no directory scans and
+# nothing to parse when the pack is opened.
+PACK_MAGIC = b'DPLPACK1'
+HEADER = struct.Struct('<8s4sIIQ4x')
+SLOT = struct.Struct('<QQIIQIQI')
+
+# Slot flags
+IS_PACKAGE = 0x1
+IS_NAMESPACE = 0x2
+HAS_CODE = 0x4
+
+def name_hash(name):
+    # Python's hash() is salted per process, the index needs a stable hash
+    return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(), 'little')
+
+def module_name(relative_file):
+    # 'pkg/sub/__init__.py' -> ('pkg.sub', True), 'pkg/mod.py' -> ('pkg.mod', False)
+    parts = relative_file[:-len('.py')].split('/')
+    if parts[-1] == '__init__':
+        return '.'.join(parts[:-1]), True
+    return '.'.join(parts), False
+
+class PackWriter:
+    # Stream stubs into a new pack: blobs are written as they are added and
+    # only the small per-module records are kept until the index is written
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(b'\0' * HEADER.size)
+        self.records = {}
+
+    def write_blob(self, data):
+        offset = self.file.tell()
+        self.file.write(data)
+        return offset, len(data)
+
+    def add(self, relative_file, source, code=b''):
+        name, is_package = module_name(relative_file)
+        if not name:
+            return
+        encoded_name = name.encode()
+        name_offset, name_len = self.write_blob(encoded_name)
+        source_offset, source_len = self.write_blob(source)
+        code_offset, code_len = self.write_blob(code) if code else (0, 0)
+        flags = (IS_PACKAGE if is_package else 0) | (HAS_CODE if code else 0)
+        self.records[encoded_name] = (name_offset, name_len, flags, source_offset, source_len, code_offset, code_len)
+
+    def close(self):
+        # Parent packages without an __init__ stub become namespace packages
+        for encoded_name in list(self.records):
+            parts = encoded_name.split(b'.')
+            for depth in range(1, len(parts)):
+                parent = b'.'.join(parts[:depth])
+                if parent not in self.records:
+                    name_offset, name_len = self.write_blob(parent)
+                    self.records[parent] = (name_offset, name_len, IS_PACKAGE | IS_NAMESPACE, 0, 0, 0, 0)
+
+        nslots = 1
+        while nslots < 2 * len(self.records):
+            nslots *= 2
+        slots = [None] * nslots
+        for encoded_name in sorted(self.records):
+            h = name_hash(encoded_name)
+            i = h & (nslots - 1)
+            while slots[i] is not None:
+                i = (i + 1) & (nslots - 1)
+            slots[i] = SLOT.pack(h, *self.records[encoded_name])
+
+        index_offset = self.file.tell()
+        empty = b'\0' * SLOT.size
+        self.file.write(b''.join(slot or empty for slot in slots))
+        self.file.seek(0)
+        self.file.write(HEADER.pack(PACK_MAGIC, MAGIC_NUMBER, len(self.records), nslots, index_offset))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+class StubPack:
+    # Read-only view of a pack through a memory map
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(self.path, 'rb') as file:
+            # An empty file cannot be mapped and raises ValueError as well
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self.map)
+        if size < HEADER.size:
+            self.map.close()
+            raise ValueError(f"{path} is truncated")
+        magic, self.code_magic, self.count, self.nslots, self.index_offset = HEADER.unpack_from(self.map, 0)
+        if magic != PACK_MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a stub pack")
+        # The index is written last, so a pack cut short (e.g. half copied)
+        # is missing at least its end
+        if (self.nslots & (self.nslots - 1) or not self.nslots or self.index_offset < HEADER.size
+                or self.index_offset + self.nslots * SLOT.size > size):
+            self.map.close()
+            raise ValueError(f"{path} is truncated")
+        # Marshalled code is only usable by the interpreter version that wrote it
+        self.code_usable = self.code_magic == MAGIC_NUMBER
+        self.view = memoryview(self.map)
+
+    def lookup(self, name):
+        # Return (flags, source, code) for a module name, or None
+        encoded_name = name.encode()
+        h = name_hash(encoded_name)
+        mask = self.nslots - 1
+        i = h & mask
+        while True:
+            slot = SLOT.unpack_from(self.map, self.index_offset + i * SLOT.size)
+            slot_hash, name_offset, name_len, flags, source_offset, source_len, code_offset, code_len = slot
+            if name_len == 0:
+                return None
+            if slot_hash == h and self.view[name_offset:name_offset + name_len] == encoded_name:
+                source = self.view[source_offset:source_offset + source_len]
+                code = self.view[code_offset:code_offset + code_len]
+                return flags, source, code
+            i = (i + 1) & mask
+
+    def __contains__(self, relative_file):
+        entry = self.lookup(module_name(relative_file)[0])
+        return entry is not None and not entry[0] & IS_NAMESPACE
+
+    def origin(self, name, flags):
+        # A virtual path inside the pack, for __file__ and tracebacks
+        parts = name.split('.')
+        if flags & IS_PACKAGE:
+            return os.path.join(self.path, *parts, '__init__.py')
+        return os.path.join(self.path, *parts) + '.py'
+
+    def find_spec(self, fullname):
+        entry = self.lookup(fullname)
+        if entry is None:
+            return None
+        flags, source, code = entry
+        package_dir = os.path.join(self.path, *fullname.split('.'))
+        if flags & IS_NAMESPACE:
+            spec = ModuleSpec(fullname, None, is_package=True)
+            spec.submodule_search_locations = [package_dir]
+            return spec
+        loader = PackLoader(self, fullname, flags, source, code)
+        spec = ModuleSpec(fullname, loader, origin=self.origin(fullname, flags), is_package=bool(flags & IS_PACKAGE))
+        spec.has_location = True
+        if flags & IS_PACKAGE:
+            spec.submodule_search_locations = [package_dir]
+        return spec
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+
+class PackLoader:
+    # Executes a module straight out of the memory-mapped pack
+    def __init__(self, pack, name, flags, source, code):
+        self.pack = pack
+        self.name = name
+        self.flags = flags
+        self.source = source
+        self.code = code
+
+    def create_module(self, spec):
+        return None  # Default module creation
+
+    def get_code(self, fullname):
+        if self.flags & HAS_CODE and self.pack.code_usable:
+            return marshal.loads(self.code)
+        return compile(bytes(self.source), self.pack.origin(self.name, self.flags), 'exec', dont_inherit=True)
+
+    def exec_module(self, module):
+        exec(self.get_code(module.__name__), module.__dict__)
+
+    def get_source(self, fullname):
+        return bytes(self.source).decode()
+
+    def is_package(self, fullname):
+        return bool(self.flags & IS_PACKAGE)
+
+class StubPackTests:
+    # Run with `python -m unittest stub_pack`; load_tests() makes a
+    # unittest.TestCase of these, keeping unittest out of stubbed runs
+    def setUp(self):
+        import tempfile
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def write_source(self, relative_file, source):
+        path = os.path.join(self.tmp, 'src', relative_file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(source)
+
+    def build(self, **options):
+        from create_doppelganger_repo import create_doppelganger_repo
+
+        return create_doppelganger_repo(os.path.join(self.tmp, 'src'), os.path.join(self.tmp, 'dst'), output_format='pack', **options)
+
+    def test_write_and_look_up(self):
+        path = os.path.join(self.tmp, 'stubs.pack')
+        with PackWriter(path) as writer:
+            writer.add('app/__init__.py', b'')
+            writer.add('app/models.py', b'X = 1\n', marshal.dumps(compile('X = 2\n', 'models', 'exec')))
+            writer.add('ns/deep/mod.py', b'Y = 1\n')
+        pack = StubPack(path)
+        self.addCleanup(pack.close)
+        self.assertEqual(pack.count, 5)
+
+        flags, source, code = pack.lookup('app.models')
+        self.assertEqual((flags, bytes(source)), (HAS_CODE, b'X = 1\n'))
+        self.assertEqual(pack.lookup('ns.deep')[0], IS_PACKAGE | IS_NAMESPACE)
+        self.assertIsNone(pack.lookup('app.views'))
+        self.assertIn('app/__init__.py', pack)
+        self.assertNotIn('ns/deep/__init__.py', pack)
+
+        spec = pack.find_spec('app.models')
+        self.assertEqual(spec.origin, os.path.join(pack.path, 'app', 'models.py'))
+        namespace = {}
+        exec(spec.loader.get_code('app.models'), namespace)
+        # The marshalled code wins over the source
+        self.assertEqual(namespace['X'], 2)
+
+    def test_import_from_a_generated_pack(self):
+        import importlib
+        import sys
+
+        from stub_finder import install_stub_finder
+
+        self.write_source('pack_test_app/__init__.py', '')
+        self.write_source('pack_test_app/views.py', 'def view() -> str:\n    return "real"\n')
+        self.build(stub_mode='typed', bytecode='pycache')
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp, 'dst'))), ['.doppelganger_imports.json', '.doppelganger_manifest.json', 'stubs.pack'])
+
+        finder = install_stub_finder([os.path.join(self.tmp, 'dst')])
+        self.addCleanup(sys.meta_path.remove, finder)
+        self.addCleanup(sys.modules.pop, 'pack_test_app.views', None)
+        self.addCleanup(sys.modules.pop, 'pack_test_app', None)
+        views = importlib.import_module('pack_test_app.views')
+        self.assertEqual(views.view(), '')
+        self.assertEqual(views.__file__, os.path.join(self.tmp, 'dst', 'stubs.pack', 'pack_test_app', 'views.py'))
+
+    def test_truncated_packs_are_rejected_and_rebuilt(self):
+        for i in range(20):
+            self.write_source(f'pkg/mod{i}.py', f'X = {i}\n')
+        self.build()
+        path = os.path.join(self.tmp, 'dst', 'stubs.pack')
+        with open(path, 'rb') as file:
+            data = file.read()
+
+        for size in (0, HEADER.size - 1, HEADER.size, len(data) // 2, len(data) - 1):
+            with self.subTest(size=size):
+                with open(path, 'wb') as file:
+                    file.write(data[:size])
+                with self.assertRaises(ValueError):
+                    StubPack(path)
+        # A half-copied pack costs a full rebuild, not a crash
+        self.assertEqual(self.build()['regenerated'], 20)
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(), data)
+
+    def test_packs_do_not_depend_on_worker_timing(self):
+        for i in range(40):
+            self.write_source(f'pkg/mod{i:02d}.py', f'def f{i}():\n    return {i}\n' * (1 + i % 7))
+        path = os.path.join(self.tmp, 'dst', 'stubs.pack')
+        packs = []
+        for jobs in (1, 2, 2):
+            if os.path.exists(path):
+                os.remove(path)
+            self.build(jobs=jobs, chunk_size=1)
+            with open(path, 'rb') as file:
+                packs.append(file.read())
+        self.assertEqual(packs[1], packs[0])
+        self.assertEqual(packs[2], packs[0])
+
+def load_tests(loader, tests, pattern):
+    import unittest
+
+    return loader.loadTestsFromTestCase(type('TestStubPack', (StubPackTests, unittest.TestCase), {}))
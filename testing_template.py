@@ -3,11 +3,11 @@
 
 ### Logger Setup
 
-Initializes a logger to capture detailed logs, useful for debugging.
+Initializes a logger to capture detailed logs, useful for debugging. Calling `setup_logger` again replaces its handlers instead of duplicating them, and `async_writer=True` moves the file writes to a background thread.
 
 ### Helper Method
 
-`assertDoesNotRaise` is now a method within the `TestBugFixTemplate` class.
+`assertDoesNotRaise` is now a method within the `TestBugFixTemplate` class. So is `assertScenariosPass`, which fails with one subtest per failed case of a `ScenarioMatrix` run.
 
 ### Buggy and Fixed Function Placeholders
 
@@ -25,16 +25,22 @@ Provides a structure to test various scenarios with detailed comments:
 - **Scenario II**: Buggy callee with exception handling by its caller should capture the exception and output an error message, which doesn't match the observed output either (intermediary fixing to avoid crashing).
 - **Scenario III**: Fixed callee without exception handling by its caller should NOT raise an exception, and the output matches the expected output (unprotectedly fixed).
 - **Scenario IV**: Fixed callee with exception handling by its caller should output the function's expected result, which matches the expected output (fixed for good!).
+- **Scenario V**: Fixed callee, with and without exception handling by its caller, should be neither significantly slower nor allocate more than in its recorded baseline (no performance regression).
 
-### Detailed Test Methods
+### Scenario Matrix
 
-Each test method corresponds to a specific scenario and verifies the expected behavior.
+`ScenarioMatrix` generates the four scenarios for every input of a table; `matrix.run()` skips the cases that were green and unchanged in the last run.
+
+### Performance Baselines
+
+`matrix.benchmark()` checks Scenario V against the calibrated timings and allocations committed in `.scenario_baselines.json`, and skips the variants without one.
 
 ### How to Use the Template
 
 1. **Replace Placeholders**: Substitute the placeholders (`buggy_function`, `fixed_function`, `handle_with_exception_handling`) with the actual function names and logic.
-2. **Customize Test Methods**: Modify the test methods to match the parameters and expected results for your specific bug fix.
-3. **Run Tests**: Execute the tests to verify that the bug is fixed and that the new implementation works as expected.
+2. **Fill the Matrix**: Add one `matrix.add_input(...)` row per input, with the expected result of the fixed function (and `raises=None` for inputs on which the bug does not show).
+3. **Record Baselines**: Run `matrix.benchmark(update=True)` once the fix is final and commit `.scenario_baselines.json`.
+4. **Run Tests**: Execute the tests to verify that the bug is fixed and that the new implementation works as expected.
 
 ### Suggestions for Next Steps
 
@@ -43,24 +49,63 @@ Each test method corresponds to a specific scenario and verifies the expected be
 **b.** Extend the template to include more complex scenarios and edge cases specific to your application.
 
 """
+import os
+import sys
+import json
+import math
+import time
+import hashlib
+import inspect
+import tempfile
 import unittest
 import logging
+import functools
+import statistics
+import tracemalloc
+import concurrent.futures
 from logging.handlers import RotatingFileHandler
 
+# Names of the handlers attached by setup_logger, so that calling it again
+# replaces them instead of adding duplicates
+SETUP_HANDLER_NAMES = (
+    "setup_logger.file",
+    "setup_logger.console",
+    "setup_logger.writer",
+)
+
 
-def setup_logger(name, log_file, level=logging.DEBUG):
+def setup_logger(
+    name, log_file, level=logging.DEBUG, async_writer=False, **writer_options
+):
     """
     Initializes a logger to capture detailed logs, useful for debugging.
+    With async_writer, a BatchingLogWriter (see log_writer.py) writes the logs from a
+    background thread, configured by writer_options.
     """
     formatter = logging.Formatter(
         "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     )
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    for handler in list(logger.handlers):
+        if handler.name in SETUP_HANDLER_NAMES:
+            logger.removeHandler(handler)
+            handler.close()
+    if async_writer:
+        from log_writer import BatchingLogWriter
+
+        writer_options.setdefault("stream", sys.stderr)
+        writer = BatchingLogWriter(log_file, **writer_options)
+        writer.set_name("setup_logger.writer")
+        writer.setFormatter(formatter)
+        logger.addHandler(writer)
+        return logger
     file_handler = RotatingFileHandler(log_file, maxBytes=10**6, backupCount=3)
+    file_handler.set_name("setup_logger.file")
     file_handler.setFormatter(formatter)
     console_handler = logging.StreamHandler()
+    console_handler.set_name("setup_logger.console")
     console_handler.setFormatter(formatter)
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
     logger.addHandler(file_handler)
     logger.addHandler(console_handler)
     return logger
@@ -99,6 +144,459 @@ def handle_with_exception_handling(func, *args, **kwargs):
         return {"error": str(e)}
 
 
+# Green runs are remembered here, relative to the working directory
+SCENARIO_CACHE = ".scenario_cache.json"
+
+# (name, description, uses the fixed callee, called through the wrapper)
+SCENARIOS = (
+    (
+        "I",
+        "Buggy callee without exception handling by its caller should raise an exception (reproduces the bug).",
+        False,
+        False,
+    ),
+    (
+        "II",
+        "Buggy callee with exception handling by its caller should output an error message (intermediary fixing).",
+        False,
+        True,
+    ),
+    (
+        "III",
+        "Fixed callee without exception handling by its caller should output the expected output (unprotectedly fixed).",
+        True,
+        False,
+    ),
+    (
+        "IV",
+        "Fixed callee with exception handling by its caller should output the expected output (fixed for good!).",
+        True,
+        True,
+    ),
+)
+
+
+def source_of(func):
+    """
+    Source code of a function, None if it is not available (e.g. a builtin).
+    """
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return None
+
+
+def run_scenario_case(callee, wrapper, kwargs, outcome):
+    """
+    Runs one case and returns None if it passed, or why it failed. The outcome is
+    ("raises", exception type) or ("returns", expected result).
+    """
+    try:
+        result = callee(**kwargs) if wrapper is None else wrapper(callee, **kwargs)
+    except Exception as e:
+        if outcome[0] == "raises" and isinstance(e, outcome[1]):
+            return None
+        return f"raised {type(e).__name__}: {e}"
+    if outcome[0] == "raises":
+        return f"returned {result!r} instead of raising {outcome[1].__name__}"
+    if result != outcome[1]:
+        return f"returned {result!r} instead of {outcome[1]!r}"
+    return None
+
+
+def run_scenario_batch(cases):
+    """
+    Worker entry point: the outcome of run_scenario_case for every case of a batch.
+    """
+    return [run_scenario_case(*case) for case in cases]
+
+
+# Baselines of Scenario V, committed next to this file: the samples are
+# relative to calibration_workload, which makes them portable across machines
+PERFORMANCE_BASELINES = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".scenario_baselines.json"
+)
+
+# The variants timed by Scenario V: (name, uses the fixed callee, wrapped). Only
+# the fixed ones are checked against their baselines.
+PERFORMANCE_VARIANTS = (
+    ("buggy callee", False, False),
+    ("buggy callee, wrapped", False, True),
+    ("fixed callee", True, False),
+    ("fixed callee, wrapped", True, True),
+)
+
+
+def calibration_workload():
+    """
+    Pure-Python workload timed next to every sample of Scenario V, so that the
+    samples measure the callee relative to the speed of the machine at the time.
+    """
+    total = 0
+    for i in range(200):
+        total += i * i
+    return total
+
+
+def time_calls(call, number):
+    """
+    CPU seconds per call over `number` calls; exceptions count as returns. CPU
+    time leaves out the time the process spent preempted by others.
+    """
+    started = time.process_time()
+    for _ in range(number):
+        try:
+            call()
+        except Exception:
+            pass
+    return (time.process_time() - started) / number
+
+
+def calls_per_sample(call, min_sample_time):
+    """
+    Number of calls taking about min_sample_time, extrapolated from doubling runs
+    of a tenth of it; this also warms the call up.
+    """
+    number = 1
+    while True:
+        elapsed = time_calls(call, number) * number
+        if elapsed >= min_sample_time / 10:
+            return max(number, math.ceil(number * min_sample_time / elapsed))
+        number *= 2
+
+
+def peak_allocation(call):
+    """
+    Peak bytes allocated by one call, traced after a first untraced call.
+    """
+    try:
+        call()
+    except Exception:
+        pass
+    # A caller already tracing, e.g. under `python -X tracemalloc`, keeps tracing
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        try:
+            call()
+        except Exception:
+            pass
+        return max(0, tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        if started:
+            tracemalloc.stop()
+
+
+def measure_performance(call, repeat, min_sample_time):
+    """
+    (median seconds per call, samples relative to calibration_workload, peak bytes
+    allocated per call).
+    """
+    number = calls_per_sample(call, min_sample_time)
+    calibration_number = calls_per_sample(calibration_workload, min_sample_time)
+    seconds = []
+    samples = []
+    for _ in range(repeat):
+        elapsed = time_calls(call, number)
+        seconds.append(elapsed)
+        samples.append(elapsed / time_calls(calibration_workload, calibration_number))
+    return statistics.median(seconds), samples, peak_allocation(call)
+
+
+def slower_p_value(baseline, current):
+    """
+    One-sided Mann-Whitney U test (normal approximation, average ranks for ties):
+    the probability of `current` ranking at least this high above `baseline` if
+    both came from the same distribution.
+    """
+    ranked = sorted(
+        [(value, False) for value in baseline] + [(value, True) for value in current]
+    )
+    current_ranks = 0.0
+    index = 0
+    while index < len(ranked):
+        end = index
+        while end + 1 < len(ranked) and ranked[end + 1][0] == ranked[index][0]:
+            end += 1
+        rank = (index + end) / 2 + 1
+        current_ranks += rank * sum(
+            1 for _, is_current in ranked[index : end + 1] if is_current
+        )
+        index = end + 1
+    n1, n2 = len(current), len(baseline)
+    u = current_ranks - n1 * (n1 + 1) / 2
+    deviation = math.sqrt(n1 * n2 * (n1 + n2 + 1) / 12)
+    if not deviation:
+        return 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / deviation
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+class ScenarioReport:
+    """
+    Outcome of a ScenarioMatrix run: the names of the cases that passed or were
+    skipped (green in the last run and unchanged, or without a Scenario V baseline),
+    and (name, reason) per failure. Scenario V adds (name, median seconds, peak
+    bytes) per variant timed.
+    """
+
+    def __init__(self):
+        self.passed = []
+        self.skipped = []
+        self.failures = []
+        self.timings = []
+
+
+class ScenarioMatrix:
+    """
+    The four scenarios of a bug fix for every input of a table. Register the buggy
+    and fixed callees and the exception handling wrapper once, then add each input
+    with the output expected from the fixed callee; the buggy callee is expected to
+    raise `raises`, which the wrapper turns into `handled`. Inputs on which the bug
+    does not show are added with raises=None.
+
+    Cases are run in a process pool once there are enough of them, so callees and
+    inputs must be picklable (module-level functions are). Cases whose callee
+    source, wrapper source, input and expectation hash the same as in the last
+    green run are skipped; a change in a function the callee calls is not
+    noticed, use run(use_cache=False) to run everything.
+
+    benchmark() runs Scenario V, the performance of the fixed callee against the
+    baselines stored under the name of the matrix (the fixed callee's by default).
+    """
+
+    def __init__(
+        self,
+        buggy,
+        fixed,
+        wrapper=handle_with_exception_handling,
+        raises=KeyError,
+        handled=None,
+        cache_file=SCENARIO_CACHE,
+        name=None,
+    ):
+        module = fixed.__module__
+        if module == "__main__":
+            # The same baselines whether the tests are run as a script or not
+            module = inspect.getmodulename(inspect.getsourcefile(fixed))
+        self.name = name or f"{module}.{fixed.__qualname__}"
+        self.buggy = buggy
+        self.fixed = fixed
+        self.wrapper = wrapper
+        self.raises = raises
+        self.handled = handled
+        self.cache_file = cache_file
+        self.inputs = []
+
+    def add_input(self, name, kwargs, expected, raises=..., handled=...):
+        """
+        Adds an input, given as the keyword arguments of the callees. `raises` and
+        `handled` default to those of the matrix.
+        """
+        raises = self.raises if raises is ... else raises
+        handled = self.handled if handled is ... else handled
+        self.inputs.append((name, kwargs, expected, raises, handled))
+
+    def cases(self):
+        """
+        (name, callee, wrapper, kwargs, outcome) of every scenario and input.
+        """
+        cases = []
+        for input_name, kwargs, expected, raises, handled in self.inputs:
+            for scenario, _, use_fixed, wrapped in SCENARIOS:
+                if use_fixed or raises is None:
+                    outcome = ("returns", expected)
+                elif wrapped:
+                    outcome = ("returns", handled)
+                else:
+                    outcome = ("raises", raises)
+                callee = self.fixed if use_fixed else self.buggy
+                wrapper = self.wrapper if wrapped else None
+                cases.append(
+                    (
+                        f"Scenario {scenario}: {input_name}",
+                        callee,
+                        wrapper,
+                        kwargs,
+                        outcome,
+                    )
+                )
+        return cases
+
+    def case_hash(self, callee, wrapper, kwargs, outcome, sources):
+        """
+        Hash of everything a case depends on, None if a source is not available.
+        """
+        parts = []
+        for func in (callee, wrapper):
+            if func is not None:
+                if func not in sources:
+                    sources[func] = source_of(func)
+                if sources[func] is None:
+                    return None
+                parts.append(sources[func])
+        parts.append(json.dumps([kwargs, outcome], sort_keys=True, default=repr))
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file, "r") as file:
+                return set(json.load(file))
+        except (OSError, ValueError):
+            return set()
+
+    def save_cache(self, green):
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w") as file:
+            json.dump(sorted(green), file)
+        os.replace(tmp_file, self.cache_file)
+
+    def run(
+        self, workers=None, use_cache=True, batch_size=500, min_parallel_cases=2000
+    ):
+        """
+        Runs the cases and returns a ScenarioReport. They run in this process if
+        there are fewer than `min_parallel_cases` to run (a pool takes longer to
+        start than they take) or if workers is 0, otherwise in batches over
+        `workers` processes (one per CPU by default).
+        """
+        report = ScenarioReport()
+        green = self.load_cache() if use_cache else set()
+        sources = {}
+        to_run = []
+        hashes = []
+        for name, callee, wrapper, kwargs, outcome in self.cases():
+            digest = self.case_hash(callee, wrapper, kwargs, outcome, sources)
+            if digest is not None and digest in green:
+                report.skipped.append(name)
+                continue
+            to_run.append((name, (callee, wrapper, kwargs, outcome)))
+            hashes.append(digest)
+
+        batches = [
+            [case for _, case in to_run[start : start + batch_size]]
+            for start in range(0, len(to_run), batch_size)
+        ]
+        if workers == 0 or len(to_run) < min_parallel_cases:
+            results = [run_scenario_batch(batch) for batch in batches]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                results = list(executor.map(run_scenario_batch, batches))
+
+        messages = [message for batch in results for message in batch]
+        for (name, _), digest, message in zip(to_run, hashes, messages):
+            if message is None:
+                report.passed.append(name)
+                if digest is not None:
+                    green.add(digest)
+            else:
+                report.failures.append((name, message))
+                green.discard(digest)
+        if use_cache and to_run:
+            self.save_cache(green)
+        return report
+
+    def benchmark(
+        self,
+        baseline_file=PERFORMANCE_BASELINES,
+        repeat=10,
+        min_sample_time=0.05,
+        tolerance=1.0,
+        memory_tolerance=0.25,
+        alpha=0.01,
+        update=False,
+    ):
+        """
+        Scenario V: times the buggy and fixed callees, bare and wrapped, on every
+        input, after a warmup, over `repeat` samples, and traces their peak
+        allocation. The fixed variants fail when their fastest sample is more than
+        `tolerance` above the fastest of the baseline and the one-sided Mann-Whitney
+        U test finds the slowdown significant at `alpha`, or when they allocate more
+        than `memory_tolerance` above the baseline. Calibrated timings of callees
+        this small still vary by about 40% between processes, hence the wide default
+        tolerance; allocations do not. Variants without a baseline in baseline_file
+        are skipped; `update` records all of them. Baselines are never moved
+        otherwise, so slow drifts add up until they fail.
+        """
+        report = ScenarioReport()
+        try:
+            with open(baseline_file, "r") as file:
+                baselines = json.load(file)
+        except (OSError, ValueError):
+            baselines = {}
+        changed = False
+        for input_name, kwargs, *_ in self.inputs:
+            for variant, use_fixed, wrapped in PERFORMANCE_VARIANTS:
+                callee = self.fixed if use_fixed else self.buggy
+                if wrapped:
+                    call = functools.partial(self.wrapper, callee, **kwargs)
+                else:
+                    call = functools.partial(callee, **kwargs)
+                seconds, samples, peak = measure_performance(
+                    call, repeat, min_sample_time
+                )
+                name = f"Scenario V: {input_name}, {variant}"
+                report.timings.append((name, seconds, peak))
+                if not use_fixed:
+                    continue
+
+                key = f"{self.name} / {input_name} / {variant}"
+                baseline = baselines.get(key)
+                if update:
+                    baselines[key] = {
+                        "samples": samples,
+                        "peak_bytes": peak,
+                        "seconds": seconds,
+                    }
+                    changed = True
+                    report.passed.append(name)
+                    continue
+                if baseline is None:
+                    report.skipped.append(name)
+                    continue
+
+                # The fastest samples are the least disturbed by other processes
+                slowdown = min(samples) / min(baseline["samples"])
+                p_value = slower_p_value(baseline["samples"], samples)
+                if slowdown > 1 + tolerance and p_value < alpha:
+                    report.failures.append(
+                        (
+                            name,
+                            f"{slowdown:.2f}x slower than its baseline (p={p_value:.2g})",
+                        )
+                    )
+                elif peak > baseline["peak_bytes"] * (1 + memory_tolerance) + 256:
+                    report.failures.append(
+                        (
+                            name,
+                            f"allocates {peak} bytes at peak, {baseline['peak_bytes']} in its baseline",
+                        )
+                    )
+                else:
+                    report.passed.append(name)
+        if changed:
+            tmp_file = baseline_file + ".tmp"
+            with open(tmp_file, "w") as file:
+                json.dump(baselines, file, indent=1, sort_keys=True)
+            os.replace(tmp_file, baseline_file)
+        return report
+
+
+# The scenarios of the placeholders above, one input per row
+matrix = ScenarioMatrix(
+    buggy_function,
+    fixed_function,
+    handle_with_exception_handling,
+    raises=KeyError,
+    handled={"error": "KeyError encountered"},
+)
+matrix.add_input("name", {"name": "Alice"}, expected={"message": "Hello, Alice!"})
+matrix.add_input("missing name", {"age": 30}, expected={"error": "Name not provided"})
+
+
 class TestBugFixTemplate(unittest.TestCase):
     def setUp(self):
         """
@@ -115,71 +613,121 @@ class TestBugFixTemplate(unittest.TestCase):
         except Exception as e:
             self.fail(f"{func.__name__} raised {type(e).__name__} unexpectedly: {e}")
 
-    def test_buggy_function_without_exception_handling(self):
+    def assertScenariosPass(self, report):
         """
-        Scenario I: Buggy callee without exception handling by its caller should raise an exception,
-        which matches the observed output (reproduces the bug).
+        Fails with one subtest per failed case of a ScenarioMatrix run.
         """
-        with self.assertRaises(KeyError):
-            buggy_function(name="Alice")
+        for name, message in report.failures:
+            with self.subTest(name):
+                self.fail(message)
 
-    def test_buggy_function_with_exception_handling(self):
+    def test_scenarios(self):
         """
-        Scenario II: Buggy callee with exception handling by its caller should capture the exception and output an error message,
-        which doesn't match the observed output either (intermediary fixing to avoid crashing).
+        Scenarios I to IV for every input of the matrix, all of them on every run.
         """
-        result = handle_with_exception_handling(buggy_function, name="Alice")
-        self.assertEqual(result, {"error": "KeyError encountered"})
+        report = matrix.run(use_cache=False)
+        self.assertScenariosPass(report)
+        self.assertEqual(len(report.passed), 4 * len(matrix.inputs))
 
-    def test_fixed_function_without_exception_handling(self):
+    def test_scenario_matrix_runner(self):
         """
-        Scenario III: Fixed callee without exception handling by its caller should NOT raise an exception,
-        and the output matches the expected output (unprotectedly fixed).
+        Failures are reported and not cached, green cases are skipped until their
+        callee changes, and large matrices run in a process pool.
         """
-        self.assertDoesNotRaise(fixed_function, name="Alice")
-        result = fixed_function(name="Alice")
-        self.assertEqual(result, {"message": "Hello, Alice!"})
-
-    def test_fixed_function_with_exception_handling(self):
-        """
-        Scenario IV: Fixed callee with exception handling by its caller should output the function's expected result,
-        which matches the expected output (fixed for good!).
-        """
-        result = handle_with_exception_handling(fixed_function, name="Alice")
-        self.assertEqual(result, {"message": "Hello, Alice!"})
-
-    def test_missing_name_buggy_function_without_exception_handling(self):
-        """
-        Scenario I: Buggy callee without exception handling by its caller should raise an exception,
-        which matches the observed output (reproduces the bug).
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache_file = os.path.join(cache_dir, SCENARIO_CACHE)
+            wrong = ScenarioMatrix(
+                buggy_function,
+                fixed_function,
+                handled={"error": "KeyError encountered"},
+                cache_file=cache_file,
+            )
+            wrong.add_input("name", {"name": "Alice"}, expected={"message": "Hi!"})
+            report = wrong.run()
+            self.assertEqual(
+                [name for name, _ in report.failures],
+                ["Scenario III: name", "Scenario IV: name"],
+            )
+            self.assertEqual(len(wrong.run().skipped), 2)
+
+            # A new fixed callee reruns scenarios III and IV only
+            changed = ScenarioMatrix(
+                buggy_function,
+                lambda **kwargs: {"message": "Hi!"},
+                handled={"error": "KeyError encountered"},
+                cache_file=cache_file,
+            )
+            changed.add_input("name", {"name": "Alice"}, expected={"message": "Hi!"})
+            report = changed.run()
+            self.assertEqual(report.skipped, ["Scenario I: name", "Scenario II: name"])
+            self.assertEqual(report.passed, ["Scenario III: name", "Scenario IV: name"])
+
+            large = ScenarioMatrix(
+                buggy_function,
+                fixed_function,
+                handled={"error": "KeyError encountered"},
+                cache_file=cache_file,
+            )
+            for index in range(50):
+                large.add_input(
+                    f"name {index}",
+                    {"name": str(index)},
+                    expected={"message": f"Hello, {index}!"},
+                )
+            report = large.run(workers=2, batch_size=40, min_parallel_cases=0)
+            self.assertScenariosPass(report)
+            self.assertEqual(len(report.passed), 200)
+
+    def test_scenario_v_performance(self):
         """
-        with self.assertRaises(KeyError):
-            buggy_function(age=30)
-
-    def test_missing_name_buggy_function_with_exception_handling(self):
-        """
-        Scenario II: Buggy callee with exception handling by its caller should capture the exception and output an error message,
-        which doesn't match the observed output either (intermediary fixing to avoid crashing).
+        Scenario V: The fixed callee, with and without exception handling by its
+        caller, should be neither significantly slower nor allocate more than in
+        its baseline (no performance regression).
         """
-        result = handle_with_exception_handling(buggy_function, age=30)
-        self.assertEqual(result, {"error": "KeyError encountered"})
-
-    def test_missing_name_fixed_function_without_exception_handling(self):
+        report = matrix.benchmark()
+        self.assertScenariosPass(report)
+        self.assertEqual(len(report.timings), 4 * len(matrix.inputs))
+        for name in report.skipped:
+            with self.subTest(name):
+                self.skipTest(
+                    "no baseline: run matrix.benchmark(update=True) and commit "
+                    f"{os.path.basename(PERFORMANCE_BASELINES)}"
+                )
+
+    def test_performance_regression_is_detected(self):
         """
-        Scenario III: Fixed callee without exception handling by its caller should NOT raise an exception,
-        and the output matches the expected output (unprotectedly fixed).
+        A fix adding an O(n) scan fails Scenario V against the baseline of the
+        original fix, which passes against its own. The scan makes the fix about a
+        hundred times slower, well beyond the default tolerance. Without
+        a baseline, the fixed variants are skipped and nothing is recorded.
         """
-        self.assertDoesNotRaise(fixed_function, age=30)
-        result = fixed_function(age=30)
-        self.assertEqual(result, {"error": "Name not provided"})
 
-    def test_missing_name_fixed_function_with_exception_handling(self):
-        """
-        Scenario IV: Fixed callee with exception handling by its caller should output the function's expected result,
-        which matches the expected output (fixed for good!).
-        """
-        result = handle_with_exception_handling(fixed_function, age=30)
-        self.assertEqual(result, {"error": "Name not provided"})
+        def scanning_fix(**kwargs):
+            for _ in range(2000):
+                pass
+            return fixed_function(**kwargs)
+
+        with tempfile.TemporaryDirectory() as baseline_dir:
+            baseline_file = os.path.join(baseline_dir, "baselines.json")
+            for fixed, update, passes in [
+                (fixed_function, False, None),
+                (fixed_function, True, True),
+                (fixed_function, False, True),
+                (scanning_fix, False, False),
+            ]:
+                regression = ScenarioMatrix(buggy_function, fixed, name="greeting")
+                regression.add_input("name", {"name": "Alice"}, expected=None)
+                report = regression.benchmark(
+                    baseline_file,
+                    repeat=5,
+                    min_sample_time=0.02,
+                    update=update,
+                )
+                if passes is None:
+                    self.assertEqual(len(report.skipped), 2)
+                    self.assertFalse(os.path.exists(baseline_file))
+                else:
+                    self.assertEqual(not report.failures, passes, report.failures)
 
 
 if __name__ == "__main__":
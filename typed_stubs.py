@@ -0,0 +1,409 @@
+import ast
+import builtins
+
+# Stubs produced by the 'typed' stub mode keep the shape of a module (its
+# imports, signatures, classes, nested classes, properties and cheap
+# constants) while everything that would run real work at import time is
+# replaced by a cheap placeholder, so that importing a stub costs the same no
+# matter how heavy the original module is. Functions return a default value
+# of their annotated return type instead of None.
+
+# Literal containers with more elements than this are emptied
+MAX_LITERAL_ITEMS = 64
+
+# Return annotations mapped to the expression of their default value, by the
+# last component of their (possibly dotted) name
+RETURN_DEFAULTS = {
+    'int': '0', 'float': '0.0', 'complex': '0j', 'str': "''", 'bytes': "b''", 'bytearray': 'bytearray()',
+    'bool': 'False', 'list': '[]', 'List': '[]', 'Sequence': '[]', 'MutableSequence': '[]', 'Iterable': '[]',
+    'Collection': '[]', 'dict': '{}', 'Dict': '{}', 'Mapping': '{}', 'MutableMapping': '{}', 'DefaultDict': '{}',
+    'OrderedDict': '{}', 'set': 'set()', 'Set': 'set()', 'AbstractSet': 'set()', 'MutableSet': 'set()',
+    'frozenset': 'frozenset()', 'FrozenSet': 'frozenset()', 'tuple': '()', 'Tuple': '()', 'Iterator': 'iter(())',
+    'Generator': 'iter(())', 'Callable': 'lambda *args, **kwargs: None',
+}
+
+# Decorators that only wrap or describe the function they decorate, as
+# opposed to registering it somewhere (routes, signals, fixtures, ...)
+SAFE_DECORATORS = {
+    'property', 'setter', 'getter', 'deleter', 'staticmethod', 'classmethod', 'abstractmethod', 'cached_property',
+    'overload', 'override', 'final', 'dataclass', 'total_ordering', 'contextmanager', 'asynccontextmanager',
+    'lru_cache', 'cache', 'wraps', 'unique', 'runtime_checkable', 'no_type_check',
+}
+
+# Calls that build typing constructs and are cheap to keep at module level
+SAFE_CALLS = {
+    'TypeVar', 'ParamSpec', 'TypeVarTuple', 'NewType', 'namedtuple', 'NamedTuple', 'TypedDict', 'getLogger', 'field',
+    'auto',
+}
+
+BUILTIN_NAMES = frozenset(dir(builtins))
+
+def dotted_name(node):
+    # 'typing.List' for typing.List, None for anything but a name chain
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        value = dotted_name(node.value)
+        return value + '.' + node.attr if value else None
+    return None
+
+def literal_size(node):
+    # Number of elements of a (nested) literal, None if it is not a literal
+    if isinstance(node, ast.Constant):
+        return 1
+    if isinstance(node, ast.UnaryOp) and isinstance(node.operand, ast.Constant):
+        return 1
+    if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        children = node.elts
+    elif isinstance(node, ast.Dict):
+        if None in node.keys:
+            return None  # **unpacking
+        children = node.keys + node.values
+    else:
+        return None
+    size = 1
+    for child in children:
+        child_size = literal_size(child)
+        if child_size is None:
+            return None
+        size += child_size
+    return size
+
+def empty_like(node):
+    # An empty container of the same kind as a literal
+    if isinstance(node, ast.Dict):
+        return ast.Dict(keys=[], values=[])
+    if isinstance(node, ast.Set):
+        return ast.Call(func=ast.Name(id='set', ctx=ast.Load()), args=[], keywords=[])
+    return type(node)(elts=[], ctx=ast.Load())
+
+def parse_expression(source):
+    return ast.parse(source, mode='eval').body
+
+def default_for_annotation(annotation):
+    # The default value expression for an annotation, None if unknown
+    if annotation is None:
+        return None
+    if isinstance(annotation, ast.Constant) and isinstance(annotation.value, str):
+        # A forward reference: 'list[User]'
+        try:
+            annotation = parse_expression(annotation.value)
+        except SyntaxError:
+            return None
+    if isinstance(annotation, ast.BinOp) and isinstance(annotation.op, ast.BitOr):
+        # X | None is None, X | Y is the default of X
+        if is_none(annotation.left) or is_none(annotation.right):
+            return None
+        return default_for_annotation(annotation.left)
+    if isinstance(annotation, ast.Subscript):
+        origin = dotted_name(annotation.value)
+        name = origin.rpartition('.')[2] if origin else None
+        arguments = annotation.slice.elts if isinstance(annotation.slice, ast.Tuple) else [annotation.slice]
+        if name == 'Optional' or (name == 'Union' and any(is_none(argument) for argument in arguments)):
+            return None
+        if name == 'Union':
+            return default_for_annotation(arguments[0])
+        if name == 'Literal':
+            return arguments[0] if isinstance(arguments[0], ast.Constant) else None
+        if name == 'Annotated':
+            return default_for_annotation(arguments[0])
+        annotation = annotation.value
+    name = dotted_name(annotation)
+    if name is None:
+        return None
+    default = RETURN_DEFAULTS.get(name.rpartition('.')[2])
+    return parse_expression(default) if default is not None else None
+
+def is_none(node):
+    return isinstance(node, ast.Constant) and node.value is None or (isinstance(node, ast.Name) and node.id == 'None')
+
+def is_generator(node):
+    # Whether a function body yields, ignoring nested scopes
+    stack = list(node.body)
+    while stack:
+        child = stack.pop()
+        if isinstance(child, (ast.Yield, ast.YieldFrom)):
+            return True
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+            continue
+        stack.extend(ast.iter_child_nodes(child))
+    return False
+
+class TypedStubGenerator(ast.NodeTransformer):
+    def __init__(self):
+        # Names bound by the statements kept so far, in the module and in
+        # the class bodies being visited. Only expressions built from these
+        # are known not to fail once their definitions became placeholders.
+        self.scopes = [set()]
+
+    def is_bound(self, name):
+        return name in BUILTIN_NAMES or any(name in scope for scope in self.scopes)
+
+    def bind(self, target):
+        for node in ast.walk(target):
+            if isinstance(node, ast.Name):
+                self.scopes[-1].add(node.id)
+
+    def is_cheap(self, node):
+        # Expressions that are evaluated in constant time and cannot fail:
+        # literals, bound names and attributes, type expressions such as
+        # Optional[int] or int | None, and typing constructs like TypeVar
+        if isinstance(node, ast.Constant):
+            return True
+        if isinstance(node, ast.Name):
+            return self.is_bound(node.id)
+        if isinstance(node, ast.Attribute):
+            return self.is_cheap(node.value)
+        if isinstance(node, ast.Subscript):
+            return self.is_cheap(node.value) and self.is_cheap(node.slice)
+        if isinstance(node, ast.UnaryOp):
+            return self.is_cheap(node.operand)
+        if isinstance(node, ast.BinOp):
+            return isinstance(node.op, ast.BitOr) and self.is_cheap(node.left) and self.is_cheap(node.right)
+        if isinstance(node, ast.Compare):
+            return self.is_cheap(node.left) and all(self.is_cheap(comparator) for comparator in node.comparators)
+        if isinstance(node, ast.BoolOp):
+            return all(self.is_cheap(value) for value in node.values)
+        if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+            return len(node.elts) <= MAX_LITERAL_ITEMS and all(self.is_cheap(elt) for elt in node.elts)
+        if isinstance(node, ast.Dict):
+            return (len(node.keys) <= MAX_LITERAL_ITEMS and None not in node.keys
+                    and all(self.is_cheap(child) for child in node.keys + node.values))
+        if isinstance(node, ast.Lambda):
+            # The body only runs when called
+            return all(self.is_cheap(default) for default in node.args.defaults + node.args.kw_defaults if default is not None)
+        if isinstance(node, ast.Call):
+            return self.is_cheap_call(node, SAFE_CALLS)
+        return False
+
+    def is_cheap_call(self, node, allowed):
+        name = dotted_name(node.func)
+        return (name is not None and name.rpartition('.')[2] in allowed and self.is_cheap(node.func)
+                and all(self.is_cheap(arg) for arg in node.args)
+                and all(self.is_cheap(keyword.value) for keyword in node.keywords))
+
+    def stub_value(self, value, annotation=None, name=None):
+        # A cheap stand-in for the value of an assignment, and whether the
+        # assigned name can be relied upon by the rest of the stub
+        if value is None or self.is_cheap(value):
+            return value, True
+        if literal_size(value) is not None:
+            # Large constant tables are emptied, except __all__ and friends
+            return (value if name is not None and name.startswith('__') else empty_like(value)), True
+        default = default_for_annotation(annotation)
+        return (default if default is not None else ast.Constant(value=None)), False
+
+    def keep_decorator(self, node):
+        if isinstance(node, ast.Call):
+            return self.is_cheap_call(node, SAFE_DECORATORS)
+        name = dotted_name(node)
+        return name is not None and name.rpartition('.')[2] in SAFE_DECORATORS and self.is_cheap(node)
+
+    def stub_arguments(self, arguments):
+        # Defaults are evaluated when the function is defined
+        def cheap_default(argument, default):
+            if default is None or self.is_cheap(default):
+                return default
+            replacement = default_for_annotation(argument.annotation)
+            return replacement if replacement is not None else ast.Constant(value=None)
+
+        positional = arguments.posonlyargs + arguments.args
+        positional = positional[len(positional) - len(arguments.defaults):]
+        arguments.defaults = [cheap_default(argument, default) for argument, default in zip(positional, arguments.defaults)]
+        arguments.kw_defaults = [cheap_default(argument, default) for argument, default in zip(arguments.kwonlyargs, arguments.kw_defaults)]
+
+    def visit_FunctionDef(self, node):
+        self.stub_arguments(node.args)
+        node.decorator_list = [decorator for decorator in node.decorator_list if self.keep_decorator(decorator)]
+        if is_generator(node):
+            # Still a generator, so that iterating over the result works
+            node.body = [ast.Return(value=None), ast.Expr(value=ast.Yield(value=None))]
+        else:
+            default = default_for_annotation(node.returns)
+            node.body = [ast.Return(value=default) if default is not None else ast.Pass()]
+        self.bind(ast.Name(id=node.name))
+        return node
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        node.bases = [base for base in node.bases if self.is_cheap(base)]
+        node.keywords = [keyword for keyword in node.keywords if self.is_cheap(keyword.value)]
+        node.decorator_list = [decorator for decorator in node.decorator_list if self.keep_decorator(decorator)]
+        self.scopes.append(set())
+        body = []
+        if ast.get_docstring(node, clean=False) is not None:
+            body.append(node.body[0])
+            node.body = node.body[1:]
+        body += self.stub_statements(node.body)
+        self.scopes.pop()
+        node.body = body or [ast.Pass()]
+        self.bind(ast.Name(id=node.name))
+        return node
+
+    def stub_statements(self, statements):
+        body = []
+        for statement in statements:
+            statement = self.stub_statement(statement)
+            if statement is not None:
+                body.append(statement)
+        return body
+
+    def stub_block(self, statements):
+        return self.stub_statements(statements) or [ast.Pass()]
+
+    def stub_statement(self, node):
+        # A module or class level statement, its cheap replacement or None
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            return self.visit(node)
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                self.scopes[-1].add((alias.asname or alias.name).partition('.')[0])
+            return node
+        if isinstance(node, ast.Assign):
+            if not all(isinstance(target, ast.Name) for target in node.targets):
+                if all(isinstance(target, (ast.Tuple, ast.List)) for target in node.targets) and self.is_cheap(node.value):
+                    for target in node.targets:
+                        self.bind(target)
+                    return node
+                # Attribute or item assignments touch other objects, and
+                # unpacking a placeholder would fail
+                return None
+            node.value, reliable = self.stub_value(node.value, name=node.targets[0].id)
+            if not reliable and any(target.id == '__all__' for target in node.targets):
+                # A computed __all__ would become None and break star
+                # imports, which without it take the names the stub binds
+                return None
+            if reliable:
+                for target in node.targets:
+                    self.bind(target)
+            return node
+        if isinstance(node, ast.AnnAssign):
+            if not isinstance(node.target, ast.Name):
+                return None
+            node.value, reliable = self.stub_value(node.value, node.annotation, node.target.id)
+            if not reliable and node.target.id == '__all__':
+                return None  # Like a computed __all__ above
+            if reliable:
+                self.bind(node.target)
+            return node
+        if isinstance(node, ast.If):
+            if not self.is_cheap(node.test):
+                return None
+            node.body = self.stub_block(node.body)
+            node.orelse = self.stub_statements(node.orelse)
+            return node
+        if isinstance(node, ast.Try):
+            # Mostly optional imports: try: import x except ImportError: x = None
+            node.body = self.stub_block(node.body)
+            for handler in node.handlers:
+                if handler.type is not None and not self.is_cheap(handler.type):
+                    handler.type = ast.Name(id='Exception', ctx=ast.Load())
+                handler.body = self.stub_block(handler.body)
+            node.orelse = self.stub_statements(node.orelse)
+            node.finalbody = self.stub_statements(node.finalbody)
+            return node
+        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+            return None  # Docstrings and stray strings
+        if getattr(ast, 'TypeAlias', None) is not None and isinstance(node, ast.TypeAlias):
+            return node  # Evaluated lazily
+        # Calls, loops, with blocks, deletions, assertions, augmented
+        # assignments and so on all do work at import time
+        return None
+
+    def visit_Module(self, node):
+        body = self.stub_statements(node.body)
+
+        # Annotations are never evaluated, so they may keep referring to
+        # names whose definitions were replaced by placeholders
+        future_names = {'annotations'}
+        for statement in body:
+            if isinstance(statement, ast.ImportFrom) and statement.module == '__future__':
+                future_names.update(alias.name for alias in statement.names)
+        body = [statement for statement in body if not (isinstance(statement, ast.ImportFrom) and statement.module == '__future__')]
+        future_import = ast.ImportFrom(module='__future__', names=[ast.alias(name=name) for name in sorted(future_names)], level=0)
+        node.body = [future_import] + body
+        return node
+
+def generate_typed_stub(tree):
+    return ast.fix_missing_locations(TypedStubGenerator().visit(tree))
+
+class TypedStubTests:
+    # Run with `python -m unittest typed_stubs`; load_tests() makes a
+    # unittest.TestCase of these
+    SOURCE = '''"""Docstring."""
+import os
+from typing import Iterator, Optional, TypeVar
+try:
+    import missing_optional_dependency
+except ImportError:
+    missing_optional_dependency = None
+
+T = TypeVar('T')
+SETTINGS: dict = load_settings(os.environ)
+TABLE = [%s]
+register_everything()
+
+def count(items: list = SETTINGS['items']) -> int:
+    raise RuntimeError
+
+def find(name: str) -> Optional['User']:
+    raise RuntimeError
+
+def names() -> Iterator[str]:
+    yield from load_names()
+
+class User:
+    kind: str = compute_kind()
+
+    @property
+    def name(self) -> str:
+        raise RuntimeError
+
+    @app.route('/user')
+    def view(self) -> list[str]:
+        raise RuntimeError
+''' % ', '.join(map(str, range(MAX_LITERAL_ITEMS + 1)))
+
+    def load_stub(self, source, name='typed_stub_test'):
+        # Execute the stub of `source` as module `name`
+        import sys
+        import types
+
+        stub = ast.unparse(generate_typed_stub(ast.parse(source)))
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+        self.addCleanup(sys.modules.pop, name, None)
+        exec(compile(stub, name, 'exec'), module.__dict__)
+        return module
+
+    def test_module_level_work_is_replaced(self):
+        module = self.load_stub(self.SOURCE)
+        self.assertIsNone(module.missing_optional_dependency)
+        self.assertEqual((module.SETTINGS, module.TABLE, module.T.__name__), ({}, [], 'T'))
+        self.assertEqual(module.count(), 0)
+        self.assertIsNone(module.find('alice'))
+        self.assertEqual(list(module.names()), [])
+
+        user = module.User()
+        self.assertEqual((module.User.kind, user.name, user.view()), ('', '', []))
+        self.assertIsNone(module.__doc__)
+
+    def test_star_imports_of_stubs(self):
+        self.load_stub("__all__ = ['a']\na = compute()\nb = 2\n")
+        namespace = {}
+        exec('from typed_stub_test import *', namespace)
+        self.assertEqual(sorted(name for name in namespace if name != '__builtins__'), ['a'])
+
+        # A computed __all__ is dropped: the public names are exported instead
+        for source in ("__all__ = ['a'] + ['b']\na = 1\nb = 2\n", "import os\n__all__: list = os.sep.split()\na = 1\nb = 2\n"):
+            with self.subTest(source=source):
+                self.assertFalse(hasattr(self.load_stub(source), '__all__'))
+                namespace = {}
+                exec('from typed_stub_test import *', namespace)
+                self.assertLessEqual({'a', 'b'}, namespace.keys())
+
+def load_tests(loader, tests, pattern):
+    import unittest
+
+    return loader.loadTestsFromTestCase(type('TestTypedStubs', (TypedStubTests, unittest.TestCase), {}))